@@ -0,0 +1,217 @@
+"""
+Cache su disco dei risultati delle analisi. Ogni voce contiene il testo
+prodotto da un'analisi ed è identificata dal nome dell'analisi e dall'hash
+dei suoi parametri; la voce è valida per il watermark del grafo (blocchi
+completati) con cui è stata calcolata. Le voci sono file di testo compressi
+con gzip (prima riga: intestazione JSON con il watermark), scritti e riletti
+riga per riga senza tenere il risultato in memoria; le meno recenti vengono
+eliminate oltre la dimensione massima. Le analisi girano in thread paralleli:
+una voce può sparire (eliminazione LRU) tra la lettura del watermark e la
+ristampa, e in quel caso vale come assente.
+"""
+import contextlib
+import gzip
+import hashlib
+import io
+import json
+import os
+import tempfile
+
+import metrics
+
+# Da incrementare quando cambiano query, schema o formato dell'output:
+# invalida tutte le voci esistenti
+CACHE_SCHEMA_VERSION = 6
+
+# Estensione delle voci; le voci in formato JSON delle versioni precedenti
+# vengono solo eliminate (clear ed eliminazione LRU)
+ENTRY_SUFFIX = '.txt.gz'
+LEGACY_ENTRY_SUFFIX = '.json.gz'
+
+# Analisi i cui risultati dipendono solo dalle singole transazioni: dopo
+# l'aggiunta di blocchi basta eseguirle sui nuovi blocchi e accodare il testo.
+# dormant ne è esclusa: i movimenti sono ordinati sull'intero intervallo e il
+# riepilogo delle rollup riguarda tutti i blocchi, quindi va ricalcolata.
+INCREMENTAL_ANALYSES = {'fan'}
+
+class AnalysisCache:
+    def __init__(self, directory, max_bytes=256 << 20):
+        os.makedirs(directory, exist_ok=True)
+        self._directory = directory
+        self._max_bytes = max_bytes
+
+    @staticmethod
+    def key(name, parameters):
+        payload = json.dumps(
+            {'name': name, 'parameters': parameters, 'version': CACHE_SCHEMA_VERSION}, sort_keys=True
+        )
+        return f"{name}-{hashlib.sha256(payload.encode()).hexdigest()[:16]}"
+
+    def _path(self, key):
+        return os.path.join(self._directory, f"{key}{ENTRY_SUFFIX}")
+
+    def watermark(self, key):
+        """Restituisce il watermark della voce (solo l'intestazione viene letta) oppure None."""
+        try:
+            with gzip.open(self._path(key), 'rt', encoding='utf-8') as f:
+                return json.loads(f.readline())['watermark']
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def replay(self, key, out):
+        """
+        Ristampa su out il testo della voce, riga per riga. Restituisce False,
+        senza stampare nulla, se nel frattempo la voce è stata eliminata.
+        """
+        path = self._path(key)
+        try:
+            f = gzip.open(path, 'rt', encoding='utf-8')
+        except FileNotFoundError:
+            return False
+        with f:
+            f.readline()
+            for line in f:
+                out(line, end='')
+        # L'ora di modifica fa da ora di ultimo accesso per l'eliminazione LRU
+        with contextlib.suppress(FileNotFoundError):
+            os.utime(path)
+        return True
+
+    def writer(self, key, watermark):
+        """Nuova voce per key, scritta man mano (vedi _EntryWriter) e salvata con commit()."""
+        return _EntryWriter(self, self._path(key), watermark, self._max_bytes)
+
+    def clear(self):
+        for path in self._entries():
+            os.remove(path)
+
+    def _entries(self):
+        return [
+            os.path.join(self._directory, name)
+            for name in os.listdir(self._directory) if name.endswith((ENTRY_SUFFIX, LEGACY_ENTRY_SUFFIX))
+        ]
+
+    def _evict(self):
+        """
+        Elimina le voci usate meno di recente finché la cache supera max_bytes.
+        Le voci eliminate nel frattempo da un altro thread vengono ignorate.
+        """
+        entries = []
+        for path in self._entries():
+            with contextlib.suppress(FileNotFoundError):
+                stat = os.stat(path)
+                entries.append((stat.st_mtime, stat.st_size, path))
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self._max_bytes:
+                break
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(path)
+                metrics.inc('analysis_cache_evictions')
+            total -= size
+
+class _EntryWriter:
+    """
+    Scrive il testo di una voce in un file temporaneo compresso man mano che
+    arriva; commit() lo sostituisce alla voce. Il file temporaneo è proprio di
+    ogni writer: due esecuzioni concorrenti della stessa analisi non si
+    sovrascrivono a vicenda e vince l'ultima a terminare. Una voce che supera da sola
+    la dimensione massima della cache verrebbe eliminata subito: la scrittura
+    viene abbandonata appena il file la supera.
+    """
+    def __init__(self, cache, path, watermark, max_bytes):
+        self._cache = cache
+        self._path = path
+        self._max_bytes = max_bytes
+        fd, self._tmp_path = tempfile.mkstemp(
+            prefix=os.path.basename(path) + '.', suffix='.tmp', dir=os.path.dirname(path)
+        )
+        self._raw = os.fdopen(fd, 'wb')
+        self._text = io.TextIOWrapper(gzip.GzipFile(fileobj=self._raw, mode='wb'), encoding='utf-8')
+        self._text.write(json.dumps({'watermark': watermark}, separators=(',', ':')) + '\n')
+        self.skipped = False
+
+    def write(self, text):
+        if self.skipped:
+            return
+        self._text.write(text)
+        if self._raw.tell() > self._max_bytes:
+            self.discard()
+            self.skipped = True
+            metrics.inc('analysis_cache_skipped')
+
+    def commit(self):
+        if self.skipped:
+            return
+        self._text.close()
+        self._raw.close()
+        os.replace(self._tmp_path, self._path)
+        self._cache._evict()
+
+    def discard(self):
+        if self.skipped:
+            return
+        self._text.close()
+        self._raw.close()
+        os.remove(self._tmp_path)
+
+class _Recorder:
+    """Sostituto di print che inoltra il testo a out e lo scrive nella nuova voce della cache."""
+    def __init__(self, out, writer):
+        self._out = out
+        self._writer = writer
+
+    def __call__(self, *values, sep=' ', end='\n', **kwargs):
+        text = sep.join(str(value) for value in values) + end
+        self._writer.write(text)
+        self._out(text, end='')
+
+def cached(cache, name, function, parameters, watermark):
+    """
+    Avvolge la funzione di un'analisi (che accetta out e heights) con la cache.
+    watermark è {'first_height', 'high_water_mark', 'blocks'} dei blocchi completati.
+    Con lo stesso watermark il testo salvato viene ristampato senza query; se
+    sono stati aggiunti solo blocchi oltre l'high-water mark, le analisi in
+    INCREMENTAL_ANALYSES vengono eseguite sui soli nuovi blocchi.
+    """
+    def run(out=print):
+        key = cache.key(name, parameters)
+        stored_watermark = cache.watermark(key)
+        if stored_watermark == watermark and cache.replay(key, out):
+            metrics.inc('analysis_cache_hits')
+            return
+
+        writer = cache.writer(key, watermark)
+        recorder = _Recorder(out, writer)
+        try:
+            # Il testo già salvato viene copiato nella nuova voce mentre viene ristampato
+            if (stored_watermark is not None and name in INCREMENTAL_ANALYSES
+                    and _is_append(stored_watermark, watermark) and cache.replay(key, recorder)):
+                metrics.inc('analysis_cache_partial_hits')
+                heights = list(range(stored_watermark['high_water_mark'] + 1, watermark['high_water_mark'] + 1))
+                recorder(f"\n[Cache] Risultati dei blocchi {heights[0]}-{heights[-1]}, aggiunti dopo l'ultima esecuzione:")
+                function(out=recorder, heights=heights)
+            else:
+                metrics.inc('analysis_cache_misses')
+                function(out=recorder)
+        except BaseException:
+            writer.discard()
+            raise
+        writer.commit()
+
+    return run
+
+def _is_contiguous(watermark):
+    return watermark['blocks'] == watermark['high_water_mark'] - watermark['first_height'] + 1
+
+def _is_append(old, new):
+    """
+    True se tra i due watermark sono stati completati solo blocchi oltre il
+    vecchio high-water mark (entrambi gli intervalli senza buchi).
+    """
+    return (
+        old['first_height'] == new['first_height']
+        and new['high_water_mark'] > old['high_water_mark']
+        and _is_contiguous(old) and _is_contiguous(new)
+    )
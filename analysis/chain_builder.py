@@ -0,0 +1,109 @@
+"""
+Ricostruzione in memoria delle peeling chain a partire dagli anelli trovati
+dalle query, in un solo passaggio lineare. Gli anelli sono identificati dagli
+id compatti interi (tid) e la relazione successore è tenuta in array NumPy,
+non in dizionari di txid.
+"""
+from array import array
+
+import numpy as np
+
+from .queries import get_txids_by_tid_query
+
+def build_successor_map(links_data):
+    """
+    Costruisce la relazione successore dai record (tid, change_value,
+    next_spenders), letti una sola volta (anche da un iteratore). Per ogni
+    anello si sceglie tra le spese successive dell'indirizzo di resto quella
+    che spende il resto (relazione SENT di valore change_value) e, a parità,
+    la prima per altezza, vin e tid: con un indirizzo riutilizzato le spese di
+    altri output dello stesso indirizzo non diventano successori. Il
+    successore scelto deve essere anch'esso un anello.
+    Restituisce (tids, successors): i tid degli anelli in ordine crescente e,
+    per ciascuno, la posizione del successore in tids (-1 se assente).
+    """
+    link_tids = array('q')
+    spender_links, spender_tids, spender_heights = array('q'), array('q'), array('q')
+    spender_mismatch, spender_vins = array('b'), array('q')
+    for record in links_data:
+        change_value = record['change_value']
+        for spender in record['next_spenders']:
+            spender_links.append(len(link_tids))
+            spender_tids.append(spender['tid'])
+            spender_heights.append(-1 if spender['block_height'] is None else spender['block_height'])
+            spender_mismatch.append(spender['value'] != change_value)
+            spender_vins.append(-1 if spender['vin'] is None else spender['vin'])
+        link_tids.append(record['tid'])
+
+    records = np.frombuffer(link_tids, dtype=np.int64)
+    # Un solo record per anello: a parità di tid vale l'ultimo letto
+    tids, last_reversed = np.unique(records[::-1], return_index=True)
+    kept_records = len(records) - 1 - last_reversed
+    record_position = np.full(len(records), -1, dtype=np.int64)
+    record_position[kept_records] = np.arange(len(tids))
+
+    links = record_position[np.frombuffer(spender_links, dtype=np.int64)]
+    valid = links >= 0
+    links = links[valid]
+    candidates = np.frombuffer(spender_tids, dtype=np.int64)[valid]
+    heights = np.frombuffer(spender_heights, dtype=np.int64)[valid]
+    mismatch = np.frombuffer(spender_mismatch, dtype=np.int8)[valid]
+    vins = np.frombuffer(spender_vins, dtype=np.int64)[valid]
+
+    # Spesa scelta per ogni anello: la prima nell'ordine (resto, altezza, vin, tid)
+    order = np.lexsort((candidates, vins, heights, mismatch, links))
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = links[order][1:] != links[order][:-1]
+    chosen_links, chosen = links[order][first], candidates[order][first]
+
+    # Il successore è la spesa scelta, se è anch'essa un anello
+    positions = np.searchsorted(tids, chosen)
+    found = positions < len(tids)
+    found[found] &= tids[positions[found]] == chosen[found]
+    successors = np.full(len(tids), -1, dtype=np.int64)
+    successors[chosen_links[found]] = positions[found]
+    return tids, successors
+
+def reconstruct_chains(tids, successors, min_chain_length):
+    """
+    Ricostruisce le catene seguendo la relazione successore. Le teste sono gli
+    anelli con grado entrante zero; gli anelli rimasti non visitati
+    appartengono a cicli, che vengono spezzati nel tid minore. Ogni anello
+    compare in una sola catena. Restituisce le catene (liste di tid) lunghe
+    almeno min_chain_length, dalla più lunga.
+    """
+    in_degree = np.bincount(successors[successors >= 0], minlength=len(tids))
+    next_position = array('q', successors.tobytes())
+    visited = bytearray(len(tids))
+
+    def walk(start):
+        chain = []
+        current = start
+        while current >= 0 and not visited[current]:
+            visited[current] = 1
+            chain.append(current)
+            current = next_position[current]
+        return chain
+
+    chains = [walk(position) for position in np.flatnonzero(in_degree == 0).tolist()]
+    chains += [walk(position) for position in range(len(tids)) if not visited[position]]
+
+    found_chains = [tids[chain].tolist() for chain in chains if len(chain) >= min_chain_length]
+    found_chains.sort(key=len, reverse=True)
+    return found_chains
+
+def resolve_txids(neo4j_conn, chains, graph=None, batch_size=10000):
+    """
+    Restituisce {tid: txid} per gli anelli delle catene trovate, leggendo i
+    txid da Neo4j a gruppi di batch_size oppure dal MemoryGraph.
+    """
+    tids = sorted({tid for chain in chains for tid in chain})
+    if graph is not None:
+        return graph.txids_by_tid(tids)
+    txids = {}
+    for start in range(0, len(tids), batch_size):
+        records = neo4j_conn.execute_query(
+            get_txids_by_tid_query(), parameters={'tids': tids[start:start + batch_size]}
+        )
+        txids.update((record['tid'], record['txid']) for record in records)
+    return txids
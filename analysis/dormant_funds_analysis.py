@@ -1,23 +1,119 @@
-from .queries import get_dormant_funds_query
+from .queries import (
+    DORMANCY_BANDS_YEARS,
+    get_dormant_funds_query,
+    get_dormant_funds_rollup_query,
+    get_dormancy_summary_query,
+    get_blocks_without_rollups_query
+)
+from .windows import height_parameters, merge_windows, window_span
 
-def run(neo4j_conn,min_age_years=5):
+def _dormant_order(record):
+    """Chiave dell'ORDER BY delle query sui fondi dormienti, per la fusione delle finestre."""
+    return -record['days_dormant'], record['txid'], record['from_address'], -record['value']
+
+def _missing_rollups(neo4j_conn, heights, window):
+    """Numero di blocchi completati (in heights o nella finestra window) ancora privi delle rollup."""
+    records = neo4j_conn.execute_query(
+        get_blocks_without_rollups_query(incremental=heights is not None, windowed=window is not None),
+        parameters=height_parameters(heights, window)
+    )
+    return records[0]['blocks'] if records else 0
+
+def _print_summary(neo4j_conn, graph, min_age_years, min_age_days, heights, window, out):
+    """
+    Stampa i totali delle rollup per blocco (dei blocchi in heights o nella
+    finestra window) e restituisce il numero di blocchi con spese oltre la
+    soglia (None se nessun blocco ha le rollup). Con graph i totali vengono
+    calcolati in memoria (MemoryGraph.dormancy_summary).
+    """
+    if graph is not None:
+        summary = graph.dormancy_summary(min_age_days=min_age_days, heights=heights, window=window)
+    else:
+        records = neo4j_conn.execute_query(
+            get_dormancy_summary_query(incremental=heights is not None, windowed=window is not None),
+            parameters={'min_age_days': min_age_days, **height_parameters(heights, window)}
+        )
+        summary = records[0] if records else None
+    if summary is None or not summary['blocks']:
+        out("  > Nessun blocco con rollup di dormienza: eseguire --action migrate.")
+        return None
+
+    out(f"  Rollup su {summary['blocks']} blocchi: {summary['cdd']:.0f} coin-days destroyed.")
+    for years in DORMANCY_BANDS_YEARS:
+        out(f"    - Speso dopo almeno {years} anni: {summary[f'spent_over_{years}y']:.4f} BTC")
+    out(f"  Blocchi con spese oltre {min_age_years} anni: {summary['matching_blocks']}.")
+    return summary['matching_blocks']
+
+def run(neo4j_conn,min_age_years=5, heights=None, out=print, graph=None, use_rollups=True, sink=None,
+        windows=None, window_workers=1):
     """
     Esegue l'analisi per identificare il movimento di fondi dormienti.
+    Se heights è indicato, analizza solo le transazioni di quei blocchi;
+    altrimenti, con windows (vedi analysis.windows), quelle delle finestre,
+    lette window_workers alla volta e fuse: i movimenti restano ordinati per
+    giorni di inattività sull'intero intervallo.
+    I record vengono letti in streaming, quindi la memoria resta costante
+    anche con milioni di movimenti.
+    Il testo prodotto viene scritto tramite out (print per default).
+    Con graph (analysis.memory_graph.MemoryGraph) l'analisi viene eseguita in
+    memoria, con lo stesso output.
+    Con use_rollups i totali vengono letti dalle rollup dei nodi Block e le
+    relazioni SENT vengono esaminate solo nei blocchi con spese oltre la soglia;
+    se alcuni blocchi non hanno ancora le rollup (grafo migrato solo in parte)
+    viene usata la query completa, per non perdere i loro movimenti.
+    Con sink (analysis.sinks.ResultSink) i movimenti vengono scritti nella
+    tabella movements invece che stampati.
     """
-    print("\n[Analisi] Ricerca Movimento di Fondi Dormienti...")
+    out("\n[Analisi] Ricerca Movimento di Fondi Dormienti...")
 
     min_age_days = min_age_years * 365
-    
-    dormant_query = get_dormant_funds_query()
-    records = neo4j_conn.execute_query(
-        dormant_query,
-        parameters={'min_age_days': min_age_days}
-    )
+    windowed = heights is None and windows is not None
+    window = window_span(windows) if windowed else None
 
-    if not records:
-        print(f"  > Nessun movimento di fondi dormienti (oltre {min_age_years} anni) trovato.")
+    if use_rollups and graph is None:
+        missing = _missing_rollups(neo4j_conn, heights, window)
+        if missing:
+            out(f"  > {missing} blocchi senza rollup di dormienza (eseguire --action migrate): "
+                "uso della query completa.")
+            use_rollups = False
+    if use_rollups and not _print_summary(neo4j_conn, graph, min_age_years, min_age_days, heights, window, out):
+        out(f"  > Nessun movimento di fondi dormienti (oltre {min_age_years} anni) trovato.")
+        return
+    if graph is not None:
+        records = graph.dormant_funds(min_age_days=min_age_days, heights=heights, window=window)
     else:
-        print(f"  > Trovati movimenti sospetti di fondi dormienti (oltre {min_age_years} anni):")
-        for record in records:
-            print(f"    - TXID: {record['txid']} ha speso {record['value']:.4f} BTC "
-                  f"dall'indirizzo {record['from_address']} dopo {record['days_dormant']:.0f} giorni.")
\ No newline at end of file
+        if use_rollups:
+            dormant_query = get_dormant_funds_rollup_query(incremental=heights is not None, windowed=windowed)
+        else:
+            dormant_query = get_dormant_funds_query(incremental=heights is not None, windowed=windowed)
+        if windowed:
+            records = merge_windows(
+                lambda window: neo4j_conn.stream_query(
+                    dormant_query, parameters={'min_age_days': min_age_days, **height_parameters(window=window)}
+                ),
+                windows, key=_dormant_order, max_workers=window_workers
+            )
+        else:
+            records = neo4j_conn.stream_query(
+                dormant_query,
+                parameters={'min_age_days': min_age_days, 'heights': heights}
+            )
+
+    found = 0
+    for record in records:
+        found += 1
+        if sink is not None:
+            sink.write('movements', {
+                'txid': record['txid'], 'value': float(record['value']),
+                'from_address': record['from_address'], 'days_dormant': float(record['days_dormant'])
+            })
+            continue
+        if found == 1:
+            out(f"  > Trovati movimenti sospetti di fondi dormienti (oltre {min_age_years} anni):")
+        out(f"    - TXID: {record['txid']} ha speso {record['value']:.4f} BTC "
+            f"dall'indirizzo {record['from_address']} dopo {record['days_dormant']:.0f} giorni.")
+
+    if not found:
+        out(f"  > Nessun movimento di fondi dormienti (oltre {min_age_years} anni) trovato.")
+    elif sink is not None:
+        out(f"  > Trovati {found} movimenti sospetti di fondi dormienti (oltre {min_age_years} anni).")
\ No newline at end of file
@@ -0,0 +1,89 @@
+"""
+Esecuzione concorrente delle analisi. Le analisi sono letture indipendenti:
+vengono eseguite in un pool di thread che condividono il driver (e quindi il
+pool di connessioni) del Neo4jConnector, ognuna con le proprie sessioni.
+"""
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+
+class BufferedOutput:
+    """
+    Sostituto di print per un'analisi eseguita in parallelo: il testo viene
+    raccolto a parte (in memoria fino a max_memory byte, poi su file
+    temporaneo) finché non è il turno dell'analisi, così l'output delle
+    analisi concorrenti non si mescola. Dopo replay il testo successivo viene
+    stampato subito, così i risultati parziali compaiono man mano.
+    """
+    def __init__(self, max_memory=1 << 20):
+        self._buffer = tempfile.SpooledTemporaryFile(max_size=max_memory, mode='w+')
+        self._lock = threading.Lock()
+        self._stream = None
+
+    def __call__(self, *values, sep=' ', end='\n', **kwargs):
+        text = sep.join(str(value) for value in values) + end
+        with self._lock:
+            if self._stream is not None:
+                self._stream.write(text)
+            else:
+                self._buffer.write(text)
+
+    def replay(self, stream=None):
+        stream = stream or sys.stdout
+        with self._lock:
+            self._buffer.seek(0)
+            for line in self._buffer:
+                stream.write(line)
+            stream.flush()
+            self._stream = stream
+
+    def close(self):
+        self._buffer.close()
+
+def _run_task(name, function, out):
+    started = time.monotonic()
+    try:
+        function(out=out)
+        error = None
+    except Exception as e:
+        metrics.inc(f"analysis_{name}_errors")
+        error = e
+    elapsed = time.monotonic() - started
+    metrics.observe(f"analysis_{name}", elapsed)
+    return {'elapsed': elapsed, 'error': error}
+
+def run_analyses(tasks, max_workers=4):
+    """
+    Esegue le analisi [(nome, funzione)] con al più max_workers thread. Ogni
+    funzione riceve l'argomento out da usare al posto di print. L'output viene
+    stampato nell'ordine di tasks: quello di ciascuna analisi appena le
+    precedenti sono terminate e, da quel momento, man mano che viene prodotto.
+    Restituisce {nome: {'elapsed': secondi, 'error': eccezione o None}}.
+    """
+    results = {}
+    started = time.monotonic()
+    if max_workers <= 1 or len(tasks) <= 1:
+        for name, function in tasks:
+            results[name] = _run_task(name, function, print)
+    else:
+        with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='analysis') as executor:
+            submitted = []
+            for name, function in tasks:
+                out = BufferedOutput()
+                submitted.append((name, out, executor.submit(_run_task, name, function, out)))
+            for name, out, future in submitted:
+                out.replay()
+                results[name] = future.result()
+                out.close()
+
+    elapsed = time.monotonic() - started
+    print("\n--- Tempi delle analisi ---")
+    for name, result in results.items():
+        status = f"errore: {result['error']}" if result['error'] else "ok"
+        print(f"  {name}: {result['elapsed']:.1f}s ({status})")
+    print(f"  Totale: {elapsed:.1f}s con {max(1, min(max_workers, len(tasks)))} analisi in parallelo")
+    return results
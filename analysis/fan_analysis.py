@@ -1,27 +1,72 @@
-from .queries import get_fan_out_query, get_fan_in_query
+from .queries import get_fan_out_query, get_fan_in_query, get_fan_out_feature_query, get_fan_in_feature_query
+from .windows import height_parameters, stream_windows, window_span
 
-def run(neo4j_conn):
+def _fetch(neo4j_conn, builder, parameters, heights, windows, window_workers, page_size):
     """
-    Esegue l'analisi per identificare i pattern Fan-In e Fan-Out.
+    Restituisce i record come iteratore: sull'intero grafo a pagine keyset
+    ordinate per tid (id compatto), sui soli blocchi in heights in un'unica
+    query, sulle finestre con una query per finestra.
     """
-    print("\n[Analisi] Ricerca Pattern Fan-Out (potenziale Smurfing)...")
-    fan_out_query = get_fan_out_query()
-    records = neo4j_conn.execute_query(fan_out_query, parameters={'max_inputs': 2, 'min_outputs': 10})
+    if heights is not None:
+        return neo4j_conn.stream_query(builder(incremental=True), parameters={**parameters, 'heights': heights})
+    if windows is not None:
+        query = builder(windowed=True)
+        return stream_windows(
+            lambda window: neo4j_conn.stream_query(
+                query, parameters={**parameters, **height_parameters(window=window)}
+            ),
+            windows, window_workers
+        )
+    return neo4j_conn.paginate_query(builder(paged=True), parameters=parameters, key='tid', page_size=page_size)
 
-    if not records:
-        print("  > Nessuna transazione con pattern Fan-Out trovata.")
-    else:
-        print("  > Trovate transazioni sospette:")
-        for record in records:
-            print(f"    - TXID: {record['txid']} (Inputs: {record['inputs']}, Outputs: {record['outputs']})")
+def _print_records(records, not_found_message, out, sink=None, table=None):
+    """
+    Stampa i record man mano che arrivano, senza tenerli in memoria. Con sink
+    i record vengono scritti nella tabella indicata e si stampa solo il totale.
+    """
+    found = 0
+    for record in records:
+        found += 1
+        if sink is not None:
+            sink.write(table, {'txid': record['txid'], 'inputs': int(record['inputs']),
+                               'outputs': int(record['outputs'])})
+            continue
+        if found == 1:
+            out("  > Trovate transazioni sospette:")
+        out(f"    - TXID: {record['txid']} (Inputs: {record['inputs']}, Outputs: {record['outputs']})")
+    if not found:
+        out(not_found_message)
+    elif sink is not None:
+        out(f"  > Trovate {found} transazioni sospette.")
 
-    print("\n[Analisi] Ricerca Pattern Fan-In (potenziale Consolidamento)...")
-    fan_in_query = get_fan_in_query()
-    records = neo4j_conn.execute_query(fan_in_query, parameters={'min_inputs': 10, 'max_outputs': 2})
+def run(neo4j_conn, heights=None, use_features=True, page_size=10000, out=print, graph=None, sink=None,
+        windows=None, window_workers=1):
+    """
+    Esegue l'analisi per identificare i pattern Fan-In e Fan-Out.
+    Se heights è indicato, analizza solo le transazioni di quei blocchi;
+    altrimenti, con windows (intervalli (da, a) di altezze, vedi
+    analysis.windows), quelle delle finestre, lette window_workers alla volta.
+    Con use_features usa i conteggi n_inputs/n_outputs salvati in fase di ingest.
+    Il testo prodotto viene scritto tramite out (print per default).
+    Con graph (analysis.memory_graph.MemoryGraph) l'analisi viene eseguita in memoria.
+    Con sink (analysis.sinks.ResultSink) le transazioni vengono scritte nelle
+    tabelle fan_out e fan_in invece che stampate.
+    """
+    window = window_span(windows) if windows else None
+    out("\n[Analisi] Ricerca Pattern Fan-Out (potenziale Smurfing)...")
+    if graph is not None:
+        records = graph.fan_out(min_outputs=10, max_inputs=2, heights=heights, window=window)
+    else:
+        fan_out_builder = get_fan_out_feature_query if use_features else get_fan_out_query
+        records = _fetch(neo4j_conn, fan_out_builder, {'max_inputs': 2, 'min_outputs': 10}, heights, windows,
+                         window_workers, page_size)
+    _print_records(records, "  > Nessuna transazione con pattern Fan-Out trovata.", out, sink, 'fan_out')
 
-    if not records:
-        print("  > Nessuna transazione con pattern Fan-In trovata.")
+    out("\n[Analisi] Ricerca Pattern Fan-In (potenziale Consolidamento)...")
+    if graph is not None:
+        records = graph.fan_in(min_inputs=10, max_outputs=2, heights=heights, window=window)
     else:
-        print("  > Trovate transazioni sospette:")
-        for record in records:
-            print(f"    - TXID: {record['txid']} (Inputs: {record['inputs']}, Outputs: {record['outputs']})")
\ No newline at end of file
+        fan_in_builder = get_fan_in_feature_query if use_features else get_fan_in_query
+        records = _fetch(neo4j_conn, fan_in_builder, {'min_inputs': 10, 'max_outputs': 2}, heights, windows,
+                         window_workers, page_size)
+    _print_records(records, "  > Nessuna transazione con pattern Fan-In trovata.", out, sink, 'fan_in')
@@ -0,0 +1,387 @@
+"""
+Backend di analisi in memoria: Transaction, Address e relazioni SENT/RECEIVED
+caricati in array NumPy con indici interi in formato CSR, per eseguire le
+analisi senza interrogare Neo4j. Le funzioni restituiscono record con le
+stesse colonne delle query Cypher corrispondenti, così i moduli di analisi
+li consumano allo stesso modo.
+"""
+from array import array
+
+import numpy as np
+
+from etl.identifiers import compact_id
+from .queries import (
+    DORMANCY_BANDS_YEARS,
+    get_memory_transactions_query,
+    get_memory_received_query,
+    get_memory_sent_query
+)
+
+def _csr(keys, size):
+    """Puntatori CSR per archi già ordinati per chiave: archi di k in [ptr[k], ptr[k + 1])."""
+    return np.concatenate(([0], np.cumsum(np.bincount(keys, minlength=size)))).astype(np.int64)
+
+def _dedup_last(columns, key_columns):
+    """
+    Ordina gli archi per le colonne chiave e ne tiene uno per chiave (l'ultimo
+    inserito), come il MERGE dell'ETL che aggiorna le proprietà esistenti.
+    """
+    insertion = np.arange(len(columns[0]))
+    order = np.lexsort([insertion] + [columns[i] for i in reversed(key_columns)])
+    sorted_columns = [column[order] for column in columns]
+    keep = np.ones(len(order), dtype=bool)
+    if len(order):
+        same_as_next = np.ones(len(order) - 1, dtype=bool)
+        for i in key_columns:
+            same_as_next &= sorted_columns[i][1:] == sorted_columns[i][:-1]
+        keep[:-1] = ~same_as_next
+    return [column[keep] for column in sorted_columns]
+
+class MemoryGraphBuilder:
+    """
+    Accumula transazioni e relazioni, dall'ETL (add_block_rows) o da Neo4j
+    (load_from_neo4j), in array compatti. build() crea il MemoryGraph.
+    """
+    def __init__(self):
+        self.tx_index = {}
+        self.txids = []
+        self.tx_heights = array('q')
+        self.address_index = {}
+        self.addresses = []
+        self.received = (array('q'), array('q'), array('d'), array('q'))              # tx, indirizzo, valore, vout
+        self.sent = (array('q'), array('q'), array('d'), array('d'), array('q'))      # indirizzo, tx, valore, età, vin
+
+    def _tx(self, txid, block_height=None):
+        tx_id = self.tx_index.get(txid)
+        if tx_id is None:
+            tx_id = len(self.txids)
+            self.tx_index[txid] = tx_id
+            self.txids.append(txid)
+            self.tx_heights.append(-1 if block_height is None else block_height)
+        elif block_height is not None:
+            self.tx_heights[tx_id] = block_height
+        return tx_id
+
+    def _address(self, address):
+        address_id = self.address_index.get(address)
+        if address_id is None:
+            address_id = len(self.addresses)
+            self.address_index[address] = address_id
+            self.addresses.append(address)
+        return address_id
+
+    def add_transaction(self, txid, block_height):
+        self._tx(txid, block_height)
+
+    def add_received(self, txid, address, value, vout=None):
+        # Relazioni caricate prima dell'indice vout: -1
+        vout = -1 if vout is None else vout
+        for column, item in zip(self.received, (self._tx(txid), self._address(address), value, vout)):
+            column.append(item)
+
+    def add_sent(self, address, txid, value, age_days, vin=None):
+        age_days = float('nan') if age_days is None else age_days
+        vin = -1 if vin is None else vin
+        for column, item in zip(self.sent, (self._address(address), self._tx(txid), value, age_days, vin)):
+            column.append(item)
+
+    def add_block_rows(self, rows):
+        """Aggiunge le righe di un blocco prodotte da etl.parser.build_block_rows."""
+        block_height = rows['block']['block_height']
+        for tx in rows['transactions']:
+            self.add_transaction(tx['tx_id'], block_height)
+            for output in tx['outputs']:
+                self.add_received(output['tx_id'], output['addr'], output['val'], output['vout'])
+            for input_row in tx['inputs']:
+                self.add_sent(input_row['addr'], input_row['tx_id'], input_row['val'], input_row['age'],
+                              input_row['vin'])
+
+    def build(self):
+        n_tx, n_addresses = len(self.txids), len(self.addresses)
+        # Chiave delle relazioni come nel MERGE dell'ETL: estremi e indice vout/vin
+        # (il valore è una proprietà aggiornata, non parte della chiave)
+        recv_tx, recv_addr, recv_val, _ = _dedup_last(
+            [np.frombuffer(column, dtype=dtype) for column, dtype in zip(self.received, ('i8', 'i8', 'f8', 'i8'))],
+            key_columns=[0, 1, 3]
+        )
+        sent_addr, sent_tx, sent_val, sent_age, sent_vin = _dedup_last(
+            [np.frombuffer(column, dtype=dtype)
+             for column, dtype in zip(self.sent, ('i8', 'i8', 'f8', 'f8', 'i8'))],
+            key_columns=[0, 1, 4]
+        )
+        # Gli archi SENT sono ordinati per indirizzo (CSR delle spese di ogni
+        # indirizzo); la vista per transazione usa una permutazione stabile.
+        by_tx = np.argsort(sent_tx, kind='stable')
+        return MemoryGraph(
+            txids=np.array(self.txids, dtype=object),
+            tids=np.fromiter((compact_id(txid) for txid in self.txids), dtype=np.int64, count=n_tx),
+            tx_heights=np.frombuffer(self.tx_heights, dtype='i8').copy(),
+            addresses=np.array(self.addresses, dtype=object),
+            out_ptr=_csr(recv_tx, n_tx), out_addr=recv_addr, out_val=recv_val,
+            in_ptr=_csr(sent_tx[by_tx], n_tx), in_addr=sent_addr[by_tx],
+            in_val=sent_val[by_tx], in_age=sent_age[by_tx],
+            spend_ptr=_csr(sent_addr, n_addresses), spend_tx=sent_tx, spend_val=sent_val, spend_vin=sent_vin
+        )
+
+class MemoryGraph:
+    """
+    Grafo in formato CSR. Per la transazione i gli output sono
+    out_addr/out_val[out_ptr[i]:out_ptr[i + 1]] e gli input
+    in_addr/in_val/in_age[in_ptr[i]:in_ptr[i + 1]]; per l'indirizzo j le
+    transazioni che lo spendono sono spend_tx[spend_ptr[j]:spend_ptr[j + 1]],
+    con valore e vin delle relazioni SENT in spend_val/spend_vin.
+    tids contiene l'id compatto (etl.identifiers.compact_id) di ogni transazione.
+    """
+    def __init__(self, txids, tids, tx_heights, addresses, out_ptr, out_addr, out_val,
+                 in_ptr, in_addr, in_val, in_age, spend_ptr, spend_tx, spend_val, spend_vin):
+        self.txids = txids
+        self.tids = tids
+        self.tx_heights = tx_heights
+        self.addresses = addresses
+        self.out_ptr, self.out_addr, self.out_val = out_ptr, out_addr, out_val
+        self.in_ptr, self.in_addr, self.in_val, self.in_age = in_ptr, in_addr, in_val, in_age
+        self.spend_ptr, self.spend_tx, self.spend_val, self.spend_vin = spend_ptr, spend_tx, spend_val, spend_vin
+        self.n_inputs = np.diff(in_ptr)
+        self.n_outputs = np.diff(out_ptr)
+        self.in_tx = np.repeat(np.arange(len(txids)), self.n_inputs)
+        # Posizione di ogni txid/indirizzo nell'ordine lessicografico, per
+        # ordinare i risultati come le query Cypher
+        self.tx_rank = np.argsort(np.argsort(txids, kind='stable'), kind='stable')
+        self.tid_order = np.argsort(tids, kind='stable')
+        self.address_rank = np.argsort(np.argsort(addresses, kind='stable'), kind='stable')
+
+    def __len__(self):
+        return len(self.txids)
+
+    def _height_mask(self, heights, window=None):
+        """Transazioni dei blocchi in heights oppure, se heights è None, nella finestra (da, a)."""
+        if heights is not None:
+            return np.isin(self.tx_heights, np.asarray(list(heights), dtype=np.int64))
+        if window is not None:
+            return (self.tx_heights >= window[0]) & (self.tx_heights <= window[1])
+        return np.ones(len(self.txids), dtype=bool)
+
+    def _by_tid(self, tx_ids):
+        """Ordina gli indici per tid, come le varianti paginate delle query."""
+        return tx_ids[np.argsort(self.tids[tx_ids], kind='stable')]
+
+    def _tx_ids_by_tid(self, tids):
+        """Indici delle transazioni con i tid indicati (i tid assenti dal grafo vengono ignorati)."""
+        tids = np.asarray(tids, dtype=np.int64)
+        sorted_tids = self.tids[self.tid_order]
+        positions = np.searchsorted(sorted_tids, tids)
+        found = positions < len(sorted_tids)
+        found[found] &= sorted_tids[positions[found]] == tids[found]
+        return self.tid_order[positions[found]]
+
+    def txids_by_tid(self, tids):
+        """Restituisce {tid: txid} per i tid indicati presenti nel grafo."""
+        return {int(self.tids[tx_id]): self.txids[tx_id] for tx_id in self._tx_ids_by_tid(tids)}
+
+    def _fan_records(self, mask):
+        for tx_id in self._by_tid(np.flatnonzero(mask)):
+            yield {'txid': self.txids[tx_id], 'inputs': int(self.n_inputs[tx_id]),
+                   'outputs': int(self.n_outputs[tx_id])}
+
+    def fan_out(self, min_outputs=10, max_inputs=2, heights=None, window=None):
+        """Come get_fan_out_query."""
+        mask = self._height_mask(heights, window) & (self.n_inputs <= max_inputs) & (self.n_outputs >= min_outputs)
+        return self._fan_records(mask)
+
+    def fan_in(self, min_inputs=10, max_outputs=2, heights=None, window=None):
+        """Come get_fan_in_query."""
+        mask = self._height_mask(heights, window) & (self.n_inputs >= min_inputs) & (self.n_outputs <= max_outputs)
+        return self._fan_records(mask)
+
+    def dormancy_summary(self, min_age_days=365, heights=None, window=None):
+        """
+        Come get_dormancy_summary_query, calcolando le rollup di ogni blocco
+        dagli input come il parser (_block_dormancy_rollup).
+        """
+        mask = self._height_mask(heights, window)
+        block_heights = np.unique(self.tx_heights[mask])
+        edges = np.flatnonzero(mask[self.in_tx])
+        block_of_edge = np.searchsorted(block_heights, self.tx_heights[self.in_tx[edges]])
+        values, ages = self.in_val[edges], self.in_age[edges]
+        max_age = np.zeros(len(block_heights))
+        np.maximum.at(max_age, block_of_edge, ages)
+        summary = {
+            'blocks': len(block_heights),
+            'cdd': float((values * ages).sum()),
+            'matching_blocks': int((max_age >= min_age_days).sum())
+        }
+        for years in DORMANCY_BANDS_YEARS:
+            summary[f'spent_over_{years}y'] = float(values[ages >= years * 365].sum())
+        return summary
+
+    def dormant_funds(self, min_age_days=365, heights=None, window=None):
+        """Come get_dormant_funds_query, con lo stesso ordinamento: giorni, txid, indirizzo e valore."""
+        edges = np.flatnonzero((self.in_age >= min_age_days) & self._height_mask(heights, window)[self.in_tx])
+        edges = edges[np.lexsort((
+            -self.in_val[edges], self.address_rank[self.in_addr[edges]], self.tx_rank[self.in_tx[edges]],
+            -self.in_age[edges]
+        ))]
+        for edge in edges:
+            yield {'txid': self.txids[self.in_tx[edge]], 'from_address': self.addresses[self.in_addr[edge]],
+                   'value': float(self.in_val[edge]), 'days_dormant': float(self.in_age[edge])}
+
+    def _links_with_successors(self, tx_ids, change_addresses, change_values):
+        """
+        Record (tid, change_address, change_value, next_spenders) come nelle
+        query sugli anelli: solo le spese nello stesso blocco o successive.
+        """
+        for tx_id, address_id, change_value in zip(tx_ids, change_addresses, change_values):
+            next_spenders = []
+            for edge in range(self.spend_ptr[address_id], self.spend_ptr[address_id + 1]):
+                next_id = self.spend_tx[edge]
+                if next_id != tx_id and self.tx_heights[next_id] >= self.tx_heights[tx_id]:
+                    next_spenders.append({
+                        'tid': int(self.tids[next_id]), 'block_height': int(self.tx_heights[next_id]),
+                        'value': float(self.spend_val[edge]), 'vin': int(self.spend_vin[edge])
+                    })
+            yield {
+                'tid': int(self.tids[tx_id]),
+                'change_address': self.addresses[address_id],
+                'change_value': float(change_value),
+                'next_spenders': next_spenders
+            }
+
+    def _two_outputs(self, tx_ids):
+        first = self.out_ptr[tx_ids]
+        return self.out_addr[first], self.out_val[first], self.out_addr[first + 1], self.out_val[first + 1]
+
+    def peel_links(self, peel_ratio=0.2, min_input_value=0.01, heights=None, window=None):
+        """Come get_peel_links_with_successors_query."""
+        total_in = np.bincount(self.in_tx, weights=self.in_val, minlength=len(self.txids))
+        tx_ids = np.flatnonzero(
+            self._height_mask(heights, window) & (self.n_outputs == 2) & (self.n_inputs <= 2)
+            & (total_in >= min_input_value)
+        )
+        a1, v1, a2, v2 = self._two_outputs(tx_ids)
+        threshold = total_in[tx_ids] * peel_ratio
+        keep = ((v1 + v2) <= total_in[tx_ids]) & (
+            ((v1 < threshold) & (v2 > threshold)) | ((v2 < threshold) & (v1 > threshold))
+        )
+        change, change_value = np.where(v1 > v2, a1, a2), np.where(v1 > v2, v1, v2)
+        return self._links_with_successors(tx_ids[keep], change[keep], change_value[keep])
+
+    def self_change_links(self, heights=None, window=None):
+        """Come get_self_change_peel_link_query."""
+        tx_ids = np.flatnonzero(self._height_mask(heights, window) & (self.n_inputs == 1) & (self.n_outputs == 2))
+        in_addr = self.in_addr[self.in_ptr[tx_ids]]
+        a1, v1, a2, v2 = self._two_outputs(tx_ids)
+        keep = ((a1 == in_addr) | (a2 == in_addr)) & (a1 != a2)
+        change_value = np.where(a1 == in_addr, v1, v2)
+        return self._links_with_successors(tx_ids[keep], in_addr[keep], change_value[keep])
+
+    def _receivers(self):
+        """
+        CSR (calcolato alla prima richiesta) delle transazioni che pagano ogni
+        indirizzo: per l'indirizzo j receive_tx/receive_val[receive_ptr[j]:receive_ptr[j + 1]].
+        """
+        if not hasattr(self, 'receive_ptr'):
+            order = np.argsort(self.out_addr, kind='stable')
+            self.receive_tx = np.repeat(np.arange(len(self.txids)), self.n_outputs)[order]
+            self.receive_val = self.out_val[order]
+            self.receive_ptr = _csr(self.out_addr[order], len(self.addresses))
+        return self.receive_ptr, self.receive_tx, self.receive_val
+
+    def _trace_records(self, from_txid, edges, max_fanout):
+        """Record degli archi (valore, transazione, indirizzo) più grandi, come _trace_edges delle query."""
+        edges.sort(key=lambda edge: (-edge[0], self.tids[edge[1]]))
+        for value, tx_id, address_id in edges[:max_fanout]:
+            yield {'from_txid': from_txid, 'address': self.addresses[address_id], 'value': float(value),
+                   'tid': int(self.tids[tx_id]), 'txid': self.txids[tx_id],
+                   'block_height': int(self.tx_heights[tx_id])}
+
+    def trace_hop(self, tids, backward=False, min_value=0.0, max_fanout=20):
+        """Come get_trace_hop_query."""
+        if backward:
+            receive_ptr, receive_tx, _ = self._receivers()
+        for tx_id in self._tx_ids_by_tid(tids):
+            height = self.tx_heights[tx_id]
+            edges = []
+            if backward:
+                for k in range(self.in_ptr[tx_id], self.in_ptr[tx_id + 1]):
+                    address_id, value = self.in_addr[k], self.in_val[k]
+                    if value >= min_value:
+                        edges.extend(
+                            (value, prev_id, address_id)
+                            for prev_id in receive_tx[receive_ptr[address_id]:receive_ptr[address_id + 1]]
+                            if prev_id != tx_id and self.tx_heights[prev_id] <= height
+                        )
+            else:
+                for k in range(self.out_ptr[tx_id], self.out_ptr[tx_id + 1]):
+                    address_id, value = self.out_addr[k], self.out_val[k]
+                    if value >= min_value:
+                        edges.extend(
+                            (value, next_id, address_id)
+                            for next_id in self.spend_tx[self.spend_ptr[address_id]:self.spend_ptr[address_id + 1]]
+                            if next_id != tx_id and self.tx_heights[next_id] >= height
+                        )
+            yield from self._trace_records(self.txids[tx_id], edges, max_fanout)
+
+    def trace_addresses(self, addresses, backward=False, min_value=0.0, max_fanout=20):
+        """Come get_trace_address_query, con gli indirizzi invece dei loro aid."""
+        if backward:
+            receive_ptr, receive_tx, receive_val = self._receivers()
+        for address_id in np.flatnonzero(np.isin(self.addresses, list(addresses))):
+            if backward:
+                start, end = receive_ptr[address_id], receive_ptr[address_id + 1]
+                edges = list(zip(receive_val[start:end], receive_tx[start:end], [address_id] * (end - start)))
+            else:
+                edges = []
+                for next_id in np.unique(self.spend_tx[self.spend_ptr[address_id]:self.spend_ptr[address_id + 1]]):
+                    inputs = slice(self.in_ptr[next_id], self.in_ptr[next_id + 1])
+                    values = self.in_val[inputs][self.in_addr[inputs] == address_id]
+                    edges.extend((value, next_id, address_id) for value in values)
+            edges = [edge for edge in edges if edge[0] >= min_value]
+            yield from self._trace_records(None, edges, max_fanout)
+
+    def common_input_clusters(self):
+        """
+        Euristica common-input-ownership: componenti connesse degli indirizzi
+        che compaiono insieme come input. Propagazione dell'etichetta minima
+        con aggancio delle radici e pointer jumping, tutto vettoriale.
+        Restituisce per ogni indirizzo l'indice del rappresentante del cluster.
+        """
+        labels = np.arange(len(self.addresses))
+        edges = self.n_inputs[self.in_tx] > 1
+        edge_tx, edge_addr = self.in_tx[edges], self.in_addr[edges]
+        while True:
+            tx_min = np.full(len(self.txids), len(self.addresses))
+            np.minimum.at(tx_min, edge_tx, labels[edge_addr])
+            new_labels = labels.copy()
+            np.minimum.at(new_labels, labels[edge_addr], tx_min[edge_tx])
+            while True:
+                jumped = new_labels[new_labels]
+                if np.array_equal(jumped, new_labels):
+                    break
+                new_labels = jumped
+            if np.array_equal(new_labels, labels):
+                return labels
+            labels = new_labels
+
+def load_from_neo4j(neo4j_connector):
+    """Carica transazioni e relazioni dal grafo Neo4j, in streaming."""
+    builder = MemoryGraphBuilder()
+    for record in neo4j_connector.stream_query(get_memory_transactions_query()):
+        builder.add_transaction(record['txid'], record['block_height'])
+    for record in neo4j_connector.stream_query(get_memory_received_query()):
+        builder.add_received(record['txid'], record['address'], record['value'], record['vout'])
+    for record in neo4j_connector.stream_query(get_memory_sent_query()):
+        builder.add_sent(record['address'], record['txid'], record['value'], record['age_days'], record['vin'])
+    return builder.build()
+
+def apply_common_input_ownership(graph):
+    """
+    Versione in memoria di etl.clustering.apply_common_input_ownership: salva
+    in graph.entity_ids il rappresentante del cluster di ogni indirizzo.
+    """
+    print("\n--- Applicazione dell'euristica 'Common-Input-Ownership' (in memoria) ---")
+    graph.entity_ids = graph.common_input_clusters()
+    sizes = np.bincount(graph.entity_ids, minlength=len(graph.addresses))
+    print(f"Euristica applicata con successo: {len(graph.addresses)} indirizzi, "
+          f"{int((sizes > 1).sum())} cluster con più indirizzi "
+          f"(il più grande ne contiene {int(sizes.max()) if len(sizes) else 0}).")
+    return graph.entity_ids
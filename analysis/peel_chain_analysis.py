@@ -1,98 +1,70 @@
-from .queries import (
-    get_peeling_chain_link_query, 
-    get_next_transaction_query
-)
+from .queries import get_peel_links_with_successors_query, get_peel_links_with_successors_feature_query
+from .chain_builder import build_successor_map, reconstruct_chains, resolve_txids
+from .windows import height_parameters, stream_windows, window_span
 
-def run(neo4j_conn):
+def run(neo4j_conn, heights=None, min_chain_length=3, use_features=True, out=print, graph=None, sink=None,
+        windows=None, window_workers=1):
     """
     Esegue l'analisi per ricostruire le Peeling Chains complete con una logica
     di collegamento più robusta.
+    Se heights è indicato, cerca gli anelli solo tra le transazioni di quei blocchi;
+    altrimenti, con windows (vedi analysis.windows), tra quelle delle finestre,
+    lette window_workers alla volta. Le catene vengono ricostruite una sola
+    volta su tutti gli anelli, quindi attraversano i confini delle finestre.
+    Con use_features gli anelli vengono cercati sulle feature salvate in fase di ingest.
+    Il testo prodotto viene scritto tramite out (print per default).
+    Con graph (analysis.memory_graph.MemoryGraph) l'analisi viene eseguita in memoria.
+    Con sink (analysis.sinks.ResultSink) le catene vengono scritte nella tabella
+    chains (una riga per anello) invece che stampate.
     """
-    print("\n[Analisi Avanzata] Ricostruzione Peeling Chains complete...")
+    out("\n[Analisi Avanzata] Ricostruzione Peeling Chains complete...")
     
-    # 1. Trova tutti i possibili anelli e i loro indirizzi di resto in un colpo solo.
-    # Modifichiamo la query get_peeling_chain_link_query per restituire anche il resto.
-    # Per non modificare queries.py, la definiamo temporaneamente qui.
-    peel_links_query_with_change = (
-        "MATCH (t:Transaction) "
-        "WHERE COUNT { (t)-[:RECEIVED]->() } = 2 AND COUNT { (t)<-[:SENT]-() } <= 2 "
-        "WITH t, REDUCE(total = 0.0, s IN [(a:Address)-[s:SENT]->(t) | s] | total + s.value) AS total_input_value "
-        "WHERE total_input_value >= 0.01 "
-        "WITH t, total_input_value, [(t)-[r:RECEIVED]->(a:Address) | {addr: a, val: r.value}] AS outputs "
-        "WITH t, total_input_value, outputs[0] AS o1, outputs[1] AS o2 "
-        "WITH t, total_input_value, o1, o2, (o1.val + o2.val) AS total_output_value "
-        "WHERE total_output_value <= total_input_value "
-        "AND ( (o1.val < total_input_value * 0.2 AND o2.val > total_input_value * 0.2) OR "
-        "      (o2.val < total_input_value * 0.2 AND o1.val > total_input_value * 0.2) ) "
-        "WITH t, CASE WHEN o1.val > o2.val THEN o1.addr.address ELSE o2.addr.address END AS change_address "
-        "RETURN t.txid AS txid, change_address"
-    )
-    
-    links_data = neo4j_conn.execute_query(peel_links_query_with_change)
-    # Creiamo un dizionario per un accesso rapido: {txid: change_address}
-    peel_links_map = {record['txid']: record['change_address'] for record in links_data}
+    # 1. Una sola query restituisce tutti gli anelli, l'indirizzo di resto e
+    # tutte le transazioni che lo spendono (relazione successore). I record
+    # vengono letti in streaming: in memoria resta solo la mappa dei successori.
+    if graph is not None:
+        links_data = graph.peel_links(peel_ratio=0.2, min_input_value=0.01, heights=heights,
+                                      window=window_span(windows) if windows else None)
+    else:
+        builder = get_peel_links_with_successors_feature_query if use_features else get_peel_links_with_successors_query
+        windowed = heights is None and windows is not None
+        peel_links_query = builder(incremental=heights is not None, windowed=windowed)
+        parameters = {'peel_ratio': 0.2, 'min_input_value': 0.01}
+        if windowed:
+            links_data = stream_windows(
+                lambda window: neo4j_conn.stream_query(
+                    peel_links_query, parameters={**parameters, **height_parameters(window=window)}
+                ),
+                windows, window_workers
+            )
+        else:
+            links_data = neo4j_conn.stream_query(peel_links_query, parameters={**parameters, 'heights': heights})
+    tids, successors = build_successor_map(links_data)
     
-    if not peel_links_map:
-        print("  > Nessun anello di Peeling Chain trovato. Impossibile ricostruire catene.")
+    if not len(tids):
+        out("  > Nessun anello di Peeling Chain trovato. Impossibile ricostruire catene.")
         return
 
-    print(f"  Trovati {len(peel_links_map)} possibili anelli. Inizio ricostruzione catene...")
-
-    # 2. Inizializza query di supporto
-    next_tx_query = get_next_transaction_query()
-    
-    # 3. Logica di ricostruzione iterativa
-    found_chains = []
-    processed_txids = set()
-
-    # Itera su tutti gli anelli trovati come possibili punti di partenza
-    for i, start_txid in enumerate(peel_links_map.keys()):
-        print(f"  Analizzando punto di partenza: {i + 1}/{len(peel_links_map)}  \r", end="", flush=True)
+    out(f"  Trovati {len(tids)} possibili anelli. Inizio ricostruzione catene...")
 
-        if start_txid in processed_txids:
-            continue
-
-        current_chain = [start_txid]
-        current_txid = start_txid
-        
-        while True:
-            # L'anello corrente deve essere nella nostra mappa
-            if current_txid not in peel_links_map:
-                break
-            
-            change_address = peel_links_map[current_txid]
-            processed_txids.add(current_txid)
-
-            # Trova la transazione successiva che spende da quell'indirizzo
-            next_tx_result = neo4j_conn.execute_query(next_tx_query, parameters={'address': change_address})
-            
-            if not next_tx_result:
-                break # La catena finisce qui
-            
-            next_txid = next_tx_result[0]['next_txid']
-
-            # CONTROLLO CHIAVE: la transazione successiva deve essere anch'essa un anello di peel valido
-            if next_txid in peel_links_map and next_txid not in current_chain:
-                current_chain.append(next_txid)
-                current_txid = next_txid
-            else:
-                break # La catena si interrompe perché il prossimo anello non è valido o crea un ciclo
-        
-    min_chain_length = 3
-    if len(current_chain) >= min_chain_length:
-        found_chains.append(current_chain)
+    # 2. Ricostruzione in memoria: il numero di query non dipende dalla lunghezza delle catene
+    found_chains = reconstruct_chains(tids, successors, min_chain_length)
+    txids = resolve_txids(neo4j_conn, found_chains, graph)
 
-    print() 
-    print("  Ricostruzione completata.")
+    out("  Ricostruzione completata.")
 
-    # 4. Stampa i risultati
+    # 3. Stampa i risultati
     if not found_chains:
-        print("  > Nessuna Peeling Chain completa (lunghezza >= 3) trovata.")
+        out(f"  > Nessuna Peeling Chain completa (lunghezza >= {min_chain_length}) trovata.")
     else:
-        print(f"  > Trovate {len(found_chains)} Peeling Chains complete:")
-        found_chains.sort(key=len, reverse=True)
+        out(f"  > Trovate {len(found_chains)} Peeling Chains complete:")
         
         for i, chain in enumerate(found_chains):
-            print(f"\n    --- Catena #{i+1} (Lunghezza: {len(chain)}) ---")
-            for j, txid in enumerate(chain):
-                print(f"      {j+1}. {txid}")
\ No newline at end of file
+            if sink is not None:
+                for j, tid in enumerate(chain):
+                    sink.write('chains', {'chain': i + 1, 'length': len(chain), 'position': j + 1,
+                                          'txid': txids[tid]})
+                continue
+            out(f"\n    --- Catena #{i+1} (Lunghezza: {len(chain)}) ---")
+            for j, tid in enumerate(chain):
+                out(f"      {j+1}. {txids[tid]}")
@@ -3,29 +3,82 @@ Questo modulo funge da libreria centralizzata per tutte le query Cypher
 utilizzate nel progetto.
 """
 
+# Rollup di dormienza salvate su ogni nodo Block: valore speso con età di almeno
+# N anni (proprietà spent_over_<N>y) e le età delle DORMANCY_TOP_SPENDS spese più vecchie
+DORMANCY_BANDS_YEARS = (1, 2, 5, 10)
+DORMANCY_TOP_SPENDS = 10
+
 # --- Query di Manutenzione ---
 def get_clear_database_query():
     """Restituisce la query per cancellare tutti i nodi e le relazioni."""
     return "MATCH (n) DETACH DELETE n"
 
+# --- Query di Schema ---
+def get_schema_queries():
+    """
+    Restituisce le istruzioni che creano vincoli di unicità e indici di tipo
+    range, come dizionario {nome: istruzione}. Senza di essi ogni MERGE sulle
+    chiavi Transaction.tid, Address.aid e Block.height diventa una
+    scansione per label. Le chiavi di transazioni e indirizzi sono gli id
+    compatti interi (etl.identifiers): txid e address non sono indicizzati.
+    """
+    return {
+        'transaction_tid': "CREATE CONSTRAINT transaction_tid IF NOT EXISTS "
+                           "FOR (t:Transaction) REQUIRE t.tid IS UNIQUE",
+        'address_aid': "CREATE CONSTRAINT address_aid IF NOT EXISTS "
+                       "FOR (a:Address) REQUIRE a.aid IS UNIQUE",
+        'block_height': "CREATE CONSTRAINT block_height IF NOT EXISTS "
+                        "FOR (b:Block) REQUIRE b.height IS UNIQUE",
+        'etl_state_name': "CREATE CONSTRAINT etl_state_name IF NOT EXISTS "
+                          "FOR (s:EtlState) REQUIRE s.name IS UNIQUE",
+        'transaction_block_height': "CREATE INDEX transaction_block_height IF NOT EXISTS "
+                                    "FOR (t:Transaction) ON (t.block_height)",
+        'block_ingested': "CREATE INDEX block_ingested IF NOT EXISTS "
+                          "FOR (b:Block) ON (b.ingested)",
+        'address_entity_id': "CREATE INDEX address_entity_id IF NOT EXISTS "
+                             "FOR (a:Address) ON (a.entity_id)",
+        'sent_age_days': "CREATE INDEX sent_age_days IF NOT EXISTS "
+                         "FOR ()-[s:SENT]-() ON (s.age_days)",
+        # Feature delle transazioni calcolate in fase di ingest
+        'transaction_n_inputs': "CREATE INDEX transaction_n_inputs IF NOT EXISTS "
+                                "FOR (t:Transaction) ON (t.n_inputs)",
+        'transaction_n_outputs': "CREATE INDEX transaction_n_outputs IF NOT EXISTS "
+                                 "FOR (t:Transaction) ON (t.n_outputs)",
+        'transaction_self_change': "CREATE INDEX transaction_self_change IF NOT EXISTS "
+                                   "FOR (t:Transaction) ON (t.self_change)",
+        'transaction_peel_ratio': "CREATE INDEX transaction_peel_ratio IF NOT EXISTS "
+                                  "FOR (t:Transaction) ON (t.peel_ratio)",
+        # Rollup di dormienza per blocco
+        'block_max_age_days': "CREATE INDEX block_max_age_days IF NOT EXISTS "
+                              "FOR (b:Block) ON (b.max_age_days)"
+    }
+
+def get_show_schema_query():
+    """Elenca nome e stato di tutti gli indici (inclusi quelli dei vincoli)."""
+    return "SHOW INDEXES YIELD name, state RETURN name, state"
+
+def get_await_indexes_query():
+    """Attende che tutti gli indici siano ONLINE."""
+    return "CALL db.awaitIndexes($timeout)"
+
 # --- Query ETL (Parser) ---
 def get_create_transaction_query():
     """Query per creare un nodo Transazione."""
-    return "MERGE (t:Transaction {txid: $tx_id}) SET t.block_height = $h"
+    return "MERGE (t:Transaction {tid: $tid}) ON CREATE SET t.txid = $tx_id SET t.block_height = $h"
 
 def get_create_output_query():
     """Query per creare un nodo Indirizzo per un output e la relazione RECEIVED."""
     return (
-        "MATCH (t:Transaction {txid: $tx_id}) "
-        "MERGE (a:Address {address: $addr}) "
+        "MATCH (t:Transaction {tid: $tid}) "
+        "MERGE (a:Address {aid: $aid}) ON CREATE SET a.address = $addr "
         "MERGE (t)-[:RECEIVED {value: $val}]->(a)"
     )
 
 def get_create_input_query():
     """Query per creare un nodo Indirizzo per un input e la relazione SENT."""
     return (
-        "MATCH (t:Transaction {txid: $tx_id}) "
-        "MERGE (a:Address {address: $addr}) "
+        "MATCH (t:Transaction {tid: $tid}) "
+        "MERGE (a:Address {aid: $aid}) ON CREATE SET a.address = $addr "
         "MERGE (a)-[s:SENT {value: $val}]->(t) "
         "SET s.age_days = $age"
     )
@@ -39,58 +92,522 @@ def get_create_block_and_link_tx_query():
         "MERGE (b:Block {height: $block_height}) "
         "SET b.hash = $block_hash, b.timestamp = datetime({epochSeconds: $timestamp}) "
         "WITH b "
-        "MATCH (t:Transaction {txid: $tx_id}) "
+        "MATCH (t:Transaction {tid: $tid}) "
         "MERGE (t)-[:INCLUDED_IN]->(b)"
     )
 
-def get_dormant_funds_query(min_age_days=365):
+# --- Query ETL Batch (UNWIND) ---
+# Versioni "a blocchi" delle query precedenti: ogni query scrive un'intera lista
+# di righe passata come parametro, così un blocco richiede un numero fisso di
+# round trip invece di uno per transazione/input/output.
+def get_batch_create_block_and_transactions_query():
+    """
+    Crea il nodo Blocco, le Transazioni della lista $transactions (con le
+    feature calcolate dal parser) e la relazione INCLUDED_IN in un'unica query.
+    """
+    return (
+        "MERGE (b:Block {height: $block_height}) "
+        "SET b.hash = $block_hash, b.timestamp = datetime({epochSeconds: $timestamp}) "
+        "WITH b "
+        "UNWIND $transactions AS row "
+        "MERGE (t:Transaction {tid: row.tid}) "
+        "ON CREATE SET t.txid = row.tx_id "
+        "SET t.block_height = $block_height, t += row.features "
+        "MERGE (t)-[:INCLUDED_IN]->(b)"
+    )
+
+def get_batch_create_outputs_query():
+    """
+    Crea gli Indirizzi e le relazioni RECEIVED per tutte le righe di $outputs.
+    La relazione è identificata dall'indice dell'output (vout): due output
+    dello stesso valore verso lo stesso indirizzo restano distinti.
+    """
+    return (
+        "UNWIND $outputs AS row "
+        "MATCH (t:Transaction {tid: row.tid}) "
+        "MERGE (a:Address {aid: row.aid}) "
+        "ON CREATE SET a.address = row.addr "
+        "MERGE (t)-[r:RECEIVED {vout: row.vout}]->(a) "
+        "SET r.value = row.val"
+    )
+
+def get_batch_create_inputs_query():
+    """
+    Crea gli Indirizzi e le relazioni SENT per tutte le righe di $inputs,
+    identificate dall'indice dell'input (vin).
+    """
+    return (
+        "UNWIND $inputs AS row "
+        "MATCH (t:Transaction {tid: row.tid}) "
+        "MERGE (a:Address {aid: row.aid}) "
+        "ON CREATE SET a.address = row.addr "
+        "MERGE (a)-[s:SENT {vin: row.vin}]->(t) "
+        "SET s.value = row.val, s.age_days = row.age"
+    )
+
+# --- Query ETL di Caricamento Fresco (CREATE) ---
+# Varianti delle query batch per i blocchi che di sicuro non sono ancora nel
+# grafo (oltre l'ultimo nodo Block): blocco, transazioni e relazioni vengono
+# creati senza verificarne l'esistenza e solo gli Address usano MERGE. Se un
+# blocco esiste già, i vincoli di unicità fanno fallire la transazione e il
+# parser ripiega sulle query idempotenti.
+def get_fresh_create_block_and_transactions_query(create_block=True):
+    """
+    Come get_batch_create_block_and_transactions_query con CREATE. Il nodo
+    Block viene creato dal primo gruppo di transazioni (create_block) e
+    ritrovato dai gruppi successivi.
+    """
+    return (
+        ("CREATE (b:Block {height: $block_height}) " if create_block else "MATCH (b:Block {height: $block_height}) ") +
+        "SET b.hash = $block_hash, b.timestamp = datetime({epochSeconds: $timestamp}) "
+        "WITH b "
+        "UNWIND $transactions AS row "
+        "CREATE (t:Transaction {tid: row.tid, txid: row.tx_id, block_height: $block_height}) "
+        "SET t += row.features "
+        "CREATE (t)-[:INCLUDED_IN]->(b)"
+    )
+
+def get_fresh_create_outputs_query():
+    """Come get_batch_create_outputs_query con CREATE per le relazioni RECEIVED."""
+    return (
+        "UNWIND $outputs AS row "
+        "MATCH (t:Transaction {tid: row.tid}) "
+        "MERGE (a:Address {aid: row.aid}) "
+        "ON CREATE SET a.address = row.addr "
+        "CREATE (t)-[:RECEIVED {vout: row.vout, value: row.val}]->(a)"
+    )
+
+def get_fresh_create_inputs_query():
+    """Come get_batch_create_inputs_query con CREATE per le relazioni SENT."""
+    return (
+        "UNWIND $inputs AS row "
+        "MATCH (t:Transaction {tid: row.tid}) "
+        "MERGE (a:Address {aid: row.aid}) "
+        "ON CREATE SET a.address = row.addr "
+        "CREATE (a)-[:SENT {vin: row.vin, value: row.val, age_days: row.age}]->(t)"
+    )
+
+# --- Query di Checkpoint ETL ---
+def get_mark_block_ingested_query():
+    """
+    Segna un blocco come scritto completamente (eseguita nell'ultima
+    transazione del blocco) e salva le sue rollup di dormienza ($rollup).
+    """
+    return "MATCH (b:Block {height: $block_height}) SET b.ingested = true, b += $rollup"
+
+def get_max_block_height_query():
+    """Restituisce l'altezza del nodo Block più alto, completato o meno."""
+    return (
+        "MATCH (b:Block) WHERE b.height IS NOT NULL "
+        "RETURN b.height AS max_height ORDER BY b.height DESC LIMIT 1"
+    )
+
+def get_ingested_heights_query():
+    """Restituisce le altezze dei blocchi completati nell'intervallo [$from_height, $to_height]."""
+    return (
+        "MATCH (b:Block) "
+        "WHERE b.height >= $from_height AND b.height <= $to_height AND b.ingested = true "
+        "RETURN b.height AS height"
+    )
+
+def get_ingested_range_query():
+    """Restituisce la prima e l'ultima altezza (high-water mark) dei blocchi completati."""
+    return (
+        "MATCH (b:Block) WHERE b.ingested = true "
+        "RETURN min(b.height) AS first_height, max(b.height) AS high_water_mark"
+    )
+
+def get_graph_watermark_query():
+    """Restituisce prima altezza, high-water mark e numero dei blocchi completati."""
+    return (
+        "MATCH (b:Block) WHERE b.ingested = true "
+        "RETURN min(b.height) AS first_height, max(b.height) AS high_water_mark, count(b) AS blocks"
+    )
+
+def get_block_hashes_query():
+    """Restituisce altezza e hash dei blocchi completati nell'intervallo [$from_height, $to_height]."""
+    return (
+        "MATCH (b:Block) "
+        "WHERE b.height >= $from_height AND b.height <= $to_height AND b.ingested = true "
+        "RETURN b.height AS height, b.hash AS hash"
+    )
+
+# --- Query di Rollback (riorganizzazioni della catena) ---
+def get_rollback_transactions_query():
+    """
+    Elimina le transazioni dei blocchi oltre $fork_height, con le loro
+    relazioni, e gli indirizzi rimasti senza relazioni.
+    """
+    return (
+        "MATCH (t:Transaction) WHERE t.block_height > $fork_height "
+        "OPTIONAL MATCH (t)-[:SENT|RECEIVED]-(a:Address) "
+        "WITH collect(DISTINCT t) AS transactions, collect(DISTINCT a) AS addresses "
+        "FOREACH (t IN transactions | DETACH DELETE t) "
+        "WITH addresses UNWIND addresses AS a "
+        "WITH a WHERE NOT (a)--() "
+        "DELETE a"
+    )
+
+def get_rollback_blocks_query():
+    """Elimina i nodi Block (con le rollup) oltre $fork_height."""
+    return "MATCH (b:Block) WHERE b.height > $fork_height DETACH DELETE b"
+
+def get_update_etl_state_query():
+    """Salva sul nodo di metadati EtlState l'high-water mark e i blocchi falliti dell'ultima esecuzione."""
+    return (
+        "MERGE (s:EtlState {name: 'etl'}) "
+        "SET s.high_water_mark = $high_water_mark, s.failed_heights = $failed_heights, "
+        "s.updated_at = datetime()"
+    )
+
+def _height_filter(variable, incremental, windowed):
+    """
+    Condizione (seguita da AND) sull'altezza dei blocchi: le altezze in
+    $heights (incremental) oppure la finestra [$from_height, $to_height]
+    (windowed), entrambe risolte con l'indice su block_height/height.
+    """
+    if incremental:
+        return f"{variable} IN $heights AND "
+    if windowed:
+        return f"{variable} >= $from_height AND {variable} <= $to_height AND "
+    return ""
+
+def get_dormant_funds_query(min_age_days=365, incremental=False, windowed=False):
     """
     Trova transazioni che spendono fondi rimasti inattivi per un
-    determinato numero di giorni.
+    determinato numero di giorni. A parità di giorni l'ordine è fissato da
+    txid, indirizzo e valore (lo stesso di MemoryGraph.dormant_funds).
     """
     return (
         "MATCH (a:Address)-[s:SENT]->(t:Transaction) "
+        "WHERE " + _height_filter("t.block_height", incremental, windowed) + "s.age_days >= $min_age_days "
+        "RETURN t.txid AS txid, a.address AS from_address, s.value AS value, s.age_days AS days_dormant "
+        "ORDER BY days_dormant DESC, txid, from_address, value DESC"
+    )
+
+def get_dormant_funds_rollup_query(incremental=False, windowed=False):
+    """
+    Variante di get_dormant_funds_query che usa le rollup per blocco: le
+    relazioni SENT vengono esaminate solo nei blocchi la cui spesa più vecchia
+    (max_age_days) supera la soglia.
+    """
+    return (
+        "MATCH (b:Block) "
+        "WHERE " + _height_filter("b.height", incremental, windowed) + "b.max_age_days >= $min_age_days "
+        "MATCH (a:Address)-[s:SENT]->(t:Transaction)-[:INCLUDED_IN]->(b) "
         "WHERE s.age_days >= $min_age_days "
         "RETURN t.txid AS txid, a.address AS from_address, s.value AS value, s.age_days AS days_dormant "
-        "ORDER BY days_dormant DESC"
+        "ORDER BY days_dormant DESC, txid, from_address, value DESC"
+    )
+
+def get_dormancy_summary_query(incremental=False, windowed=False):
+    """
+    Totali delle rollup di dormienza sui blocchi: coin-days destroyed, valore
+    speso per fascia di età e numero di blocchi con spese oltre $min_age_days.
+    """
+    bands = ", ".join(
+        f"sum(b.spent_over_{years}y) AS spent_over_{years}y" for years in DORMANCY_BANDS_YEARS
+    )
+    return (
+        "MATCH (b:Block) "
+        "WHERE " + _height_filter("b.height", incremental, windowed) + "b.max_age_days IS NOT NULL "
+        "RETURN count(b) AS blocks, sum(b.cdd) AS cdd, " + bands + ", "
+        "count(CASE WHEN b.max_age_days >= $min_age_days THEN 1 END) AS matching_blocks"
+    )
+
+def get_blocks_without_rollups_query(incremental=False, windowed=False):
+    """
+    Conta i blocchi completati privi delle rollup di dormienza (caricati
+    prima delle rollup e non ancora migrati): per quei blocchi
+    get_dormant_funds_rollup_query non troverebbe alcun movimento.
+    """
+    return (
+        "MATCH (b:Block) "
+        "WHERE " + _height_filter("b.height", incremental, windowed) + "b.ingested = true "
+        "AND b.max_age_days IS NULL "
+        "RETURN count(b) AS blocks"
     )
 
 # --- Query di Clustering ---
-def get_common_input_ownership_query():
+def get_input_address_sets_query(by_heights=False):
     """
-    Query ottimizzata per applicare l'euristica common-input-ownership.
+    Restituisce, per ogni transazione con più di un indirizzo di input, la
+    lista degli id (aid) degli indirizzi di input (euristica common-input-ownership)
+    e l'altezza del blocco, in ordine di altezza.
+    Legge una pagina di blocchi: l'intervallo [$from_height, $to_height]
+    oppure, con by_heights=True, le altezze in $heights.
     """
     return (
         "MATCH (t:Transaction) "
-        "WHERE COUNT { (:Address)-[:SENT]->(t) } > 1 "
-        "WITH t "
-        "MATCH (a1:Address)-[:SENT]->(t), (a2:Address)-[:SENT]->(t) "
-        "WHERE elementId(a1) < elementId(a2) "
-        "MERGE (a1)-[:SAME_ENTITY]-(a2)"
+        + ("WHERE t.block_height IN $heights " if by_heights else
+           "WHERE t.block_height >= $from_height AND t.block_height <= $to_height ") +
+        "WITH t, [(a:Address)-[:SENT]->(t) | a.aid] AS addresses "
+        "WHERE size(addresses) > 1 "
+        "RETURN addresses, t.block_height AS height ORDER BY height"
+    )
+
+def get_set_entity_ids_query():
+    """Assegna l'entity_id del cluster agli indirizzi in $rows."""
+    return (
+        "UNWIND $rows AS row "
+        "MATCH (a:Address {aid: row.aid}) "
+        "SET a.entity_id = row.entity_id"
+    )
+
+def get_addresses_by_entity_ids_query():
+    """Indirizzi (aid) con entity_id in $entity_ids."""
+    return "MATCH (a:Address) WHERE a.entity_id IN $entity_ids RETURN a.aid AS aid"
+
+def get_clear_entity_ids_query():
+    """Rimuove entity_id da al più $limit indirizzi; restituisce quanti ne ha aggiornati (updated)."""
+    return (
+        "MATCH (a:Address) WHERE a.entity_id IS NOT NULL "
+        "WITH a LIMIT $limit "
+        "SET a.entity_id = null "
+        "RETURN count(a) AS updated"
+    )
+
+def get_remap_entity_ids_query():
+    """Sposta tutti gli indirizzi di un cluster assorbito sull'entity_id del cluster risultante."""
+    return (
+        "UNWIND $remaps AS row "
+        "MATCH (a:Address {entity_id: row.old_entity_id}) "
+        "SET a.entity_id = row.new_entity_id"
     )
 
 
+# --- Query di Caricamento del Backend in Memoria ---
+# Leggono l'intero grafo (in streaming) per analysis.memory_graph.
+def get_memory_transactions_query():
+    return "MATCH (t:Transaction) RETURN t.txid AS txid, t.block_height AS block_height"
+
+def get_memory_received_query():
+    return (
+        "MATCH (t:Transaction)-[r:RECEIVED]->(a:Address) "
+        "RETURN t.txid AS txid, a.address AS address, r.value AS value, r.vout AS vout"
+    )
+
+def get_memory_sent_query():
+    return (
+        "MATCH (a:Address)-[s:SENT]->(t:Transaction) "
+        "RETURN a.address AS address, t.txid AS txid, s.value AS value, s.age_days AS age_days, s.vin AS vin"
+    )
+
+def get_graph_fingerprint_query():
+    """
+    Tutte le transazioni, ordinate per tid, con blocco e relazioni: due
+    caricamenti dello stesso intervallo devono restituire le stesse righe, a
+    meno dell'ordine delle liste (benchmarks.harness --check-fresh-load).
+    """
+    return (
+        "MATCH (t:Transaction) "
+        "WITH t ORDER BY t.tid "
+        "RETURN t.tid AS tid, properties(t) AS properties, "
+        "[(t)-[:INCLUDED_IN]->(b:Block) | properties(b)] AS blocks, "
+        "[(t)-[r:RECEIVED]->(a:Address) | [r.vout, a.aid, a.address, r.value]] AS received, "
+        "[(a:Address)-[s:SENT]->(t) | [s.vin, a.aid, a.address, s.value, s.age_days]] AS sent"
+    )
+
+# --- Query di Migrazione ---
+# Le query che cercano nodi per txid o address servono solo ai grafi creati
+# prima degli id compatti, che hanno ancora i vincoli di unicità su quelle proprietà.
+def get_transactions_without_ids_query():
+    """Transazioni di [$from_height, $to_height] ancora prive dell'id compatto tid."""
+    return (
+        "MATCH (t:Transaction) "
+        "WHERE t.block_height >= $from_height AND t.block_height <= $to_height AND t.tid IS NULL "
+        "RETURN t.txid AS txid, t.change_address AS change_address"
+    )
+
+def get_set_transaction_ids_query():
+    """Salva tid e change_aid sulle transazioni di $rows."""
+    return (
+        "UNWIND $rows AS row "
+        "MATCH (t:Transaction {txid: row.txid}) "
+        "SET t.tid = row.tid, t.change_aid = row.change_aid"
+    )
+
+def get_addresses_without_ids_query():
+    """
+    Indirizzi collegati (SENT o RECEIVED) alle transazioni di
+    [$from_height, $to_height] ancora privi dell'id compatto aid.
+    """
+    return (
+        "MATCH (t:Transaction)-[:SENT|RECEIVED]-(a:Address) "
+        "WHERE t.block_height >= $from_height AND t.block_height <= $to_height AND a.aid IS NULL "
+        "RETURN DISTINCT a.address AS address"
+    )
+
+def get_set_address_ids_query():
+    """Salva aid sugli indirizzi di $rows."""
+    return (
+        "UNWIND $rows AS row "
+        "MATCH (a:Address {address: row.address}) "
+        "SET a.aid = row.aid"
+    )
+
+def get_blocks_without_edge_indexes_query():
+    """
+    Altezze dei blocchi di [$from_height, $to_height] con relazioni RECEIVED
+    o SENT ancora prive dell'indice vout/vin (caricate quando il MERGE usava
+    il valore come chiave).
+    """
+    return (
+        "MATCH (t:Transaction) "
+        "WHERE t.block_height >= $from_height AND t.block_height <= $to_height "
+        "AND (EXISTS { MATCH (t)-[r:RECEIVED]->() WHERE r.vout IS NULL } "
+        "OR EXISTS { MATCH ()-[s:SENT]->(t) WHERE s.vin IS NULL }) "
+        "RETURN DISTINCT t.block_height AS height ORDER BY height"
+    )
+
+def get_set_output_indexes_query():
+    """
+    Salva vout sulle relazioni RECEIVED senza indice di $outputs, ritrovate
+    per estremi e valore (la vecchia chiave del MERGE).
+    """
+    return (
+        "UNWIND $outputs AS row "
+        "MATCH (t:Transaction {tid: row.tid})-[r:RECEIVED]->(a:Address {aid: row.aid}) "
+        "WHERE r.vout IS NULL AND r.value = row.val "
+        "SET r.vout = row.vout"
+    )
+
+def get_set_input_indexes_query():
+    """Come get_set_output_indexes_query per vin sulle relazioni SENT di $inputs."""
+    return (
+        "UNWIND $inputs AS row "
+        "MATCH (a:Address {aid: row.aid})-[s:SENT]->(t:Transaction {tid: row.tid}) "
+        "WHERE s.vin IS NULL AND s.value = row.val "
+        "SET s.vin = row.vin"
+    )
+
+def get_transactions_without_features_query(incremental=False):
+    """
+    Conta le transazioni dei blocchi in $heights (incremental) o di
+    [$from_height, $to_height] prive delle feature (caricate prima delle
+    feature e non ancora migrate), che le query *_feature_query non vedono.
+    """
+    return (
+        "MATCH (t:Transaction) "
+        "WHERE " + _height_filter("t.block_height", incremental, not incremental) + "t.n_inputs IS NULL "
+        "RETURN count(t) AS transactions"
+    )
+
+def get_backfill_transaction_features_query():
+    """
+    Calcola le feature delle transazioni di [$from_height, $to_height] che ne
+    sono prive, a partire dalle relazioni SENT/RECEIVED già presenti (gli id
+    compatti devono essere già presenti, vedi etl.migrations.backfill_compact_ids).
+    Senza gli output non standard, fee è approssimata alla differenza tra i
+    valori di SENT e RECEIVED.
+    """
+    return (
+        "MATCH (t:Transaction) "
+        "WHERE t.block_height >= $from_height AND t.block_height <= $to_height AND t.n_inputs IS NULL "
+        "WITH t, [(a:Address)-[s:SENT]->(t) | {addr: a.address, val: s.value}] AS ins, "
+        "[(t)-[r:RECEIVED]->(a:Address) | {addr: a.address, aid: a.aid, val: r.value}] AS outs "
+        "WITH t, ins, outs, "
+        "REDUCE(total = 0.0, i IN ins | total + i.val) AS total_in, "
+        "REDUCE(total = 0.0, o IN outs | total + o.val) AS total_out "
+        "SET t.n_inputs = size(ins), t.n_outputs = size(outs), "
+        "t.total_in = total_in, t.total_out = total_out, "
+        "t.fee = CASE WHEN size(ins) = 0 THEN null ELSE total_in - total_out END, "
+        "t.self_change = size(ins) = 1 AND size(outs) = 2 AND outs[0].addr <> outs[1].addr "
+        "AND ins[0].addr IN [o IN outs | o.addr], "
+        "t.peel_ratio = CASE WHEN size(outs) = 2 AND total_in > 0 "
+        "THEN (CASE WHEN outs[0].val < outs[1].val THEN outs[0].val ELSE outs[1].val END) / total_in END, "
+        "t.change_address = CASE WHEN size(outs) = 2 "
+        "THEN (CASE WHEN outs[0].val > outs[1].val THEN outs[0].addr ELSE outs[1].addr END) END, "
+        "t.change_aid = CASE WHEN size(outs) = 2 "
+        "THEN (CASE WHEN outs[0].val > outs[1].val THEN outs[0].aid ELSE outs[1].aid END) END "
+        "RETURN count(t) AS updated"
+    )
+
+def get_backfill_block_rollups_query():
+    """
+    Calcola le rollup di dormienza dei blocchi di [$from_height, $to_height]
+    che ne sono privi, a partire dalle relazioni SENT già presenti.
+    """
+    bands = ", ".join(
+        f"sum(CASE WHEN s.age_days >= {years * 365} THEN s.value ELSE 0.0 END) AS spent_over_{years}y"
+        for years in DORMANCY_BANDS_YEARS
+    )
+    band_assignments = ", ".join(
+        f"b.spent_over_{years}y = spent_over_{years}y" for years in DORMANCY_BANDS_YEARS
+    )
+    return (
+        "MATCH (b:Block) "
+        "WHERE b.height >= $from_height AND b.height <= $to_height AND b.max_age_days IS NULL "
+        "CALL { "
+        "WITH b "
+        "OPTIONAL MATCH (:Address)-[s:SENT]->(:Transaction)-[:INCLUDED_IN]->(b) "
+        "WITH s ORDER BY s.age_days DESC "
+        "RETURN sum(s.value * s.age_days) AS cdd, max(s.age_days) AS max_age_days, "
+        f"collect(s.age_days)[..{DORMANCY_TOP_SPENDS}] AS top_spend_ages, " + bands + " "
+        "} "
+        "SET b.cdd = cdd, b.max_age_days = coalesce(max_age_days, 0.0), b.top_spend_ages = top_spend_ages, "
+        + band_assignments + " "
+        "RETURN count(b) AS updated"
+    )
+
 # --- Query di Analisi Pattern ---
-def get_fan_out_query(min_outputs=10, max_inputs=2):
+def _keyset_filter(paged):
+    """Filtro sulla chiave della paginazione keyset (vedi Neo4jConnector.paginate_query)."""
+    return "t.tid > $after AND " if paged else ""
+
+def _keyset_page(paged):
+    return " ORDER BY t.tid LIMIT $limit" if paged else ""
+
+def get_fan_out_query(min_outputs=10, max_inputs=2, incremental=False, windowed=False, paged=False):
     """
     Trova transazioni di "distribuzione" (fan-out), potenziale smurfing.
+    Con paged i risultati sono ordinati per tid a pagine di $limit righe.
     """
     return (
         "MATCH (t:Transaction) "
-        "WHERE COUNT { (t)<-[:SENT]-() } <= $max_inputs "
+        "WHERE " + _height_filter("t.block_height", incremental, windowed) + _keyset_filter(paged) +
+        "COUNT { (t)<-[:SENT]-() } <= $max_inputs "
         "AND COUNT { (t)-[:RECEIVED]->() } >= $min_outputs "
-        "RETURN t.txid AS txid, COUNT { (t)<-[:SENT]-() } AS inputs, COUNT { (t)-[:RECEIVED]->() } AS outputs"
+        "RETURN t.tid AS tid, t.txid AS txid, COUNT { (t)<-[:SENT]-() } AS inputs, COUNT { (t)-[:RECEIVED]->() } AS outputs"
+        + _keyset_page(paged)
     )
 
-def get_fan_in_query(min_inputs=10, max_outputs=2):
+def get_fan_in_query(min_inputs=10, max_outputs=2, incremental=False, windowed=False, paged=False):
     """
     Trova transazioni di "consolidamento" (fan-in), potenziale sweep.
+    Con paged i risultati sono ordinati per tid a pagine di $limit righe.
     """
     return (
         "MATCH (t:Transaction) "
-        "WHERE COUNT { (t)<-[:SENT]-() } >= $min_inputs "
+        "WHERE " + _height_filter("t.block_height", incremental, windowed) + _keyset_filter(paged) +
+        "COUNT { (t)<-[:SENT]-() } >= $min_inputs "
         "AND COUNT { (t)-[:RECEIVED]->() } <= $max_outputs "
-        "RETURN t.txid AS txid, COUNT { (t)<-[:SENT]-() } AS inputs, COUNT { (t)-[:RECEIVED]->() } AS outputs"
+        "RETURN t.tid AS tid, t.txid AS txid, COUNT { (t)<-[:SENT]-() } AS inputs, COUNT { (t)-[:RECEIVED]->() } AS outputs"
+        + _keyset_page(paged)
+    )
+
+def get_fan_out_feature_query(incremental=False, windowed=False, paged=False):
+    """
+    Variante di get_fan_out_query basata sulle feature n_inputs/n_outputs
+    salvate in fase di ingest: una scansione dell'indice invece di espandere
+    le relazioni di ogni transazione.
+    """
+    return (
+        "MATCH (t:Transaction) "
+        "WHERE " + _height_filter("t.block_height", incremental, windowed) + _keyset_filter(paged) +
+        "t.n_outputs >= $min_outputs AND t.n_inputs <= $max_inputs "
+        "RETURN t.tid AS tid, t.txid AS txid, t.n_inputs AS inputs, t.n_outputs AS outputs"
+        + _keyset_page(paged)
+    )
+
+def get_fan_in_feature_query(incremental=False, windowed=False, paged=False):
+    """Variante di get_fan_in_query basata sulle feature n_inputs/n_outputs."""
+    return (
+        "MATCH (t:Transaction) "
+        "WHERE " + _height_filter("t.block_height", incremental, windowed) + _keyset_filter(paged) +
+        "t.n_inputs >= $min_inputs AND t.n_outputs <= $max_outputs "
+        "RETURN t.tid AS tid, t.txid AS txid, t.n_inputs AS inputs, t.n_outputs AS outputs"
+        + _keyset_page(paged)
     )
 
 def get_peeling_chain_link_query(peel_ratio=0.2, min_input_value=0.01):
@@ -144,12 +661,12 @@ def get_full_peeling_chain_query(min_chain_length=3, peel_ratio=0.2, min_input_v
 
 def get_peel_link_details_query(peel_ratio=0.2, min_input_value=0.01):
     """
-    Dato un TXID, verifica se è un anello di peel e restituisce il resto.
+    Dato l'id compatto $tid di una transazione, verifica se è un anello di peel e restituisce il resto.
     Versione corretta.
     """
     # --- CORREZIONE: Usa o1.val e o2.val invece di v1 e v2 nella clausola WHERE ---
     return (
-        "MATCH (t:Transaction {txid: $txid}) "
+        "MATCH (t:Transaction {tid: $tid}) "
         "WHERE COUNT { (t)-[:RECEIVED]->() } = 2 AND COUNT { (t)<-[:SENT]-() } <= 2 "
         "WITH t, REDUCE(total = 0.0, s IN [(a:Address)-[s:SENT]->(t) | s] | total + s.value) AS total_input_value "
         "WHERE total_input_value >= $min_input_value "
@@ -161,16 +678,90 @@ def get_peel_link_details_query(peel_ratio=0.2, min_input_value=0.01):
         "RETURN CASE WHEN o1.val > o2.val THEN o1.addr.address ELSE o2.addr.address END AS change_address"
     )
 
+def _next_spenders(change_addr):
+    """
+    Parte finale delle query sugli anelli: le transazioni che spendono
+    dall'indirizzo di resto nello stesso blocco di t o dopo, con valore e vin
+    della relazione SENT, così il successore può essere scelto tra le spese
+    successive e non tra quelle precedenti di un indirizzo riutilizzato.
+    Richiede t, change_value e l'indirizzo di resto.
+    """
+    return (
+        f"OPTIONAL MATCH ({change_addr})-[s:SENT]->(next:Transaction) "
+        "WHERE next <> t AND next.block_height >= t.block_height "
+        f"RETURN t.tid AS tid, {change_addr}.address AS change_address, change_value, "
+        "collect(next {.tid, .block_height, value: s.value, vin: s.vin}) AS next_spenders"
+    )
+
+def get_peel_links_with_successors_query(peel_ratio=0.2, min_input_value=0.01, incremental=False,
+                                         windowed=False):
+    """
+    Trova tutti gli anelli di peeling chain (euristica sul valore degli output)
+    insieme all'indirizzo di resto e a tutte le transazioni che lo spendono,
+    così le catene possono essere ricostruite in memoria con una sola query.
+    """
+    return (
+        "MATCH (t:Transaction) "
+        "WHERE " + _height_filter("t.block_height", incremental, windowed) +
+        "COUNT { (t)-[:RECEIVED]->() } = 2 AND COUNT { (t)<-[:SENT]-() } <= 2 "
+        "WITH t, REDUCE(total = 0.0, s IN [(a:Address)-[s:SENT]->(t) | s] | total + s.value) AS total_input_value "
+        "WHERE total_input_value >= $min_input_value "
+        "WITH t, total_input_value, [(t)-[r:RECEIVED]->(a:Address) | {addr: a, val: r.value}] AS outputs "
+        "WITH t, total_input_value, outputs[0] AS o1, outputs[1] AS o2 "
+        "WITH t, total_input_value, o1, o2, (o1.val + o2.val) AS total_output_value "
+        "WHERE total_output_value <= total_input_value "
+        "AND ( (o1.val < total_input_value * $peel_ratio AND o2.val > total_input_value * $peel_ratio) OR "
+        "      (o2.val < total_input_value * $peel_ratio AND o1.val > total_input_value * $peel_ratio) ) "
+        "WITH t, CASE WHEN o1.val > o2.val THEN o1.addr ELSE o2.addr END AS change_addr, "
+        "CASE WHEN o1.val > o2.val THEN o1.val ELSE o2.val END AS change_value "
+        + _next_spenders("change_addr")
+    )
+
+def get_peel_links_with_successors_feature_query(incremental=False, windowed=False):
+    """
+    Variante di get_peel_links_with_successors_query basata sulle feature:
+    peel_ratio è il rapporto tra l'output minore e il totale degli input,
+    quindi l'output maggiore vale (total_out / total_in - peel_ratio).
+    """
+    return (
+        "MATCH (t:Transaction) "
+        "WHERE " + _height_filter("t.block_height", incremental, windowed) +
+        "t.peel_ratio < $peel_ratio AND t.n_outputs = 2 AND t.n_inputs <= 2 "
+        "AND t.total_in >= $min_input_value AND t.total_out <= t.total_in "
+        "AND t.total_out / t.total_in - t.peel_ratio > $peel_ratio "
+        "MATCH (change_addr:Address {aid: t.change_aid}) "
+        "WITH t, change_addr, head([(t)-[c:RECEIVED]->(change_addr) | c.value]) AS change_value "
+        + _next_spenders("change_addr")
+    )
+
+def get_txids_by_tid_query():
+    """Restituisce il txid delle transazioni con id compatto in $tids."""
+    return (
+        "UNWIND $tids AS tid "
+        "MATCH (t:Transaction {tid: tid}) "
+        "RETURN t.tid AS tid, t.txid AS txid"
+    )
+
 def get_next_transaction_query():
     """
-    Dato un indirizzo, trova il TXID della transazione che lo usa come input.
+    Dato l'id compatto $aid di un indirizzo, trova il TXID della transazione che lo usa come input.
     """
     return (
-        "MATCH (a:Address {address: $address})-[:SENT]->(t:Transaction) "
+        "MATCH (a:Address {aid: $aid})-[:SENT]->(t:Transaction) "
         "RETURN t.txid AS next_txid LIMIT 1"
     )
 
-def get_self_change_peel_link_query():
+def get_self_change_peel_link_feature_query(incremental=False, windowed=False):
+    """Variante di get_self_change_peel_link_query basata sulla feature self_change."""
+    return (
+        "MATCH (t:Transaction) "
+        "WHERE " + _height_filter("t.block_height", incremental, windowed) + "t.self_change = true "
+        "MATCH (in_addr:Address)-[:SENT]->(t) "
+        "WITH t, in_addr, head([(t)-[c:RECEIVED]->(in_addr) | c.value]) AS change_value "
+        + _next_spenders("in_addr")
+    )
+
+def get_self_change_peel_link_query(incremental=False, windowed=False):
     """
     Trova anelli di peeling chain basati sull'euristica "self-change".
     Cerca transazioni 1-input/2-output dove un output torna all'indirizzo di input.
@@ -178,7 +769,7 @@ def get_self_change_peel_link_query():
     return (
         # Trova transazioni con 1 input e 2 output
         "MATCH (in_addr:Address)-[:SENT]->(t:Transaction) "
-        "WHERE COUNT { (:Address)-[:SENT]->(t) } = 1 AND COUNT { (t)-[:RECEIVED]->() } = 2 "
+        "WHERE " + _height_filter("t.block_height", incremental, windowed) + "COUNT { (:Address)-[:SENT]->(t) } = 1 AND COUNT { (t)-[:RECEIVED]->() } = 2 "
         
         # Verifica che uno degli output sia un self-change
         "AND EXISTS ((t)-[:RECEIVED]->(in_addr)) "
@@ -187,7 +778,58 @@ def get_self_change_peel_link_query():
         "WITH t, in_addr "
         "MATCH (t)-[:RECEIVED]->(peeled_addr:Address) "
         "WHERE peeled_addr <> in_addr "
-        
-        "RETURN t.txid AS txid, in_addr.address AS change_address"
+
+        # Le transazioni successive che spendono dall'indirizzo di resto (esclusa t stessa)
+        "WITH t, in_addr, head([(t)-[c:RECEIVED]->(in_addr) | c.value]) AS change_value "
+        + _next_spenders("in_addr")
     )
 
+
+# --- Query di Tracciamento dei Fondi ---
+# Un livello della visita in ampiezza per volta, sull'intera frontiera ($tids
+# o $aids): per ogni nodo della frontiera al più $max_fanout archi di valore
+# almeno $min_value, dal più grande. In avanti si seguono gli output
+# (t)-[:RECEIVED]->(a)-[:SENT]->(next), all'indietro gli input.
+def _trace_edges(group, value):
+    """
+    Parte comune: cap per nodo della frontiera (group è t per le
+    transazioni, a per gli indirizzi) e colonne restituite.
+    """
+    carried = "a" if group == "a" else f"{group}, a"
+    return (
+        f"WITH {carried}, {value} AS value, next ORDER BY value DESC, next.tid "
+        f"WITH {group}, collect({{address: a.address, value: value, tid: next.tid, txid: next.txid, "
+        "block_height: next.block_height})[..$max_fanout] AS edges "
+        "UNWIND edges AS edge "
+        "RETURN " + ("t.txid" if group == "t" else "null") + " AS from_txid, edge.address AS address, "
+        "edge.value AS value, edge.tid AS tid, edge.txid AS txid, edge.block_height AS block_height"
+    )
+
+def get_trace_hop_query(backward=False):
+    """Archi del livello successivo a partire dalle transazioni della frontiera $tids."""
+    if backward:
+        match = ("MATCH (next:Transaction)-[r:RECEIVED]->(a:Address)-[s:SENT]->(t) "
+                 "WHERE next <> t AND next.block_height <= t.block_height AND s.value >= $min_value ")
+    else:
+        match = ("MATCH (t)-[r:RECEIVED]->(a:Address)-[s:SENT]->(next:Transaction) "
+                 "WHERE next <> t AND next.block_height >= t.block_height AND r.value >= $min_value ")
+    return (
+        "UNWIND $tids AS tid "
+        "MATCH (t:Transaction {tid: tid}) "
+        + match + _trace_edges("t", "s.value" if backward else "r.value")
+    )
+
+def get_trace_address_query(backward=False):
+    """
+    Primo livello a partire dagli indirizzi $aids: le transazioni che li
+    spendono (in avanti) o che li finanziano (all'indietro).
+    """
+    if backward:
+        match = "MATCH (next:Transaction)-[r:RECEIVED]->(a) WHERE r.value >= $min_value "
+    else:
+        match = "MATCH (a)-[s:SENT]->(next:Transaction) WHERE s.value >= $min_value "
+    return (
+        "UNWIND $aids AS aid "
+        "MATCH (a:Address {aid: aid}) "
+        + match + _trace_edges("a", "r.value" if backward else "s.value")
+    )
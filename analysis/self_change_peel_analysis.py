@@ -1,71 +1,64 @@
-from .queries import get_self_change_peel_link_query, get_next_transaction_query
+from .queries import get_self_change_peel_link_query, get_self_change_peel_link_feature_query
+from .chain_builder import build_successor_map, reconstruct_chains, resolve_txids
+from .windows import height_parameters, stream_windows, window_span
 
-def run(neo4j_conn):
+def run(neo4j_conn, heights=None, min_chain_length=2, use_features=True, out=print, graph=None, sink=None,
+        windows=None, window_workers=1):
     """
     Esegue l'analisi "High-Confidence" per ricostruire le Peeling Chains
     basate sull'euristica del self-change address.
+    Se heights è indicato, cerca gli anelli solo tra le transazioni di quei blocchi;
+    altrimenti, con windows (vedi analysis.windows), tra quelle delle finestre,
+    lette window_workers alla volta.
+    Per queste catene ad alta affidabilità anche 2 anelli sono interessanti.
+    Con use_features usa il flag self_change salvato in fase di ingest.
+    Il testo prodotto viene scritto tramite out (print per default).
+    Con graph (analysis.memory_graph.MemoryGraph) l'analisi viene eseguita in memoria.
+    Con sink (analysis.sinks.ResultSink) le catene vengono scritte nella tabella
+    chains (una riga per anello) invece che stampate.
     """
-    print("\n[Analisi High-Confidence] Ricostruzione Peeling Chains (Self-Change)...")
+    out("\n[Analisi High-Confidence] Ricostruzione Peeling Chains (Self-Change)...")
     
-    # 1. Trova tutti gli anelli basati sul self-change
-    self_change_query = get_self_change_peel_link_query()
-    links_data = neo4j_conn.execute_query(self_change_query)
-    peel_links_map = {record['txid']: record['change_address'] for record in links_data}
+    # 1. Trova tutti gli anelli basati sul self-change, con i rispettivi successori
+    if graph is not None:
+        links_data = graph.self_change_links(heights=heights, window=window_span(windows) if windows else None)
+    else:
+        builder = get_self_change_peel_link_feature_query if use_features else get_self_change_peel_link_query
+        windowed = heights is None and windows is not None
+        self_change_query = builder(incremental=heights is not None, windowed=windowed)
+        if windowed:
+            links_data = stream_windows(
+                lambda window: neo4j_conn.stream_query(self_change_query, parameters=height_parameters(window=window)),
+                windows, window_workers
+            )
+        else:
+            links_data = neo4j_conn.stream_query(self_change_query, parameters={'heights': heights})
+    tids, successors = build_successor_map(links_data)
     
-    if not peel_links_map:
-        print("  > Nessun anello di Peeling Chain (Self-Change) trovato.")
+    if not len(tids):
+        out("  > Nessun anello di Peeling Chain (Self-Change) trovato.")
         return
 
-    print(f"  Trovati {len(peel_links_map)} possibili anelli (Self-Change). Inizio ricostruzione...")
+    out(f"  Trovati {len(tids)} possibili anelli (Self-Change). Inizio ricostruzione...")
 
     # 2. Logica di ricostruzione (identica a prima, ma su dati più affidabili)
-    next_tx_query = get_next_transaction_query()
-    found_chains = []
-    processed_txids = set()
-
-    for i, start_txid in enumerate(peel_links_map.keys()):
-        print(f"  Analizzando punto di partenza: {i + 1}/{len(peel_links_map)}  \r", end="", flush=True)
-
-        if start_txid in processed_txids:
-            continue
-
-        current_chain = [start_txid]
-        current_txid = start_txid
-        
-        while True:
-            if current_txid not in peel_links_map:
-                break
-            
-            change_address = peel_links_map[current_txid]
-            processed_txids.add(current_txid)
-            
-            next_tx_result = neo4j_conn.execute_query(next_tx_query, parameters={'address': change_address})
-            if not next_tx_result:
-                break
-            
-            next_txid = next_tx_result[0]['next_txid']
-
-            if next_txid in peel_links_map and next_txid not in current_chain:
-                current_chain.append(next_txid)
-                current_txid = next_txid
-            else:
-                break
-        
-    min_chain_length = 2 # Per queste catene ad alta affidabilità, anche 2 anelli sono interessanti
-    if len(current_chain) >= min_chain_length:
-        found_chains.append(current_chain)
+    found_chains = reconstruct_chains(tids, successors, min_chain_length)
+    txids = resolve_txids(neo4j_conn, found_chains, graph)
 
-    print() 
-    print("  Ricostruzione completata.")
+    out("  Ricostruzione completata.")
 
     # 3. Stampa i risultati
     if not found_chains:
-        print("  > Nessuna Peeling Chain completa (Self-Change) trovata.")
+        out("  > Nessuna Peeling Chain completa (Self-Change) trovata.")
     else:
-        print(f"  > Trovate {len(found_chains)} Peeling Chains complete (Self-Change):")
-        found_chains.sort(key=len, reverse=True)
+        out(f"  > Trovate {len(found_chains)} Peeling Chains complete (Self-Change):")
         
         for i, chain in enumerate(found_chains):
-            print(f"\n    --- Catena #{i+1} (Lunghezza: {len(chain)}) ---")
-            for j, txid in enumerate(chain):
-                print(f"      {j+1}. {txid}")
\ No newline at end of file
+            if sink is not None:
+                for j, tid in enumerate(chain):
+                    sink.write('chains', {'chain': i + 1, 'length': len(chain), 'position': j + 1,
+                                          'txid': txids[tid]})
+                continue
+            out(f"\n    --- Catena #{i+1} (Lunghezza: {len(chain)}) ---")
+            for j, tid in enumerate(chain):
+                out(f"      {j+1}. {txids[tid]}")
@@ -0,0 +1,114 @@
+"""
+Destinazioni strutturate dei risultati delle analisi. Invece di stampare ogni
+risultato, le analisi scrivono record (dizionari) in tabelle; ogni tabella
+diventa un file JSONL (eventualmente compresso con gzip) o Parquet nella
+cartella di output, scritto a blocchi di dimensione limitata man mano che i
+record arrivano. I file si leggono direttamente con pandas/polars/pyarrow.
+"""
+import gzip
+import json
+import os
+
+import metrics
+
+SINK_FORMATS = ('jsonl', 'parquet')
+
+class _JsonlTable:
+    def __init__(self, path, compress):
+        self._handle = gzip.open(path, 'wt', encoding='utf-8') if compress else open(path, 'w', encoding='utf-8')
+
+    def write_batch(self, records):
+        self._handle.write(''.join(json.dumps(record, separators=(',', ':')) + '\n' for record in records))
+
+    def close(self):
+        self._handle.close()
+
+class _ParquetTable:
+    def __init__(self, path, compress):
+        # Dipendenza opzionale: serve solo per l'output Parquet
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise RuntimeError("L'output Parquet richiede il pacchetto pyarrow (pip install pyarrow).")
+        self._pyarrow = pyarrow
+        self._path = path
+        self._compression = 'zstd' if compress else 'none'
+        self._writer = None
+
+    def write_batch(self, records):
+        # Ogni batch diventa un row group; lo schema è quello del primo batch
+        if self._writer is None:
+            table = self._pyarrow.Table.from_pylist(records)
+            self._writer = self._pyarrow.parquet.ParquetWriter(self._path, table.schema,
+                                                               compression=self._compression)
+        else:
+            table = self._pyarrow.Table.from_pylist(records, schema=self._writer.schema)
+        self._writer.write_table(table)
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+
+class ResultSink:
+    """
+    Scrive i record di un'analisi nei file <cartella>/<analisi>-<tabella>.<formato>,
+    aperti alla prima scrittura. In memoria restano al più batch_size record per tabella.
+    """
+    def __init__(self, output_dir, name, format='jsonl', compress=False, batch_size=10000):
+        if format not in SINK_FORMATS:
+            raise ValueError(f"Formato di output non supportato: {format}")
+        os.makedirs(output_dir, exist_ok=True)
+        self._output_dir = output_dir
+        self._name = name
+        self._format = format
+        self._compress = compress
+        self._batch_size = max(1, batch_size)
+        self._tables = {}
+        self._batches = {}
+        self.counts = {}
+        self.paths = {}
+
+    def write(self, table, record):
+        if table not in self._tables:
+            extension = '.jsonl.gz' if self._format == 'jsonl' and self._compress else f'.{self._format}'
+            path = os.path.join(self._output_dir, f"{self._name}-{table}{extension}")
+            table_class = _JsonlTable if self._format == 'jsonl' else _ParquetTable
+            self._tables[table] = table_class(path, self._compress)
+            self._batches[table] = []
+            self.counts[table] = 0
+            self.paths[table] = path
+        batch = self._batches[table]
+        batch.append(record)
+        self.counts[table] += 1
+        if len(batch) >= self._batch_size:
+            self._flush(table)
+
+    def _flush(self, table):
+        batch = self._batches[table]
+        if batch:
+            with metrics.timer('sink_write'):
+                self._tables[table].write_batch(batch)
+            metrics.inc('sink_records', len(batch))
+            self._batches[table] = []
+
+    def close(self):
+        for table, writer in self._tables.items():
+            self._flush(table)
+            writer.close()
+
+def with_sink(function, name, output_dir, format='jsonl', compress=False, batch_size=10000):
+    """
+    Restituisce la funzione di un'analisi (che accetta out e sink) da eseguire
+    con un ResultSink: a fine analisi i file vengono chiusi e su out viene
+    stampato solo un riepilogo delle righe scritte.
+    """
+    def run(out=print, **kwargs):
+        sink = ResultSink(output_dir, name, format, compress, batch_size)
+        try:
+            function(out=out, sink=sink, **kwargs)
+        finally:
+            sink.close()
+        for table, path in sink.paths.items():
+            out(f"  File {path}: {sink.counts[table]} righe ({table}).")
+    return run
@@ -0,0 +1,98 @@
+"""
+Tracciamento multi-hop dei fondi a partire da transazioni o indirizzi: visita
+in ampiezza seguendo le relazioni RECEIVED/SENT in avanti (dove vengono
+spesi gli output) o all'indietro (da dove provengono gli input). Ogni
+livello è una sola query sull'intera frontiera (a gruppi di batch_size),
+quindi il numero di query cresce con la profondità e non con i nodi
+visitati; in memoria restano solo la frontiera e l'insieme dei tid visitati.
+Le relazioni SENT hanno l'indice dell'input (vin) ma non l'output speso
+(txid, vout): un indirizzo riutilizzato collega quindi una transazione a
+tutte le spese successive dell'indirizzo, e max_fanout e min_value limitano
+l'esplosione della frontiera.
+"""
+from etl.identifiers import compact_id
+from .queries import get_trace_hop_query, get_trace_address_query
+
+TRACE_DIRECTIONS = ('forward', 'backward')
+
+def _level_records(neo4j_conn, graph, frontier, addresses, backward, parameters, batch_size):
+    """Record degli archi di un livello, letti in streaming a gruppi di batch_size nodi della frontiera."""
+    if addresses:
+        if graph is not None:
+            yield from graph.trace_addresses(addresses, backward, **parameters)
+        else:
+            aids = sorted({compact_id(address) for address in addresses})
+            for start in range(0, len(aids), batch_size):
+                yield from neo4j_conn.stream_query(
+                    get_trace_address_query(backward), parameters={**parameters, 'aids': aids[start:start + batch_size]}
+                )
+    for start in range(0, len(frontier), batch_size):
+        batch = frontier[start:start + batch_size]
+        if graph is not None:
+            yield from graph.trace_hop(batch, backward, **parameters)
+        else:
+            yield from neo4j_conn.stream_query(get_trace_hop_query(backward), parameters={**parameters, 'tids': batch})
+
+def run(neo4j_conn, txids=(), addresses=(), direction='forward', max_depth=5, max_fanout=20, min_value=0.0,
+        max_frontier=100000, batch_size=5000, out=print, graph=None, sink=None):
+    """
+    Segue i fondi per al più max_depth livelli a partire dalle transazioni
+    txids e dagli indirizzi addresses. Per ogni nodo vengono seguiti al più
+    max_fanout archi di almeno min_value BTC (dal più grande); ogni
+    transazione viene espansa una sola volta e la frontiera di un livello è
+    limitata a max_frontier transazioni.
+    Gli archi vengono stampati man mano che arrivano tramite out.
+    Con graph (analysis.memory_graph.MemoryGraph) l'analisi viene eseguita in memoria.
+    Con sink (analysis.sinks.ResultSink) gli archi vengono scritti nella
+    tabella trace invece che stampati.
+    """
+    if direction not in TRACE_DIRECTIONS:
+        raise ValueError(f"Direzione di tracciamento non supportata: {direction}")
+    backward = direction == 'backward'
+    arrow = '<-' if backward else '->'
+    direction_label = "all'indietro" if backward else "in avanti"
+    out(f"\n[Analisi] Tracciamento dei fondi {direction_label} "
+        f"(profondità {max_depth}, max {max_fanout} archi per nodo, valore minimo {min_value} BTC)...")
+    if not txids and not addresses:
+        out("  > Nessuna transazione o indirizzo di partenza indicato.")
+        return
+
+    parameters = {'min_value': min_value, 'max_fanout': max_fanout}
+    frontier = sorted({compact_id(txid) for txid in txids})
+    visited = set(frontier)
+    total_edges = 0
+    for hop in range(1, max_depth + 1):
+        next_frontier = []
+        edges = 0
+        truncated = False
+        for record in _level_records(neo4j_conn, graph, frontier, addresses if hop == 1 else (), backward,
+                                     parameters, batch_size):
+            edges += 1
+            if sink is not None:
+                sink.write('trace', {
+                    'hop': hop, 'from_txid': record['from_txid'] or '', 'address': record['address'],
+                    'value': record['value'], 'txid': record['txid'], 'block_height': record['block_height']
+                })
+            elif record['from_txid'] is None:
+                out(f"    [{hop}] {record['address']} {arrow} {record['txid']} "
+                    f"({record['value']:.8f} BTC, blocco {record['block_height']})")
+            else:
+                out(f"    [{hop}] {record['from_txid']} {arrow} {record['address']} {arrow} {record['txid']} "
+                    f"({record['value']:.8f} BTC, blocco {record['block_height']})")
+
+            if record['tid'] in visited:
+                continue
+            if len(next_frontier) >= max_frontier:
+                truncated = True
+                continue
+            visited.add(record['tid'])
+            next_frontier.append(record['tid'])
+
+        total_edges += edges
+        out(f"  > Livello {hop}: {edges} archi, {len(next_frontier)} nuove transazioni"
+            + (f" (frontiera limitata a {max_frontier})." if truncated else "."))
+        frontier = sorted(next_frontier)
+        if not frontier:
+            break
+
+    out(f"  > Tracciamento completato: {total_edges} archi, {len(visited)} transazioni visitate.")
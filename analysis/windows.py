@@ -0,0 +1,135 @@
+"""
+Analisi per finestre di altezze. Invece di una sola query su tutte le
+transazioni del grafo, l'intervallo di blocchi viene diviso in finestre
+contigue filtrate con l'indice su block_height: le finestre vengono lette in
+parallelo (al più max_workers alla volta) e i loro record restituiti
+nell'ordine delle finestre, appena disponibili. Ogni finestra passa i record
+al consumatore tramite una coda limitata, quindi in memoria restano al più
+max_workers * buffer_size record qualunque sia la dimensione delle finestre.
+"""
+import heapq
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+
+import metrics
+
+# Marcatore di fine finestra nella coda dei record
+_DONE = object()
+
+def split_windows(from_height, to_height, window_size=0):
+    """Divide [from_height, to_height] in finestre (da, a) di al più window_size blocchi (0 = una sola finestra)."""
+    if window_size <= 0:
+        return [(from_height, to_height)]
+    return [(start, min(start + window_size - 1, to_height))
+            for start in range(from_height, to_height + 1, window_size)]
+
+def window_span(windows):
+    """Intervallo (da, a) coperto dalle finestre."""
+    return windows[0][0], windows[-1][1]
+
+def height_parameters(heights=None, window=None):
+    """Parametri del filtro sulle altezze delle query (incremental con heights, windowed con window)."""
+    parameters = {'heights': heights}
+    if window is not None:
+        parameters.update(from_height=window[0], to_height=window[1])
+    return parameters
+
+def _group_windows(windows, groups):
+    """Raggruppa le finestre in al più groups intervalli contigui (da, a)."""
+    size = -(-len(windows) // groups)
+    return [(windows[i][0], windows[min(i + size, len(windows)) - 1][1]) for i in range(0, len(windows), size)]
+
+class _Failure:
+    def __init__(self, error):
+        self.error = error
+
+def _put(records_queue, item, stop):
+    """Accoda item attendendo spazio nella coda; False se il consumatore ha smesso di leggere."""
+    while not stop.is_set():
+        try:
+            records_queue.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+def _produce(fetch, window, records_queue, stop):
+    started = time.monotonic()
+    records = None
+    try:
+        records = fetch(window)
+        for record in records:
+            if not _put(records_queue, record, stop):
+                return
+        _put(records_queue, _DONE, stop)
+    except BaseException as error:
+        _put(records_queue, _Failure(error), stop)
+    finally:
+        # Chiude il generatore (e la sessione) anche se la lettura viene interrotta
+        close = getattr(records, 'close', None)
+        if close is not None:
+            close()
+        metrics.observe('analysis_window', time.monotonic() - started)
+
+def _start(executor, fetch, window, buffer_size, stop):
+    records_queue = queue.Queue(maxsize=buffer_size)
+    executor.submit(_produce, fetch, window, records_queue, stop)
+    return records_queue
+
+def _consume(records_queue):
+    while True:
+        item = records_queue.get()
+        if item is _DONE:
+            return
+        if isinstance(item, _Failure):
+            raise item.error
+        yield item
+
+def stream_windows(fetch, windows, max_workers=4, buffer_size=1000):
+    """
+    Esegue fetch(window), che restituisce i record di una finestra come
+    iteratore, per ogni finestra. Restano in corso al più max_workers
+    finestre, ciascuna con al più buffer_size record in attesa; i record
+    vengono restituiti finestra per finestra nell'ordine di windows.
+    """
+    if max_workers <= 1 or len(windows) <= 1:
+        for window in windows:
+            yield from fetch(window)
+        return
+    stop = threading.Event()
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='window') as executor:
+        try:
+            remaining = iter(windows)
+            pending = deque(
+                _start(executor, fetch, window, buffer_size, stop) for window in islice(remaining, max_workers)
+            )
+            while pending:
+                yield from _consume(pending.popleft())
+                window = next(remaining, None)
+                if window is not None:
+                    pending.append(_start(executor, fetch, window, buffer_size, stop))
+        finally:
+            stop.set()
+
+def merge_windows(fetch, windows, key, max_workers=4, buffer_size=1000):
+    """
+    Come stream_windows, per query ordinate secondo key: le finestre vengono
+    raggruppate in al più max_workers intervalli contigui, letti in parallelo,
+    e i loro record fusi con heapq.merge, così l'ordinamento vale sull'intero
+    intervallo e non solo all'interno di ciascuna finestra.
+    """
+    groups = _group_windows(windows, max(max_workers, 1))
+    if len(groups) == 1:
+        yield from fetch(groups[0])
+        return
+    stop = threading.Event()
+    with ThreadPoolExecutor(max_workers=len(groups), thread_name_prefix='window') as executor:
+        try:
+            queues = [_start(executor, fetch, group, buffer_size, stop) for group in groups]
+            yield from heapq.merge(*(_consume(records_queue) for records_queue in queues), key=key)
+        finally:
+            stop.set()
@@ -0,0 +1,117 @@
+"""
+Server JSON-RPC locale che simula un nodo Bitcoin Core sopra una
+SyntheticChain: getblockcount, getbestblockhash, getblockhash, getblock
+(verbosity 2) e getrawtransaction (verbose), anche in richieste batch. Conta
+le richieste HTTP e le chiamate per metodo. Per provare --action follow il
+tip visibile può essere spostato (set_tip) e le riorganizzazioni simulate
+sostituendo gli ultimi blocchi con blocchi di hash diverso (reorg).
+"""
+import hashlib
+import json
+import threading
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+class _RpcError(Exception):
+    def __init__(self, code, message):
+        super().__init__(message)
+        self.code = code
+
+class FakeBitcoinRpcServer:
+    def __init__(self, chain, host='127.0.0.1', port=0):
+        self._chain = chain
+        self._blocks = list(chain.blocks)
+        self._hash_to_block = {block['hash']: block for block in chain.blocks}
+        self.tip = len(self._blocks) - 1
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.calls = Counter()
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                payload = json.loads(body)
+                with server._lock:
+                    server.requests += 1
+                if isinstance(payload, list):
+                    response = [server._dispatch(call) for call in payload]
+                else:
+                    response = server._dispatch(payload)
+                data = json.dumps(response).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        self.host, self.port = self._server.server_address
+        self._thread = None
+
+    def _dispatch(self, call):
+        method, params = call.get('method'), call.get('params', [])
+        with self._lock:
+            self.calls[method] += 1
+        try:
+            result = self._call(method, params)
+            return {'result': result, 'error': None, 'id': call.get('id')}
+        except _RpcError as e:
+            return {'result': None, 'error': {'code': e.code, 'message': str(e)}, 'id': call.get('id')}
+
+    def _call(self, method, params):
+        blocks = self._blocks
+        if method == 'getblockcount':
+            return self.tip
+        if method == 'getbestblockhash':
+            return blocks[self.tip]['hash']
+        if method == 'getblockhash':
+            if not 0 <= params[0] <= self.tip:
+                raise _RpcError(-8, "Block height out of range")
+            return blocks[params[0]]['hash']
+        if method == 'getblock':
+            if params[0] not in self._hash_to_block:
+                raise _RpcError(-5, "Block not found")
+            return self._hash_to_block[params[0]]
+        if method == 'getrawtransaction':
+            if params[0] not in self._chain.transactions:
+                raise _RpcError(-5, "No such mempool or blockchain transaction")
+            return self._chain.transactions[params[0]]
+        raise _RpcError(-32601, "Method not found")
+
+    def set_tip(self, height):
+        """Rende visibili i blocchi fino all'altezza height (gli altri "non ancora minati")."""
+        with self._lock:
+            self.tip = min(height, len(self._blocks) - 1)
+
+    def reorg(self, depth, salt='reorg'):
+        """
+        Sostituisce gli ultimi depth blocchi visibili con blocchi di hash
+        diverso che contengono le stesse transazioni, come una riorganizzazione
+        in cui i blocchi orfani vengono minati di nuovo.
+        """
+        with self._lock:
+            for height in range(max(0, self.tip - depth + 1), self.tip + 1):
+                block = dict(self._blocks[height])
+                block['hash'] = hashlib.sha256(f"{block['hash']}:{salt}".encode()).hexdigest()
+                self._blocks[height] = block
+                self._hash_to_block[block['hash']] = block
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def reset_stats(self):
+        with self._lock:
+            self.requests = 0
+            self.calls = Counter()
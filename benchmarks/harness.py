@@ -0,0 +1,302 @@
+"""
+Benchmark riproducibile di ETL e analisi su una catena sintetica.
+
+    python -m benchmarks.harness --blocks 200 --txs-per-block 50
+    python -m benchmarks.harness --neo4j --clear-neo4j   # Neo4j di config.py
+    python -m benchmarks.harness --neo4j --clear-neo4j --check-fresh-load
+
+L'ETL (process_block) legge i blocchi dal server RPC locale e scrive su un
+sostituto in memoria di Neo4j oppure, con --neo4j, sul database configurato.
+Il report (JSON) contiene blocchi/s, transazioni/s, chiamate RPC e round
+trip Neo4j per blocco, la latenza di ogni analisi e il numero di peeling
+chain generate che le analisi non ricostruiscono esattamente (deve essere 0). Con --check-fresh-load la
+catena viene caricata una seconda volta con le query idempotenti e il grafo
+viene confrontato con quello del caricamento fresco (CREATE).
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import subprocess
+import tempfile
+import time
+from datetime import datetime, timezone
+
+import config
+import metrics
+from connectors.bitcoin_connector import BitcoinConnector
+from etl.parser import process_block
+from etl.prevout_store import PrevoutStore
+from analysis import fan_analysis, peel_chain_analysis, dormant_funds_analysis, self_change_peel_analysis
+from analysis.memory_graph import MemoryGraphBuilder, apply_common_input_ownership
+from analysis.chain_builder import build_successor_map, reconstruct_chains, resolve_txids
+from analysis.queries import (
+    get_graph_fingerprint_query,
+    get_peel_links_with_successors_feature_query,
+    get_self_change_peel_link_feature_query
+)
+from .synthetic_chain import SyntheticChain
+from .fake_rpc import FakeBitcoinRpcServer
+
+ANALYSES = {
+    'fan': fan_analysis.run,
+    'peel-sc': self_change_peel_analysis.run,
+    'peel-heuristic': peel_chain_analysis.run,
+    'dormant': dormant_funds_analysis.run,
+}
+
+class InProcessNeo4j:
+    """
+    Sostituto di Neo4jConnector per l'ETL: conta transazioni e query e
+    ricostruisce il grafo scritto in un MemoryGraphBuilder, su cui vengono
+    poi eseguite le analisi.
+    """
+    def __init__(self):
+        self.builder = MemoryGraphBuilder()
+        self.round_trips = 0
+        self.statements = 0
+
+    def execute_write(self, statements):
+        self.round_trips += 1
+        self.statements += len(statements)
+        for _, parameters in statements:
+            for row in parameters.get('transactions', []):
+                self.builder.add_transaction(row['tx_id'], parameters['block_height'])
+            for row in parameters.get('outputs', []):
+                self.builder.add_received(row['tx_id'], row['addr'], row['val'], row['vout'])
+            for row in parameters.get('inputs', []):
+                self.builder.add_sent(row['addr'], row['tx_id'], row['val'], row['age'], row['vin'])
+        return len(statements)
+
+    def close(self):
+        pass
+
+class CountingNeo4j:
+    """Inoltra le chiamate a un Neo4jConnector contando transazioni e query di scrittura."""
+    def __init__(self, connector):
+        self._connector = connector
+        self.round_trips = 0
+        self.statements = 0
+
+    def execute_write(self, statements):
+        self.round_trips += 1
+        self.statements += len(statements)
+        return self._connector.execute_write(statements)
+
+    def __getattr__(self, name):
+        return getattr(self._connector, name)
+
+def _git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout.strip()
+    except Exception:
+        return None
+
+def _quiet():
+    """Scarta l'output dei moduli misurati, che altrimenti peserebbe sui tempi."""
+    return contextlib.redirect_stdout(io.StringIO())
+
+def run_etl_benchmark(chain, rpc_server, neo4j, workdir, fresh=False):
+    btc_connector = BitcoinConnector('bench', 'bench', rpc_server.host, rpc_server.port, config.RPC_BATCH_SIZE)
+    prevout_store = PrevoutStore(os.path.join(workdir, 'prevouts.sqlite'), config.PREVOUT_CACHE_SIZE)
+    rpc_server.reset_stats()
+
+    failed = 0
+    started = time.perf_counter()
+    with _quiet():
+        for block in chain.blocks:
+            if not process_block(block['height'], btc_connector, neo4j, config.ETL_TX_CHUNK_SIZE, prevout_store,
+                                 fresh=fresh):
+                failed += 1
+    elapsed = time.perf_counter() - started
+    prevout_store.close()
+
+    blocks = len(chain.blocks)
+    transactions = sum(len(block['tx']) for block in chain.blocks)
+    return {
+        'blocks': blocks,
+        'transactions': transactions,
+        'failed_blocks': failed,
+        'elapsed_s': elapsed,
+        'blocks_per_s': blocks / elapsed,
+        'tx_per_s': transactions / elapsed,
+        'rpc_requests_per_block': rpc_server.requests / blocks,
+        'rpc_calls_per_block': {method: count / blocks for method, count in sorted(rpc_server.calls.items())},
+        'neo4j_round_trips_per_block': neo4j.round_trips / blocks,
+        'neo4j_statements_per_block': neo4j.statements / blocks,
+    }
+
+def graph_fingerprint(neo4j_connector):
+    """{tid: righe di get_graph_fingerprint_query} con le liste ordinate, confrontabili tra due caricamenti."""
+    def normalized(items):
+        return sorted(items, key=lambda item: json.dumps(item, sort_keys=True, default=str))
+    return {
+        record['tid']: (record['properties'], normalized(record['blocks']),
+                        normalized(record['received']), normalized(record['sent']))
+        for record in neo4j_connector.stream_query(get_graph_fingerprint_query())
+    }
+
+def check_fresh_load(chain, rpc_server, neo4j_connector, workdir):
+    """
+    Ricarica la catena con le query idempotenti (MERGE) in un database
+    svuotato e la confronta con il grafo del caricamento fresco appena
+    eseguito. Restituisce il numero di transazioni diverse.
+    """
+    from etl.schema import ensure_schema
+    from analysis.queries import get_clear_database_query
+    fresh_rows = graph_fingerprint(neo4j_connector)
+    neo4j_connector.execute_query(get_clear_database_query())
+    ensure_schema(neo4j_connector)
+    run_etl_benchmark(chain, rpc_server, CountingNeo4j(neo4j_connector), workdir)
+    merge_rows = graph_fingerprint(neo4j_connector)
+    return sum(fresh_rows.get(tid) != merge_rows.get(tid) for tid in fresh_rows.keys() | merge_rows.keys())
+
+def check_peel_chains(chain, neo4j_conn=None, graph=None):
+    """
+    Verifica di regressione delle peeling chain: ogni catena generata deve
+    essere ricostruita per intero e nell'ordine giusto, anche quando il resto
+    torna sempre allo stesso indirizzo (self-change), il cui riuso rende
+    candidate come successori anche le spese precedenti.
+    Restituisce {analisi: catene attese non ricostruite}.
+    """
+    sources = {
+        'peel-sc': (lambda: graph.self_change_links()) if graph is not None else
+                   (lambda: neo4j_conn.stream_query(get_self_change_peel_link_feature_query())),
+        'peel-heuristic': (lambda: graph.peel_links(peel_ratio=0.2, min_input_value=0.01)) if graph is not None else
+                          (lambda: neo4j_conn.stream_query(get_peel_links_with_successors_feature_query(),
+                                                           parameters={'peel_ratio': 0.2, 'min_input_value': 0.01})),
+    }
+    expected = {
+        'peel-sc': [tuple(txids) for txids, self_change in chain.peel_chains if self_change],
+        'peel-heuristic': [tuple(txids) for txids, _ in chain.peel_chains],
+    }
+    missing = {}
+    for name, links in sources.items():
+        tids, successors = build_successor_map(links())
+        chains = reconstruct_chains(tids, successors, min_chain_length=2)
+        txids = resolve_txids(neo4j_conn, chains, graph)
+        found = {tuple(txids[tid] for tid in found_chain) for found_chain in chains}
+        missing[name] = sum(txid_chain not in found for txid_chain in expected[name])
+    return missing
+
+def run_analysis_benchmark(neo4j_conn=None, graph=None, workdir=None):
+    """Latenza (secondi) del clustering e di ogni analisi, eseguiti in sequenza."""
+    latencies = {}
+    started = time.perf_counter()
+    with _quiet():
+        if graph is not None:
+            apply_common_input_ownership(graph)
+        else:
+            from etl.clustering import apply_common_input_ownership as apply_on_neo4j
+            apply_on_neo4j(neo4j_conn, state_path=os.path.join(workdir, 'clusters.pickle'))
+    latencies['clustering'] = time.perf_counter() - started
+
+    for name, run in ANALYSES.items():
+        started = time.perf_counter()
+        run(neo4j_conn, out=lambda *args, **kwargs: None, graph=graph)
+        latencies[name] = time.perf_counter() - started
+    return latencies
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark di ETL e analisi su una catena sintetica")
+    parser.add_argument('--blocks', type=int, default=100, help="Numero di blocchi (default: 100).")
+    parser.add_argument('--txs-per-block', type=int, default=50, help="Transazioni per blocco (default: 50).")
+    parser.add_argument('--seed', type=int, default=42, help="Seed del generatore (default: 42).")
+    parser.add_argument('--peel-chains', type=int, default=5, help="Peeling chain generate (default: 5).")
+    parser.add_argument('--dormant-coins', type=int, default=20, help="Monete dormienti (default: 20).")
+    parser.add_argument('--neo4j', action='store_true', help="Scrive e analizza sul Neo4j configurato.")
+    parser.add_argument('--clear-neo4j', action='store_true',
+                        help="Con --neo4j: cancella TUTTO il database prima del benchmark.")
+    parser.add_argument('--fresh-load', action='store_true',
+                        help="Scrive i blocchi con le query di caricamento fresco (CREATE).")
+    parser.add_argument('--check-fresh-load', action='store_true',
+                        help="Con --neo4j --clear-neo4j: confronta il caricamento fresco con quello idempotente.")
+    parser.add_argument('--output', help="File del report JSON (default: benchmarks/results/<data>.json).")
+    args = parser.parse_args()
+    if args.check_fresh_load:
+        if not (args.neo4j and args.clear_neo4j):
+            parser.error("--check-fresh-load richiede --neo4j e --clear-neo4j.")
+        args.fresh_load = True
+
+    parameters = {
+        'blocks': args.blocks, 'txs_per_block': args.txs_per_block, 'seed': args.seed,
+        'peel_chains': args.peel_chains, 'dormant_coins': args.dormant_coins,
+        'backend': 'neo4j' if args.neo4j else 'memory',
+        'rpc_batch_size': config.RPC_BATCH_SIZE, 'tx_chunk_size': config.ETL_TX_CHUNK_SIZE,
+        'fresh_load': args.fresh_load,
+    }
+
+    print(f"Generazione della catena sintetica ({args.blocks} blocchi)...")
+    started = time.perf_counter()
+    chain = SyntheticChain(blocks=args.blocks, txs_per_block=args.txs_per_block, seed=args.seed,
+                           peel_chains=args.peel_chains, dormant_coins=args.dormant_coins)
+    generation_s = time.perf_counter() - started
+
+    rpc_server = FakeBitcoinRpcServer(chain).start()
+    neo4j_connector = None
+    try:
+        with tempfile.TemporaryDirectory() as workdir:
+            if args.neo4j:
+                from connectors.neo4j_connector import Neo4jConnector
+                from etl.schema import ensure_schema
+                from analysis.queries import get_clear_database_query
+                neo4j_connector = Neo4jConnector(config.NEO4J_URI, config.NEO4J_USER, config.NEO4J_PASS)
+                if args.clear_neo4j:
+                    neo4j_connector.execute_query(get_clear_database_query())
+                ensure_schema(neo4j_connector)
+                neo4j = CountingNeo4j(neo4j_connector)
+            else:
+                neo4j = InProcessNeo4j()
+
+            print("Benchmark ETL...")
+            etl = run_etl_benchmark(chain, rpc_server, neo4j, workdir, fresh=args.fresh_load)
+            print("Benchmark analisi...")
+            if args.neo4j:
+                analyses = run_analysis_benchmark(neo4j_conn=neo4j_connector, workdir=workdir)
+                peel_check = check_peel_chains(chain, neo4j_conn=neo4j_connector)
+            else:
+                graph = neo4j.builder.build()
+                analyses = run_analysis_benchmark(graph=graph)
+                peel_check = check_peel_chains(chain, graph=graph)
+            if args.check_fresh_load:
+                print("Confronto con il caricamento idempotente...")
+                etl['fresh_load_mismatches'] = check_fresh_load(chain, rpc_server, neo4j_connector, workdir)
+    finally:
+        rpc_server.stop()
+        if neo4j_connector is not None:
+            neo4j_connector.close()
+
+    report = {
+        'timestamp': datetime.now(timezone.utc).isoformat(),
+        'git_commit': _git_commit(),
+        'parameters': parameters,
+        'chain': dict(chain.stats(), generation_s=generation_s),
+        'etl': etl,
+        'analysis_latency_s': analyses,
+        'peel_chains_not_reconstructed': peel_check,
+        'metrics': metrics.REGISTRY.snapshot(),
+    }
+
+    output = args.output or os.path.join(
+        'benchmarks', 'results', datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%SZ') + '.json'
+    )
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    print(f"\nETL: {etl['blocks_per_s']:.1f} blocchi/s, {etl['tx_per_s']:.1f} tx/s, "
+          f"{etl['rpc_requests_per_block']:.2f} richieste RPC e "
+          f"{etl['neo4j_round_trips_per_block']:.2f} round trip Neo4j per blocco.")
+    for name, seconds in analyses.items():
+        print(f"  {name}: {seconds * 1000:.1f} ms")
+    print(f"Peeling chain generate non ricostruite: {peel_check} (su {len(chain.peel_chains)}).")
+    if args.check_fresh_load:
+        print(f"Caricamento fresco: {etl['fresh_load_mismatches']} transazioni diverse dal caricamento idempotente.")
+    print(f"Report salvato in {output}")
+
+if __name__ == "__main__":
+    main()
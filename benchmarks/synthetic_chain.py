@@ -0,0 +1,152 @@
+"""
+Generatore deterministico di una blockchain sintetica per i benchmark.
+I blocchi hanno la stessa struttura di getblock con verbosity 2 e
+contengono, oltre a transazioni ordinarie, pattern fan-out/fan-in, peeling
+chain (con resto su un nuovo indirizzo o sull'indirizzo di input) e monete
+dormienti spese dopo un salto temporale di alcuni anni.
+"""
+import hashlib
+import random
+
+COIN = 100_000_000     # satoshi per BTC
+FEE = 1_000            # fee fissa in satoshi
+MIN_SPENDABLE = 100 * FEE  # gli output più piccoli non vengono più spesi
+
+def _hash(*parts):
+    return hashlib.sha256(':'.join(str(part) for part in parts).encode()).hexdigest()
+
+class SyntheticChain:
+    """
+    Catena sintetica generata interamente in __init__: a parità di parametri
+    e di seed i blocchi (txid, indirizzi e valori) sono identici.
+    """
+    def __init__(self, blocks=100, txs_per_block=50, seed=42, fan_ratio=0.05, peel_chains=5,
+                 peel_length=10, self_change_ratio=0.5, dormant_coins=20, dormant_gap_days=6 * 365,
+                 start_time=1_500_000_000, block_interval=600):
+        self._random = random.Random(seed)
+        self._seed = seed
+        self._address_count = 0
+        self._utxos = []        # (txid, vout, indirizzo, valore in satoshi)
+        self._dormant = []      # UTXO riservati, spesi solo dopo il salto temporale
+        self._peels = []        # [UTXO di resto, passi rimanenti, self-change, txid della catena]
+        self.blocks = []
+        self.peel_chains = []   # (txid della catena in ordine, self-change): risultato atteso delle analisi
+        self.transactions = {}  # txid -> transazione (con il campo time, come getrawtransaction)
+
+        # Le monete dormienti vengono spese nell'ultimo decimo della catena,
+        # dopo un salto di dormant_gap_days giorni.
+        dormant_spend_height = max(1, blocks - max(1, blocks // 10))
+        for height in range(blocks):
+            timestamp = start_time + height * block_interval
+            if height >= dormant_spend_height:
+                timestamp += dormant_gap_days * 86400
+            self._build_block(height, timestamp, txs_per_block, fan_ratio, dormant_coins,
+                              height >= dormant_spend_height, peel_chains, peel_length, self_change_ratio)
+
+    # --- Primitive ---
+    def _new_address(self):
+        self._address_count += 1
+        return 'bcrt1q' + _hash(self._seed, 'address', self._address_count)[:38]
+
+    def _add_utxos(self, utxos):
+        self._utxos.extend(utxo for utxo in utxos if utxo[3] >= MIN_SPENDABLE)
+
+    def _take_utxo(self):
+        """Estrae un UTXO casuale (scambio con l'ultimo elemento: O(1))."""
+        index = self._random.randrange(len(self._utxos))
+        self._utxos[index], self._utxos[-1] = self._utxos[-1], self._utxos[index]
+        return self._utxos.pop()
+
+    def _make_tx(self, block, inputs, outputs, coinbase=False):
+        """inputs: UTXO spesi; outputs: [(indirizzo, satoshi)]. Restituisce i nuovi UTXO."""
+        txid = _hash(self._seed, 'tx', block['height'], len(block['tx']))
+        if coinbase:
+            vin = [{'coinbase': f"{block['height']:08x}", 'sequence': 0xffffffff}]
+        else:
+            vin = [{'txid': utxo[0], 'vout': utxo[1]} for utxo in inputs]
+        vout = [
+            {'value': value / COIN, 'n': n, 'scriptPubKey': {'address': address}}
+            for n, (address, value) in enumerate(outputs)
+        ]
+        tx = {'txid': txid, 'vin': vin, 'vout': vout}
+        block['tx'].append(tx)
+        self.transactions[txid] = dict(tx, time=block['time'], blocktime=block['time'])
+        return [(txid, n, address, value) for n, (address, value) in enumerate(outputs)]
+
+    def _split(self, total, parts):
+        """Divide total satoshi in parts output casuali (tutti positivi)."""
+        cuts = sorted(self._random.sample(range(1, total), parts - 1)) if parts > 1 else []
+        bounds = [0] + cuts + [total]
+        return [bounds[i + 1] - bounds[i] for i in range(parts)]
+
+    # --- Pattern ---
+    def _regular_tx(self, block):
+        inputs = [self._take_utxo() for _ in range(min(len(self._utxos), self._random.choice((1, 1, 2))))]
+        total = sum(utxo[3] for utxo in inputs) - FEE
+        payment = max(1, int(total * self._random.uniform(0.1, 0.9)))
+        outputs = [(self._new_address(), payment), (self._new_address(), total - payment)]
+        self._add_utxos(self._make_tx(block, inputs, outputs))
+
+    def _fan_out_tx(self, block):
+        inputs = [self._take_utxo()]
+        parts = self._random.randint(10, 20)
+        outputs = [(self._new_address(), value) for value in self._split(inputs[0][3] - FEE, parts)]
+        self._add_utxos(self._make_tx(block, inputs, outputs))
+
+    def _fan_in_tx(self, block):
+        inputs = [self._take_utxo() for _ in range(min(len(self._utxos), self._random.randint(10, 15)))]
+        outputs = [(self._new_address(), sum(utxo[3] for utxo in inputs) - FEE)]
+        self._add_utxos(self._make_tx(block, inputs, outputs))
+
+    def _peel_step(self, block, peel):
+        utxo, remaining, self_change, txids = peel
+        total = utxo[3] - FEE
+        peeled = max(1, int(total * self._random.uniform(0.01, 0.1)))
+        change_address = utxo[2] if self_change else self._new_address()
+        created = self._make_tx(block, [utxo], [(self._new_address(), peeled), (change_address, total - peeled)])
+        self._add_utxos(created[:1])
+        txids.append(created[1][0])
+        peel[0], peel[1] = created[1], remaining - 1
+
+    def _build_block(self, height, timestamp, txs_per_block, fan_ratio, dormant_coins, spend_dormant,
+                     peel_chains, peel_length, self_change_ratio):
+        block = {'hash': _hash(self._seed, 'block', height), 'height': height, 'time': timestamp, 'tx': []}
+
+        # Coinbase: i primi blocchi finanziano le monete dormienti e le peeling chain
+        coinbase_address = self._new_address()
+        coinbase = self._make_tx(block, [], [(coinbase_address, 50 * COIN)], coinbase=True)[0]
+        if len(self._dormant) < dormant_coins and not spend_dormant:
+            self._dormant.append(coinbase)
+        elif height and len(self._peels) < peel_chains:
+            peel = [coinbase, peel_length, self._random.random() < self_change_ratio, []]
+            self._peels.append(peel)
+            self.peel_chains.append((peel[3], peel[2]))
+        else:
+            self._utxos.append(coinbase)
+
+        for peel in [peel for peel in self._peels if peel[1] > 0]:
+            self._peel_step(block, peel)
+
+        if spend_dormant and self._dormant:
+            for _ in range(min(len(self._dormant), max(1, dormant_coins // 5))):
+                dormant = self._dormant.pop()
+                outputs = [(self._new_address(), dormant[3] - FEE)]
+                self._add_utxos(self._make_tx(block, [dormant], outputs))
+
+        while len(block['tx']) < txs_per_block and self._utxos:
+            roll = self._random.random()
+            if roll < fan_ratio:
+                self._fan_out_tx(block)
+            elif roll < 2 * fan_ratio and len(self._utxos) >= 10:
+                self._fan_in_tx(block)
+            else:
+                self._regular_tx(block)
+
+        self.blocks.append(block)
+
+    def stats(self):
+        return {
+            'blocks': len(self.blocks),
+            'transactions': len(self.transactions),
+            'addresses': self._address_count
+        }
@@ -9,7 +9,116 @@ RPC_USER = os.getenv("RPC_USER")
 RPC_PASS = os.getenv("RPC_PASS")
 RPC_HOST = os.getenv("RPC_HOST")
 RPC_PORT = os.getenv("RPC_PORT")
+# Numero massimo di chiamate per richiesta batch JSON-RPC
+RPC_BATCH_SIZE = int(os.getenv("RPC_BATCH_SIZE", "100"))
+
+# Sorgente dei blocchi per l'ETL ('rpc' oppure 'blk') e, per 'blk', la cartella
+# blocks/ di Bitcoin Core e la rete ('main', 'test', 'testnet4', 'signet', 'regtest')
+BLOCK_SOURCE = os.getenv("BLOCK_SOURCE", "rpc")
+BLOCKS_DIR = os.getenv("BLOCKS_DIR")
+BITCOIN_NETWORK = os.getenv("BITCOIN_NETWORK", "main")
+# File blk*.dat mappati in memoria contemporaneamente (ognuno tiene aperto un descrittore)
+BLK_MAX_OPEN_FILES = int(os.getenv("BLK_MAX_OPEN_FILES", "16"))
 
 NEO4J_URI = os.getenv("NEO4J_URI")
 NEO4J_USER = os.getenv("NEO4J_USER")
-NEO4J_PASS = os.getenv("NEO4J_PASS")
\ No newline at end of file
+NEO4J_PASS = os.getenv("NEO4J_PASS")
+
+# Numero massimo di transazioni scritte in una singola transazione Neo4j
+# durante l'ETL (0 = l'intero blocco in una sola transazione).
+ETL_TX_CHUNK_SIZE = int(os.getenv("ETL_TX_CHUNK_SIZE", "1000"))
+
+# Caricamento fresco: i blocchi oltre l'ultimo già presente nel grafo vengono
+# scritti con CREATE invece di MERGE (solo gli Address restano con MERGE).
+ETL_FRESH_LOAD = os.getenv("ETL_FRESH_LOAD", "true").lower() in ("1", "true", "yes")
+
+# Indice locale dei prevout (file SQLite) usato per risolvere gli input senza
+# getrawtransaction. Lasciare vuoto per disabilitarlo.
+PREVOUT_DB_PATH = os.getenv("PREVOUT_DB_PATH", "prevouts.sqlite")
+PREVOUT_CACHE_SIZE = int(os.getenv("PREVOUT_CACHE_SIZE", "200000"))
+
+# Pipeline ETL: blocchi scaricati in anticipo e numero di thread di download
+ETL_PREFETCH_DEPTH = int(os.getenv("ETL_PREFETCH_DEPTH", "8"))
+ETL_FETCH_WORKERS = int(os.getenv("ETL_FETCH_WORKERS", "2"))
+
+# ETL multi-processo: tentativi per shard fallito e tempo massimo (secondi)
+# concesso al driver per ritentare una transazione in deadlock
+ETL_SHARD_RETRIES = int(os.getenv("ETL_SHARD_RETRIES", "2"))
+NEO4J_MAX_RETRY_TIME = float(os.getenv("NEO4J_MAX_RETRY_TIME", "60"))
+
+# Esportazione CSV per neo4j-admin: cartella di destinazione e numero di
+# indirizzi ricordati per la deduplicazione (memoria costante per shard)
+EXPORT_DIR = os.getenv("EXPORT_DIR", "export")
+EXPORT_DEDUP_CACHE_SIZE = int(os.getenv("EXPORT_DEDUP_CACHE_SIZE", "1000000"))
+
+# Clustering common-input-ownership: file di stato dell'union-find, blocchi
+# letti per pagina e indirizzi aggiornati per transazione di scrittura
+CLUSTER_STATE_PATH = os.getenv("CLUSTER_STATE_PATH", "clusters.pickle")
+CLUSTER_PAGE_BLOCKS = int(os.getenv("CLUSTER_PAGE_BLOCKS", "100"))
+CLUSTER_WRITE_BATCH_SIZE = int(os.getenv("CLUSTER_WRITE_BATCH_SIZE", "5000"))
+
+# Migrazione delle feature delle transazioni: blocchi aggiornati per transazione di scrittura
+MIGRATION_BATCH_BLOCKS = int(os.getenv("MIGRATION_BATCH_BLOCKS", "100"))
+
+# Lettura dei risultati in streaming: record richiesti al server per volta,
+# timeout delle query di lettura in secondi (0 = nessun limite) e righe per
+# pagina nelle analisi paginate sull'intero grafo
+NEO4J_FETCH_SIZE = int(os.getenv("NEO4J_FETCH_SIZE", "1000"))
+NEO4J_QUERY_TIMEOUT = float(os.getenv("NEO4J_QUERY_TIMEOUT", "0"))
+ANALYSIS_PAGE_SIZE = int(os.getenv("ANALYSIS_PAGE_SIZE", "10000"))
+
+# Analisi concorrenti: numero massimo di analisi eseguite in parallelo e
+# dimensione del pool di connessioni del driver Neo4j (condiviso dai thread)
+ANALYSIS_WORKERS = int(os.getenv("ANALYSIS_WORKERS", "4"))
+NEO4J_MAX_POOL_SIZE = int(os.getenv("NEO4J_MAX_POOL_SIZE", "100"))
+
+# Analisi per finestre di altezze: blocchi per finestra (0 = una sola query
+# sull'intero grafo) e finestre lette in parallelo da ciascuna analisi
+ANALYSIS_WINDOW_SIZE = int(os.getenv("ANALYSIS_WINDOW_SIZE", "10000"))
+ANALYSIS_WINDOW_WORKERS = int(os.getenv("ANALYSIS_WINDOW_WORKERS", "4"))
+
+# Metriche: porta dell'endpoint Prometheus /metrics (0 = disattivato), file
+# JSON aggiornato ogni METRICS_INTERVAL secondi (vuoto = disattivato) e
+# intervallo in secondi tra due stampe dell'avanzamento dell'ETL
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+METRICS_FILE = os.getenv("METRICS_FILE", "")
+METRICS_INTERVAL = float(os.getenv("METRICS_INTERVAL", "10"))
+ETL_PROGRESS_INTERVAL = float(os.getenv("ETL_PROGRESS_INTERVAL", "5"))
+
+# Profilazione cProfile dell'ETL: cartella dei dump (vuoto = disattivata) e
+# blocchi coperti da ciascun dump
+PROFILE_DIR = os.getenv("PROFILE_DIR", "")
+PROFILE_BLOCKS = int(os.getenv("PROFILE_BLOCKS", "1000"))
+
+# Cache dei risultati delle analisi: cartella (vuoto = disattivata) e
+# dimensione massima in MB oltre la quale le voci meno usate vengono eliminate
+ANALYSIS_CACHE_DIR = os.getenv("ANALYSIS_CACHE_DIR", "analysis_cache")
+ANALYSIS_CACHE_MAX_MB = int(os.getenv("ANALYSIS_CACHE_MAX_MB", "256"))
+
+# Output delle analisi: 'console' (testo), 'jsonl' o 'parquet' (file per
+# tabella nella cartella ANALYSIS_OUTPUT_DIR) e record scritti per blocco
+ANALYSIS_OUTPUT_FORMAT = os.getenv("ANALYSIS_OUTPUT_FORMAT", "console")
+ANALYSIS_OUTPUT_DIR = os.getenv("ANALYSIS_OUTPUT_DIR", "results")
+ANALYSIS_SINK_BATCH_SIZE = int(os.getenv("ANALYSIS_SINK_BATCH_SIZE", "10000"))
+
+# Registro degli id compatti (file SQLite) che rileva le collisioni tra gli id
+# interi di txid e indirizzi. Lasciare vuoto per disabilitarlo.
+ID_REGISTRY_PATH = os.getenv("ID_REGISTRY_PATH", "ids.sqlite")
+ID_REGISTRY_CACHE_SIZE = int(os.getenv("ID_REGISTRY_CACHE_SIZE", "500000"))
+
+# Modalità follow (--action follow): secondi tra due controlli del tip,
+# profondità massima delle riorganizzazioni gestite con il rollback ed
+# endpoint ZMQ hashblock del nodo (es. tcp://127.0.0.1:28332, richiede pyzmq).
+# Lasciare vuoto l'endpoint per il solo polling.
+FOLLOW_POLL_INTERVAL = float(os.getenv("FOLLOW_POLL_INTERVAL", "1.0"))
+FOLLOW_MAX_REORG_DEPTH = int(os.getenv("FOLLOW_MAX_REORG_DEPTH", "100"))
+FOLLOW_ZMQ_ENDPOINT = os.getenv("FOLLOW_ZMQ_ENDPOINT", "")
+
+# Tracciamento dei fondi (--type trace): livelli visitati, archi seguiti per
+# nodo, valore minimo degli archi (BTC), transazioni massime per livello e
+# nodi della frontiera per query
+TRACE_MAX_DEPTH = int(os.getenv("TRACE_MAX_DEPTH", "5"))
+TRACE_MAX_FANOUT = int(os.getenv("TRACE_MAX_FANOUT", "20"))
+TRACE_MIN_VALUE = float(os.getenv("TRACE_MIN_VALUE", "0"))
+TRACE_MAX_FRONTIER = int(os.getenv("TRACE_MAX_FRONTIER", "100000"))
+TRACE_BATCH_SIZE = int(os.getenv("TRACE_BATCH_SIZE", "5000"))
@@ -1,8 +1,13 @@
 from bitcoinrpc.authproxy import AuthServiceProxy
 
-class BitcoinConnector:
-    def __init__(self, user, password, host, port):
+import metrics
+from .block_source import BlockSource
+
+class BitcoinConnector(BlockSource):
+    def __init__(self, user, password, host, port, max_batch_size=100):
         self.rpc_url = f"http://{user}:{password}@{host}:{port}"
+        # Numero massimo di chiamate inviate in una singola richiesta batch JSON-RPC
+        self.max_batch_size = max(1, max_batch_size)
         try:
             self.rpc = AuthServiceProxy(self.rpc_url, timeout=120)
             self.rpc.getblockcount() # Test della connessione
@@ -11,11 +16,57 @@ class BitcoinConnector:
             print(f"Errore di connessione al nodo Bitcoin: {e}")
             raise
 
+    def get_block_count(self):
+        """Restituisce l'altezza del blocco più recente (tip) del nodo."""
+        return self.rpc.getblockcount()
+
+    def get_best_block_hash(self):
+        """Restituisce l'hash del blocco più recente (tip) del nodo."""
+        return self.rpc.getbestblockhash()
+
     def get_block_by_height(self, height):
         """Recupera un intero blocco data l'altezza."""
-        block_hash = self.rpc.getblockhash(height)
-        return self.rpc.getblock(block_hash, 2) # Verbosity 2
+        with metrics.timer('rpc_get_block'):
+            block_hash = self.rpc.getblockhash(height)
+            block = self.rpc.getblock(block_hash, 2) # Verbosity 2
+        metrics.inc('rpc_requests', 2)
+        metrics.inc('rpc_calls', 2)
+        return block
 
     def get_transaction(self, txid):
         """Recupera una singola transazione dato il suo txid."""
         return self.rpc.getrawtransaction(txid, True) # Verbose
+
+    def _batch(self, calls):
+        """
+        Esegue una lista di chiamate [metodo, parametri...] tramite richieste
+        batch JSON-RPC di al più max_batch_size elementi. I risultati sono
+        restituiti nello stesso ordine delle chiamate.
+        """
+        results = []
+        for start in range(0, len(calls), self.max_batch_size):
+            # batch_ consuma le liste che riceve: passiamo delle copie
+            chunk = [list(call) for call in calls[start:start + self.max_batch_size]]
+            with metrics.timer('rpc_batch'):
+                results.extend(self.rpc.batch_(chunk))
+            metrics.inc('rpc_requests')
+            metrics.inc('rpc_calls', len(chunk))
+        return results
+
+    def get_block_hashes(self, heights):
+        """Recupera in batch gli hash dei blocchi alle altezze indicate."""
+        return self._batch([["getblockhash", height] for height in heights])
+
+    def get_blocks_by_height(self, heights):
+        """Recupera in batch più blocchi completi (verbosity 2) date le altezze."""
+        block_hashes = self.get_block_hashes(heights)
+        return self._batch([["getblock", block_hash, 2] for block_hash in block_hashes])
+
+    def get_transactions(self, txids):
+        """
+        Recupera in batch più transazioni. Restituisce un dizionario
+        {txid: transazione} senza duplicati.
+        """
+        unique_txids = list(dict.fromkeys(txids))
+        results = self._batch([["getrawtransaction", txid, True] for txid in unique_txids])
+        return dict(zip(unique_txids, results))
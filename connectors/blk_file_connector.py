@@ -0,0 +1,314 @@
+import glob
+import hashlib
+import mmap
+import os
+import threading
+from collections import OrderedDict
+
+from .block_source import BlockSource
+
+# Parametri di rete: magic dei file blk*.dat, prefissi base58 e hrp bech32
+NETWORKS = {
+    'main': {'magic': bytes.fromhex('f9beb4d9'), 'p2pkh': 0x00, 'p2sh': 0x05, 'hrp': 'bc'},
+    'test': {'magic': bytes.fromhex('0b110907'), 'p2pkh': 0x6f, 'p2sh': 0xc4, 'hrp': 'tb'},
+    'testnet4': {'magic': bytes.fromhex('1c163f28'), 'p2pkh': 0x6f, 'p2sh': 0xc4, 'hrp': 'tb'},
+    'signet': {'magic': bytes.fromhex('0a03cf40'), 'p2pkh': 0x6f, 'p2sh': 0xc4, 'hrp': 'tb'},
+    'regtest': {'magic': bytes.fromhex('fabfb5da'), 'p2pkh': 0x6f, 'p2sh': 0xc4, 'hrp': 'bcrt'},
+}
+
+_B58_ALPHABET = '123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz'
+_BECH32_CHARSET = 'qpzry9x8gf2tvdw0s3jn54khce6mua7l'
+_BECH32_GENERATOR = (0x3b6a57b2, 0x26508e6d, 0x1ea119fa, 0x3d4233dd, 0x2a1462b3)
+_BECH32M_CONST = 0x2bc830a3
+_NULL_HASH = bytes(32)
+
+# L'indice dei file (costoso da costruire) è condiviso tra tutte le istanze
+# dello stesso processo, ad es. tra i thread del pipeline di prefetch.
+# Contiene solo percorsi e offset: nessun file resta aperto.
+_INDEX_CACHE = {}
+_INDEX_LOCK = threading.Lock()
+
+def _sha256d(data):
+    return hashlib.sha256(hashlib.sha256(data).digest()).digest()
+
+def _read_varint(buf, pos):
+    """Legge un CompactSize a partire da pos. Restituisce (valore, nuova posizione)."""
+    first = buf[pos]
+    if first < 0xfd:
+        return first, pos + 1
+    size = {0xfd: 2, 0xfe: 4, 0xff: 8}[first]
+    return int.from_bytes(buf[pos + 1:pos + 1 + size], 'little'), pos + 1 + size
+
+# --- Codifica degli indirizzi ---
+def _base58check(payload):
+    data = payload + _sha256d(payload)[:4]
+    number = int.from_bytes(data, 'big')
+    chars = []
+    while number:
+        number, remainder = divmod(number, 58)
+        chars.append(_B58_ALPHABET[remainder])
+    padding = len(data) - len(data.lstrip(b'\0'))
+    return '1' * padding + ''.join(reversed(chars))
+
+def _bech32_polymod(values):
+    checksum = 1
+    for value in values:
+        top = checksum >> 25
+        checksum = (checksum & 0x1ffffff) << 5 ^ value
+        for i in range(5):
+            if (top >> i) & 1:
+                checksum ^= _BECH32_GENERATOR[i]
+    return checksum
+
+def _convert_bits(data, from_bits, to_bits):
+    accumulator, bits, result = 0, 0, []
+    max_value = (1 << to_bits) - 1
+    for value in data:
+        accumulator = (accumulator << from_bits) | value
+        bits += from_bits
+        while bits >= to_bits:
+            bits -= to_bits
+            result.append((accumulator >> bits) & max_value)
+    if bits:
+        result.append((accumulator << (to_bits - bits)) & max_value)
+    return result
+
+def _segwit_address(hrp, version, program):
+    """Indirizzo bech32 (versione 0) o bech32m (versione >= 1), BIP173/BIP350."""
+    data = [version] + _convert_bits(program, 8, 5)
+    hrp_expanded = [ord(c) >> 5 for c in hrp] + [0] + [ord(c) & 31 for c in hrp]
+    constant = 1 if version == 0 else _BECH32M_CONST
+    polymod = _bech32_polymod(hrp_expanded + data + [0] * 6) ^ constant
+    checksum = [(polymod >> 5 * (5 - i)) & 31 for i in range(6)]
+    return hrp + '1' + ''.join(_BECH32_CHARSET[d] for d in data + checksum)
+
+def script_to_address(script, network):
+    """
+    Deriva l'indirizzo di uno scriptPubKey standard (P2PKH, P2SH, P2WPKH,
+    P2WSH, P2TR). Restituisce None per gli script non standard.
+    """
+    length = len(script)
+    if length == 25 and script[0] == 0x76 and script[1] == 0xa9 and script[2] == 0x14 \
+            and script[23] == 0x88 and script[24] == 0xac:
+        return _base58check(bytes([network['p2pkh']]) + bytes(script[3:23]))
+    if length == 23 and script[0] == 0xa9 and script[1] == 0x14 and script[22] == 0x87:
+        return _base58check(bytes([network['p2sh']]) + bytes(script[2:22]))
+    if length in (22, 34) and script[0] == 0x00 and script[1] == length - 2:
+        return _segwit_address(network['hrp'], 0, script[2:])
+    if length == 34 and script[0] == 0x51 and script[1] == 0x20:
+        return _segwit_address(network['hrp'], 1, script[2:])
+    return None
+
+# --- Accesso ai file ---
+def _xor(data, key, offset=0):
+    """
+    Rimuove l'offuscamento XOR (blocks/xor.dat) applicato da Bitcoin Core da
+    data, porzione del file che inizia a offset: il byte i usa
+    key[(offset + i) % len(key)].
+    """
+    shift = offset % len(key)
+    key = key[shift:] + key[:shift]
+    keystream = (key * (len(data) // len(key) + 1))[:len(data)]
+    return (int.from_bytes(data, 'little') ^ int.from_bytes(keystream, 'little')).to_bytes(len(data), 'little')
+
+def _read(buf, offset, size, xor_key):
+    """
+    Legge size byte da offset. Senza offuscamento restituisce uno slice del
+    memoryview (nessuna copia); altrimenti decodifica solo quella porzione.
+    """
+    data = buf[offset:offset + size]
+    return data if xor_key is None else memoryview(_xor(data, xor_key, offset))
+
+def _read_file(f, offset, size, xor_key):
+    """Come _read, leggendo da un file aperto invece che da un buffer."""
+    f.seek(offset)
+    data = f.read(size)
+    return data if xor_key is None else _xor(data, xor_key, offset)
+
+def _open_buffer(path):
+    """Mappa in memoria un file blk*.dat (anche se offuscato: si decodifica solo ciò che si legge)."""
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return memoryview(b'')
+        return memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+def _build_index(blocks_dir, magic):
+    """
+    Scandisce gli header di tutti i blocchi nei file blk*.dat e ricostruisce
+    la catena più lunga a partire dal genesis. Di ogni blocco vengono letti
+    solo i primi 8 byte (magic e dimensione) e l'header, un file alla volta.
+    Restituisce i percorsi dei file, la chiave XOR (None se i file non sono
+    offuscati) e, per ogni altezza, la tripla (indice del file, offset
+    dell'header, dimensione del blocco).
+    """
+    xor_key = None
+    xor_path = os.path.join(blocks_dir, 'xor.dat')
+    if os.path.exists(xor_path):
+        with open(xor_path, 'rb') as f:
+            key = f.read()
+        if any(key):
+            xor_key = key
+
+    paths = sorted(glob.glob(os.path.join(blocks_dir, 'blk*.dat')))
+    entries = {}      # hash -> (indice file, offset header, dimensione, hash precedente)
+    children = {}     # hash precedente -> [hash]
+    for file_index, path in enumerate(paths):
+        with open(path, 'rb') as f:
+            file_size = os.fstat(f.fileno()).st_size
+            pos = 0
+            while pos + 8 <= file_size:
+                preamble = _read_file(f, pos, 8, xor_key)
+                if preamble[:4] != magic:
+                    break
+                size = int.from_bytes(preamble[4:8], 'little')
+                header_pos = pos + 8
+                if size < 80 or header_pos + size > file_size:
+                    break
+                header = _read_file(f, header_pos, 80, xor_key)
+                block_hash = _sha256d(header)
+                prev_hash = header[4:36]
+                entries[block_hash] = (file_index, header_pos, size, prev_hash)
+                children.setdefault(prev_hash, []).append(block_hash)
+                pos = header_pos + size
+
+    # Visita in ampiezza dal genesis per trovare il blocco più profondo
+    best_hash, best_height = None, -1
+    frontier = [(block_hash, 0) for block_hash in children.get(_NULL_HASH, [])]
+    while frontier:
+        block_hash, height = frontier.pop()
+        if height > best_height:
+            best_hash, best_height = block_hash, height
+        frontier.extend((child, height + 1) for child in children.get(block_hash, []))
+
+    chain = [None] * (best_height + 1)
+    block_hash = best_hash
+    for height in range(best_height, -1, -1):
+        file_index, header_pos, size, prev_hash = entries[block_hash]
+        chain[height] = (file_index, header_pos, size)
+        block_hash = prev_hash
+    return paths, xor_key, chain
+
+class BlkFileConnector(BlockSource):
+    """
+    Sorgente di blocchi che legge direttamente i file blocks/blk*.dat di
+    Bitcoin Core tramite memory mapping, evitando il JSON dell'RPC.
+    I blocchi vengono decodificati nella stessa struttura di getblock con
+    verbosity 2. Non esiste un indice delle transazioni: get_transactions
+    viene delegato al connettore di fallback (se presente), quindi gli input
+    vanno risolti principalmente tramite l'indice dei prevout.
+    Un file viene mappato solo quando serve un suo blocco; restano aperte al
+    più max_open_files mappe, le usate meno di recente vengono chiuse.
+    """
+    def __init__(self, blocks_dir, network='main', fallback=None, max_open_files=16):
+        if network not in NETWORKS:
+            raise ValueError(f"Rete sconosciuta: {network}")
+        self._network = NETWORKS[network]
+        self._fallback = fallback
+        self._max_open_files = max(1, max_open_files)
+        self._maps = OrderedDict()
+        self._maps_lock = threading.Lock()
+
+        key = (os.path.abspath(blocks_dir), network)
+        with _INDEX_LOCK:
+            if key not in _INDEX_CACHE:
+                print(f"Indicizzazione dei file blk*.dat in {blocks_dir}...")
+                _INDEX_CACHE[key] = _build_index(blocks_dir, self._network['magic'])
+            self._paths, self._xor_key, self._chain = _INDEX_CACHE[key]
+        print(f"Sorgente blk*.dat pronta: {len(self._chain)} blocchi nella catena principale.")
+
+    def get_block_count(self):
+        return len(self._chain) - 1
+
+    def get_block_by_height(self, height):
+        if not 0 <= height < len(self._chain):
+            raise IndexError(f"Blocco {height} non presente nei file blk*.dat")
+        file_index, header_pos, size = self._chain[height]
+        # Con i file offuscati viene decodificato (e copiato) solo il blocco richiesto
+        block = _read(self._buffer(file_index), header_pos, size, self._xor_key)
+        return self._parse_block(block, 0, height)
+
+    def _buffer(self, file_index):
+        """Mappa del file file_index, dalla cache LRU delle mappe aperte."""
+        with self._maps_lock:
+            buf = self._maps.get(file_index)
+            if buf is not None:
+                self._maps.move_to_end(file_index)
+                return buf
+            buf = _open_buffer(self._paths[file_index])
+            self._maps[file_index] = buf
+            if len(self._maps) > self._max_open_files:
+                # La mappa (e il suo descrittore) si chiude quando nessun blocco in lettura la usa più
+                self._maps.popitem(last=False)
+            return buf
+
+    def get_transactions(self, txids):
+        if self._fallback is None:
+            raise LookupError(
+                "Transazioni sorgente non presenti nell'indice dei prevout e nessun nodo RPC "
+                "di fallback configurato."
+            )
+        return self._fallback.get_transactions(txids)
+
+    def _parse_block(self, buf, pos, height):
+        block = {
+            'hash': _sha256d(buf[pos:pos + 80])[::-1].hex(),
+            'height': height,
+            'time': int.from_bytes(buf[pos + 68:pos + 72], 'little'),
+            'tx': []
+        }
+        tx_count, pos = _read_varint(buf, pos + 80)
+        for _ in range(tx_count):
+            tx, pos = self._parse_transaction(buf, pos)
+            block['tx'].append(tx)
+        return block
+
+    def _parse_transaction(self, buf, pos):
+        """Decodifica una transazione. Gli slice del memoryview non copiano i dati."""
+        version_pos = pos
+        pos += 4
+        segwit = buf[pos] == 0 and buf[pos + 1] == 1
+        if segwit:
+            pos += 2
+        body_pos = pos
+
+        vin = []
+        input_count, pos = _read_varint(buf, pos)
+        for _ in range(input_count):
+            prev_txid = buf[pos:pos + 32]
+            prev_vout = int.from_bytes(buf[pos + 32:pos + 36], 'little')
+            script_length, pos = _read_varint(buf, pos + 36)
+            script = buf[pos:pos + script_length]
+            pos += script_length + 4 # script + sequence
+            if prev_vout == 0xffffffff and prev_txid == _NULL_HASH:
+                vin.append({'coinbase': script.hex()})
+            else:
+                vin.append({'txid': bytes(prev_txid)[::-1].hex(), 'vout': prev_vout})
+
+        vout = []
+        output_count, pos = _read_varint(buf, pos)
+        for n in range(output_count):
+            value = int.from_bytes(buf[pos:pos + 8], 'little')
+            script_length, pos = _read_varint(buf, pos + 8)
+            script = buf[pos:pos + script_length]
+            pos += script_length
+            script_pub_key = {}
+            address = script_to_address(script, self._network)
+            if address is not None:
+                script_pub_key['address'] = address
+            vout.append({'value': value / 1e8, 'n': n, 'scriptPubKey': script_pub_key})
+        body_end = pos
+
+        if segwit:
+            for _ in range(input_count):
+                item_count, pos = _read_varint(buf, pos)
+                for _ in range(item_count):
+                    item_length, pos = _read_varint(buf, pos)
+                    pos += item_length
+
+        # Il txid si calcola sulla serializzazione senza witness
+        digest = hashlib.sha256()
+        digest.update(buf[version_pos:version_pos + 4])
+        digest.update(buf[body_pos:body_end])
+        digest.update(buf[pos:pos + 4])
+        txid = hashlib.sha256(digest.digest()).digest()[::-1].hex()
+        return {'txid': txid, 'vin': vin, 'vout': vout}, pos + 4
@@ -0,0 +1,29 @@
+class BlockSource:
+    """
+    Interfaccia comune delle sorgenti di blocchi usate dall'ETL.
+    I blocchi restituiti hanno la stessa struttura di getblock con verbosity 2,
+    cioè quella consumata da etl/parser.process_block.
+    """
+    def get_block_count(self):
+        """Restituisce l'altezza del blocco più recente disponibile."""
+        raise NotImplementedError
+
+    def get_best_block_hash(self):
+        """Restituisce l'hash del blocco più recente (usato da --action follow)."""
+        raise NotImplementedError
+
+    def get_block_hashes(self, heights):
+        """Restituisce gli hash dei blocchi alle altezze indicate (usato da --action follow)."""
+        raise NotImplementedError
+
+    def get_block_by_height(self, height):
+        """Recupera un intero blocco data l'altezza."""
+        raise NotImplementedError
+
+    def get_transaction(self, txid):
+        """Recupera una singola transazione dato il suo txid."""
+        return self.get_transactions([txid])[txid]
+
+    def get_transactions(self, txids):
+        """Recupera più transazioni. Restituisce un dizionario {txid: transazione}."""
+        raise NotImplementedError
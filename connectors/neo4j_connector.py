@@ -1,9 +1,24 @@
-from neo4j import GraphDatabase
+from neo4j import GraphDatabase, Query, READ_ACCESS
+
+import metrics
 
 class Neo4jConnector:
-    def __init__(self, uri, user, password):
+    def __init__(self, uri, user, password, max_transaction_retry_time=30.0, fetch_size=1000, query_timeout=None,
+                 max_connection_pool_size=100):
+        # Default per stream_query: record richiesti al server per volta e
+        # timeout (in secondi) delle query di lettura, None per nessun limite.
+        self._fetch_size = fetch_size
+        self._query_timeout = query_timeout
         try:
-            self._driver = GraphDatabase.driver(uri, auth=(user, password))
+            # Le transazioni gestite (execute_write) vengono ritentate dal driver
+            # in caso di errori transitori, ad es. deadlock tra writer concorrenti,
+            # per al più max_transaction_retry_time secondi.
+            # Il driver è thread-safe e mantiene un pool di connessioni
+            # (max_connection_pool_size) riusate dalle sessioni, anche da più thread.
+            self._driver = GraphDatabase.driver(
+                uri, auth=(user, password), max_transaction_retry_time=max_transaction_retry_time,
+                max_connection_pool_size=max_connection_pool_size
+            )
             self._driver.verify_connectivity()
             print("Connesso a Neo4j.")
         except Exception as e:
@@ -16,7 +31,77 @@ class Neo4jConnector:
             print("Connessione a Neo4j chiusa.")
 
     def execute_query(self, query, parameters=None):
-        """Esegue una query su Neo4j."""
+        """
+        Esegue una query su Neo4j e restituisce tutti i record in una lista.
+        Da usare solo per risultati piccoli: per le analisi usare stream_query.
+        """
+        with metrics.timer('neo4j_query'), self._driver.session() as session:
+            records = list(session.run(query, parameters))
+        metrics.inc('neo4j_queries')
+        metrics.inc('neo4j_rows', len(records))
+        return records
+
+    def stream_query(self, query, parameters=None, fetch_size=None, timeout=None):
+        """
+        Generatore che restituisce i record di una query man mano che arrivano:
+        il driver ne richiede al server fetch_size per volta, quindi la memoria
+        non dipende dalla dimensione del risultato. La sessione resta aperta
+        finché il generatore non è esaurito o chiuso. Le query sono di sola
+        lettura e, in un cluster (URI neo4j://), vengono instradate ai server
+        di lettura.
+        """
+        fetch_size = fetch_size or self._fetch_size
+        timeout = timeout if timeout is not None else self._query_timeout
+        rows = 0
+        # Il timer copre l'intera lettura, consumo dei record da parte del chiamante incluso
+        with metrics.timer('neo4j_stream'), \
+                self._driver.session(default_access_mode=READ_ACCESS, fetch_size=fetch_size) as session:
+            try:
+                for record in session.run(Query(query, timeout=timeout), parameters):
+                    rows += 1
+                    yield record
+            finally:
+                metrics.inc('neo4j_queries')
+                metrics.inc('neo4j_rows', rows)
+
+    def paginate_query(self, query, parameters=None, key='tid', start=-1, page_size=10000, timeout=None):
+        """
+        Paginazione keyset: la query deve filtrare con "> $after" sulla colonna
+        key, ordinare per key e terminare con "LIMIT $limit". Ogni pagina è una
+        query breve e indipendente (il timeout vale per pagina) che riparte
+        dall'ultima chiave ricevuta, senza SKIP. start è il valore di $after per
+        la prima pagina, minore di ogni chiave (-1 per gli id compatti, che non
+        sono negativi).
+        """
+        parameters = dict(parameters or {})
+        after = start
+        while True:
+            received = 0
+            page_parameters = {**parameters, 'after': after, 'limit': page_size}
+            for record in self.stream_query(query, page_parameters, fetch_size=page_size, timeout=timeout):
+                received += 1
+                after = record[key]
+                yield record
+            if received < page_size:
+                return
+
+    def explain_query(self, query, parameters=None):
+        """Restituisce il piano di esecuzione (EXPLAIN) di una query senza eseguirla."""
         with self._driver.session() as session:
-            results = session.run(query, parameters)
-            return list(results) 
\ No newline at end of file
+            summary = session.run("EXPLAIN " + query, parameters).consume()
+            return summary.plan
+
+    def execute_write(self, statements):
+        """
+        Esegue una lista di coppie (query, parametri) all'interno di un'unica
+        transazione di scrittura esplicita. Restituisce il numero di query eseguite.
+        """
+        def _work(tx):
+            for query, parameters in statements:
+                tx.run(query, parameters).consume()
+
+        with metrics.timer('neo4j_write'), self._driver.session() as session:
+            session.execute_write(_work)
+        metrics.inc('neo4j_transactions')
+        metrics.inc('neo4j_statements', len(statements))
+        return len(statements)
\ No newline at end of file
@@ -0,0 +1,58 @@
+from analysis.queries import (
+    get_ingested_heights_query,
+    get_ingested_range_query,
+    get_graph_watermark_query,
+    get_max_block_height_query,
+    get_update_etl_state_query
+)
+
+def get_ingested_range(neo4j_connector):
+    """
+    Restituisce (prima altezza, high-water mark) dei blocchi già completati,
+    oppure (None, None) se il grafo è vuoto.
+    """
+    records = neo4j_connector.execute_query(get_ingested_range_query())
+    if not records:
+        return None, None
+    return records[0]['first_height'], records[0]['high_water_mark']
+
+def get_graph_watermark(neo4j_connector):
+    """
+    Restituisce lo stato dei blocchi completati come dizionario
+    {'first_height', 'high_water_mark', 'blocks'}: cambia a ogni blocco aggiunto.
+    """
+    records = neo4j_connector.execute_query(get_graph_watermark_query())
+    if not records:
+        return {'first_height': None, 'high_water_mark': None, 'blocks': 0}
+    return dict(records[0])
+
+def get_fresh_load_height(neo4j_connector):
+    """
+    Restituisce la prima altezza oltre l'ultimo nodo Block presente (anche
+    se non completato): i blocchi da lì in poi non possono essere già nel
+    grafo e vengono scritti con CREATE (caricamento fresco).
+    """
+    records = neo4j_connector.execute_query(get_max_block_height_query())
+    return records[0]['max_height'] + 1 if records else 0
+
+def get_pending_heights(neo4j_connector, start_block, end_block):
+    """
+    Restituisce, in ordine crescente, le altezze di [start_block, end_block]
+    che non risultano ancora completate: blocchi nuovi e blocchi falliti
+    in esecuzioni precedenti.
+    """
+    records = neo4j_connector.execute_query(
+        get_ingested_heights_query(),
+        parameters={'from_height': start_block, 'to_height': end_block}
+    )
+    completed = {record['height'] for record in records}
+    return [height for height in range(start_block, end_block + 1) if height not in completed]
+
+def save_etl_state(neo4j_connector, failed_heights):
+    """Aggiorna il nodo EtlState con l'high-water mark corrente e i blocchi falliti."""
+    _, high_water_mark = get_ingested_range(neo4j_connector)
+    neo4j_connector.execute_query(
+        get_update_etl_state_query(),
+        parameters={'high_water_mark': high_water_mark, 'failed_heights': sorted(failed_heights)}
+    )
+    return high_water_mark
@@ -1,12 +1,282 @@
-from analysis.queries import get_common_input_ownership_query
+import os
+import pickle
+from array import array
 
-def apply_common_input_ownership(neo4j_connector):
+from analysis.queries import (
+    get_input_address_sets_query,
+    get_set_entity_ids_query,
+    get_remap_entity_ids_query,
+    get_addresses_by_entity_ids_query,
+    get_clear_entity_ids_query
+)
+from .checkpoint import get_ingested_range
+
+# Versione del file di stato: gli stati precedenti agli id compatti usavano
+# come chiave la stringa dell'indirizzo e vanno ricostruiti
+CLUSTER_STATE_VERSION = 2
+
+class DisjointSet:
+    """
+    Union-find sugli indirizzi, con union by rank: ogni modifica si annulla
+    ripristinando un solo puntatore. Le modifiche vengono registrate per
+    blocco (record), così quelle dei blocchi orfani di una riorganizzazione
+    si possono annullare (rewind). La path compression riguarda solo i
+    puntatori definitivi (settled), cioè quelli delle unioni uscite dal
+    registro (forget) o fatte senza registrarle: i puntatori ancora
+    annullabili non vengono mai spostati.
+    Ogni indirizzo (identificato dal suo id compatto aid) riceve un intero
+    denso; l'entity_id di un cluster è l'intero del suo rappresentante.
+    """
+    def __init__(self):
+        self.ids = {}
+        self.parent = array('q')
+        self.rank = bytearray()
+        self.settled = bytearray()
+        # [(altezza, modifiche)] in ordine cronologico; le modifiche dei
+        # blocchi da history_start in poi sono tutte nel registro
+        self.history = []
+        self.history_start = 0
+        self._changes = None
+
+    def __setstate__(self, state):
+        # Stati salvati prima del registro: history_start viene fissato da load_cluster_state
+        state.setdefault('history', [])
+        state.setdefault('history_start', None)
+        state['_changes'] = None
+        self.__dict__.update(state)
+        if 'settled' not in state:
+            # Stati salvati prima della path compression: sono definitivi
+            # tutti i puntatori tranne quelli delle unioni ancora nel registro
+            self.settled = bytearray(parent != node for node, parent in enumerate(self.parent))
+            for _, changes in self.history:
+                for change in changes:
+                    if change[0] == 'union':
+                        self.settled[change[1]] = 0
+
+    def record(self, height):
+        """Le modifiche successive vengono registrate come dovute al blocco height."""
+        if not self.history or self.history[-1][0] != height:
+            self.history.append((height, []))
+        self._changes = self.history[-1][1]
+
+    def forget(self, before_height):
+        """Toglie dal registro i blocchi più vecchi sotto before_height, che non si potranno più annullare."""
+        while self.history and self.history[0][0] < before_height:
+            height, changes = self.history.pop(0)
+            self.history_start = max(self.history_start, height + 1)
+            for change in changes:
+                if change[0] == 'union':
+                    self.settled[change[1]] = 1
+        self._changes = None
+
+    def rewind(self, height):
+        """
+        Annulla, dalla più recente, le modifiche registrate dal primo blocco
+        oltre height in poi. Restituisce (rappresentanti dei cluster coinvolti
+        prima dell'annullamento, altezze fino a height annullate perché
+        registrate dopo, da clusterizzare di nuovo), oppure None se il
+        registro non risale fino a height.
+        """
+        if height + 1 < self.history_start:
+            return None
+        first = next((i for i, (h, _) in enumerate(self.history) if h > height), len(self.history))
+        undone = self.history[first:]
+        roots = {
+            self.find(self.ids[change[1]] if change[0] == 'add' else change[2])
+            for _, changes in undone for change in changes
+        }
+        for _, changes in reversed(undone):
+            for change in reversed(changes):
+                if change[0] == 'add':
+                    del self.ids[change[1]]
+                    self.parent.pop()
+                    self.rank.pop()
+                    self.settled.pop()
+                else:
+                    _, second_root, first_root, increased = change
+                    self.parent[second_root] = second_root
+                    if increased:
+                        self.rank[first_root] -= 1
+        del self.history[first:]
+        self._changes = None
+        return roots, {h for h, _ in undone if h <= height}
+
+    def add(self, address):
+        """Restituisce l'intero associato all'indirizzo, creandolo se serve."""
+        address_id = self.ids.get(address)
+        if address_id is None:
+            address_id = len(self.parent)
+            self.ids[address] = address_id
+            self.parent.append(address_id)
+            self.rank.append(0)
+            self.settled.append(0)
+            if self._changes is not None:
+                self._changes.append(('add', address))
+        return address_id
+
+    def find(self, address_id):
+        path = []
+        while self.parent[address_id] != address_id:
+            path.append(address_id)
+            address_id = self.parent[address_id]
+        # Path compression sui soli puntatori definitivi: ognuno viene spostato
+        # sul primo antenato con un puntatore annullabile (o sulla radice), che
+        # resta lo stesso qualunque rewind venga fatto in seguito
+        anchor = address_id
+        for node in reversed(path):
+            if self.settled[node]:
+                self.parent[node] = anchor
+            else:
+                anchor = node
+        return address_id
+
+    def union(self, first_id, second_id):
+        first_root, second_root = self.find(first_id), self.find(second_id)
+        if first_root == second_root:
+            return first_root
+        if self.rank[first_root] < self.rank[second_root]:
+            first_root, second_root = second_root, first_root
+        self.parent[second_root] = first_root
+        increased = self.rank[first_root] == self.rank[second_root]
+        if increased:
+            self.rank[first_root] += 1
+        if self._changes is not None:
+            self._changes.append(('union', second_root, first_root, increased))
+        else:
+            self.settled[second_root] = 1
+        return first_root
+
+def load_cluster_state(path):
+    """
+    Carica (union-find, ultima altezza clusterizzata, altezze da
+    clusterizzare di nuovo) dal file di stato, se esiste.
+    """
+    if path and os.path.exists(path):
+        with open(path, 'rb') as f:
+            state = pickle.load(f)
+        if state.get('version') == CLUSTER_STATE_VERSION:
+            disjoint_set = state['disjoint_set']
+            if disjoint_set.history_start is None:
+                disjoint_set.history_start = state['last_height'] + 1
+            return disjoint_set, state['last_height'], state.get('pending_heights', [])
+        print(f"File di stato {path} in un formato precedente: il clustering riparte dal primo blocco.")
+    return DisjointSet(), -1, []
+
+def save_cluster_state(path, disjoint_set, last_height, pending_heights=()):
+    # Scrittura atomica: un'interruzione non lascia un file di stato a metà
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        pickle.dump({'version': CLUSTER_STATE_VERSION, 'disjoint_set': disjoint_set, 'last_height': last_height,
+                     'pending_heights': sorted(pending_heights)},
+                    f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+
+def _clear_entity_ids(neo4j_connector, batch_size):
+    while True:
+        records = neo4j_connector.execute_query(get_clear_entity_ids_query(), parameters={'limit': batch_size})
+        if not records or not records[0]['updated']:
+            return
+
+def rewind_cluster_state(neo4j_connector, path, height, write_batch_size=5000):
+    """
+    Annulla il clustering dei blocchi oltre height (dopo il rollback di una
+    riorganizzazione): le unioni registrate per quei blocchi vengono
+    annullate nell'union-find e gli entity_id dei cluster coinvolti
+    riscritti (rimossi per gli indirizzi comparsi solo nei blocchi annullati).
+    Se il registro non risale fino a height, lo stato e gli entity_id del
+    grafo vengono azzerati e il clustering riparte dal primo blocco.
+    """
+    disjoint_set, last_height, pending_heights = load_cluster_state(path)
+    if last_height <= height:
+        return
+    rewound = disjoint_set.rewind(height)
+    if rewound is None:
+        print(f"Registro del clustering insufficiente per tornare al blocco {height}: "
+              f"il clustering riparte dal primo blocco.")
+        _clear_entity_ids(neo4j_connector, write_batch_size)
+        save_cluster_state(path, DisjointSet(), -1)
+        return
+
+    roots, redo_heights = rewound
+    rows = []
+    for record in neo4j_connector.stream_query(get_addresses_by_entity_ids_query(),
+                                               parameters={'entity_ids': sorted(roots)}):
+        address_id = disjoint_set.ids.get(record['aid'])
+        rows.append({'aid': record['aid'], 'entity_id': None if address_id is None else disjoint_set.find(address_id)})
+    _write_in_batches(neo4j_connector, get_set_entity_ids_query(), 'rows', rows, write_batch_size)
+    save_cluster_state(path, disjoint_set, height, set(pending_heights) | redo_heights)
+    print(f"Clustering riportato al blocco {height}: {len(rows)} indirizzi aggiornati.")
+
+def _iter_pages(last_height, high_water_mark, heights, page_blocks):
+    """Genera (query, parametri) per leggere i blocchi da clusterizzare a pagine."""
+    # Altezze già coperte dallo stato ma rielaborate in questa esecuzione (es. blocchi ritentati)
+    old_heights = sorted(height for height in (heights or []) if height <= last_height)
+    for start in range(0, len(old_heights), page_blocks):
+        yield get_input_address_sets_query(by_heights=True), {'heights': old_heights[start:start + page_blocks]}
+    for from_height in range(last_height + 1, high_water_mark + 1, page_blocks):
+        yield get_input_address_sets_query(), {
+            'from_height': from_height,
+            'to_height': min(from_height + page_blocks - 1, high_water_mark)
+        }
+
+def _write_in_batches(neo4j_connector, query, key, rows, batch_size):
+    for start in range(0, len(rows), batch_size):
+        neo4j_connector.execute_write([(query, {key: rows[start:start + batch_size]})])
+
+def apply_common_input_ownership(neo4j_connector, heights=None, state_path='clusters.pickle',
+                                 page_blocks=100, write_batch_size=5000, history_blocks=100):
+    """
+    Applica l'euristica Common-Input-Ownership con un union-find persistente.
+    Gli insiemi di indirizzi di input vengono letti a pagine di blocchi a partire
+    dall'ultima altezza già clusterizzata (più le eventuali altezze in heights
+    già coperte, ad es. blocchi ritentati) e il risultato viene scritto come
+    proprietà entity_id sugli Address, senza creare relazioni tra coppie.
+    Le unioni degli ultimi history_blocks blocchi restano annullabili da
+    rewind_cluster_state.
+    """
     print("\n--- Applicazione dell'euristica 'Common-Input-Ownership' ---")
 
     try:
-        # Usa la funzione per ottenere la query
-        query = get_common_input_ownership_query()
-        neo4j_connector.execute_query(query)
-        print("Euristica applicata con successo. Create relazioni [:SAME_ENTITY].")
+        disjoint_set, last_height, pending_heights = load_cluster_state(state_path)
+        heights = sorted(set(heights or []) | set(pending_heights))
+        _, high_water_mark = get_ingested_range(neo4j_connector)
+        if high_water_mark is None:
+            print("Nessun blocco presente nel grafo.")
+            return
+
+        touched = {}          # indirizzo -> id, indirizzi visti in questa esecuzione
+        roots_before = set()  # rappresentanti dei cluster esistenti prima di questa esecuzione
+        transactions = 0
+        for query, parameters in _iter_pages(last_height, high_water_mark, heights, page_blocks):
+            for record in neo4j_connector.stream_query(query, parameters=parameters):
+                transactions += 1
+                disjoint_set.record(record['height'])
+                address_ids = []
+                for address in record['addresses']:
+                    if address not in touched:
+                        if address in disjoint_set.ids:
+                            roots_before.add(disjoint_set.find(disjoint_set.ids[address]))
+                        touched[address] = disjoint_set.add(address)
+                    address_ids.append(touched[address])
+                for address_id in address_ids[1:]:
+                    disjoint_set.union(address_ids[0], address_id)
+
+        # I cluster esistenti assorbiti da altri vengono rinominati in blocco
+        remaps = [
+            {'old_entity_id': root, 'new_entity_id': disjoint_set.find(root)}
+            for root in roots_before if disjoint_set.find(root) != root
+        ]
+        rows = [
+            {'aid': address, 'entity_id': disjoint_set.find(address_id)}
+            for address, address_id in touched.items()
+        ]
+        _write_in_batches(neo4j_connector, get_remap_entity_ids_query(), 'remaps', remaps, write_batch_size)
+        _write_in_batches(neo4j_connector, get_set_entity_ids_query(), 'rows', rows, write_batch_size)
+
+        disjoint_set.forget(high_water_mark - history_blocks + 1)
+        save_cluster_state(state_path, disjoint_set, max(last_height, high_water_mark))
+        print(f"Euristica applicata con successo: {transactions} transazioni multi-input fino al blocco "
+              f"{high_water_mark}, {len(rows)} indirizzi aggiornati, {len(remaps)} cluster uniti. "
+              f"Proprietà [entity_id] aggiornata.")
     except Exception as e:
         print(f"Errore durante l'applicazione dell'euristica: {e}")
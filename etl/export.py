@@ -0,0 +1,184 @@
+import csv
+import gzip
+import os
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+
+from analysis.queries import DORMANCY_BANDS_YEARS
+from .parser import build_block_rows
+from .prevout_store import PrevoutStore
+from .identifiers import IdRegistry
+from .sharding import split_into_shards
+
+# Feature delle transazioni, nello stesso ordine delle colonne del file transactions
+TRANSACTION_FEATURES = [
+    'n_inputs', 'n_outputs', 'total_in', 'total_out', 'fee', 'self_change', 'peel_ratio', 'change_address',
+    'change_aid'
+]
+
+# Header dei file nel formato di "neo4j-admin database import". Le etichette e
+# i tipi di relazione sono indicati nel comando di import. Gli ID sono interi
+# (--id-type=integer): gli id compatti tid/aid per transazioni e indirizzi,
+# salvati come proprietà, e l'altezza per Block, non salvata come proprietà
+# così height resta un intero come nell'ETL.
+HEADERS = {
+    'blocks': [
+        ':ID(Block)', 'height:long', 'hash', 'timestamp:datetime', 'ingested:boolean',
+        'cdd:double', 'max_age_days:double', 'top_spend_ages:double[]'
+    ] + [f'spent_over_{years}y:double' for years in DORMANCY_BANDS_YEARS],
+    'transactions': [
+        'tid:ID(Transaction)', 'txid', 'block_height:long', 'n_inputs:long', 'n_outputs:long', 'total_in:double',
+        'total_out:double', 'fee:double', 'self_change:boolean', 'peel_ratio:double', 'change_address',
+        'change_aid:long'
+    ],
+    'addresses': ['aid:ID(Address)', 'address'],
+    'included_in': [':START_ID(Transaction)', ':END_ID(Block)'],
+    'received': [':START_ID(Transaction)', ':END_ID(Address)', 'value:double', 'vout:long'],
+    'sent': [':START_ID(Address)', ':END_ID(Transaction)', 'value:double', 'age_days:double', 'vin:long'],
+}
+
+# File -> etichetta del nodo o tipo della relazione nel comando di import
+NODE_FILES = {'blocks': 'Block', 'transactions': 'Transaction', 'addresses': 'Address'}
+RELATIONSHIP_FILES = {'included_in': 'INCLUDED_IN', 'received': 'RECEIVED', 'sent': 'SENT'}
+
+class CsvExporter:
+    """
+    Scrive le righe prodotte da build_block_rows nei file CSV di una parte
+    (uno per tipo di nodo/relazione). Gli indirizzi vengono deduplicati con
+    una cache LRU di dimensione fissa, quindi la memoria per shard è costante:
+    gli eventuali duplicati residui sono scartati da neo4j-admin con
+    --skip-duplicate-nodes.
+    """
+    def __init__(self, output_dir, part, compress=False, dedup_cache_size=1000000):
+        extension = '.csv.gz' if compress else '.csv'
+        self._files = {}
+        self._writers = {}
+        for name in HEADERS:
+            path = os.path.join(output_dir, f"{name}-part{part:04d}{extension}")
+            handle = gzip.open(path, 'wt', newline='') if compress else open(path, 'w', newline='')
+            self._files[name] = handle
+            self._writers[name] = csv.writer(handle)
+        self._seen_addresses = OrderedDict()
+        self._dedup_cache_size = dedup_cache_size
+
+    def _write_address(self, aid, address):
+        if aid in self._seen_addresses:
+            self._seen_addresses.move_to_end(aid)
+            return
+        self._seen_addresses[aid] = None
+        if len(self._seen_addresses) > self._dedup_cache_size:
+            self._seen_addresses.popitem(last=False)
+        self._writers['addresses'].writerow([aid, address])
+
+    def write_block(self, rows):
+        block = rows['block']
+        block_height = block['block_height']
+        timestamp = datetime.fromtimestamp(block['timestamp'], tz=timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+        rollup = block['rollup']
+        self._writers['blocks'].writerow(
+            [block_height, block_height, block['block_hash'], timestamp, 'true',
+             rollup['cdd'], rollup['max_age_days'], ';'.join(str(age) for age in rollup['top_spend_ages'])]
+            + [rollup[f'spent_over_{years}y'] for years in DORMANCY_BANDS_YEARS]
+        )
+
+        for tx in rows['transactions']:
+            tid = tx['tid']
+            # I valori assenti restano campi vuoti, che neo4j-admin non importa
+            features = [tx['features'][name] for name in TRANSACTION_FEATURES]
+            features = ['' if value is None else str(value).lower() if isinstance(value, bool) else value
+                        for value in features]
+            self._writers['transactions'].writerow([tid, tx['tx_id'], block_height] + features)
+            self._writers['included_in'].writerow([tid, block_height])
+
+            # Come nell'ETL, una relazione per ogni output (vout) e input (vin)
+            for output in tx['outputs']:
+                self._write_address(output['aid'], output['addr'])
+                self._writers['received'].writerow([tid, output['aid'], output['val'], output['vout']])
+            for input_row in tx['inputs']:
+                self._write_address(input_row['aid'], input_row['addr'])
+                self._writers['sent'].writerow([input_row['aid'], tid, input_row['val'], input_row['age'],
+                                                input_row['vin']])
+
+    def close(self):
+        for handle in self._files.values():
+            handle.close()
+
+def write_headers(output_dir):
+    """Scrive i file di header, separati dai file di dati delle singole parti."""
+    for name, header in HEADERS.items():
+        with open(os.path.join(output_dir, f"{name}_header.csv"), 'w', newline='') as handle:
+            csv.writer(handle).writerow(header)
+
+def _export_part(part, heights, block_source_factory, output_dir, options):
+    """Esporta un gruppo di altezze in una parte. Eseguito anche in processi figli."""
+    started = time.monotonic()
+    btc_connector = block_source_factory()
+    prevout_store = None
+    if options['prevout_db_path']:
+        prevout_store = PrevoutStore(options['prevout_db_path'], options['prevout_cache_size'])
+    id_registry = None
+    if options['id_registry_path']:
+        id_registry = IdRegistry(options['id_registry_path'], options['id_registry_cache_size'])
+
+    exporter = CsvExporter(output_dir, part, options['compress'], options['dedup_cache_size'])
+    failed_heights = []
+    try:
+        for height in heights:
+            try:
+                block_data = btc_connector.get_block_by_height(height)
+                exporter.write_block(build_block_rows(height, block_data, btc_connector, prevout_store, id_registry))
+            except Exception as e:
+                print(f"Errore durante l'esportazione del blocco {height}: {e}")
+                failed_heights.append(height)
+    finally:
+        exporter.close()
+        if prevout_store is not None:
+            prevout_store.close()
+        if id_registry is not None:
+            id_registry.close()
+
+    print(f"[Export] Parte {part} ({heights[0]}-{heights[-1]}) completata in {time.monotonic() - started:.1f}s.")
+    return failed_heights
+
+def build_import_command(output_dir, parts, compress=False, database='neo4j'):
+    """Restituisce il comando neo4j-admin che importa i file esportati."""
+    extension = '.csv.gz' if compress else '.csv'
+
+    def file_list(name):
+        files = [os.path.join(output_dir, f"{name}_header.csv")]
+        files += [os.path.join(output_dir, f"{name}-part{part:04d}{extension}") for part in range(parts)]
+        return ','.join(files)
+
+    arguments = [f"neo4j-admin database import full {database}", "--skip-duplicate-nodes=true", "--id-type=integer"]
+    arguments += [f"--nodes={label}={file_list(name)}" for name, label in NODE_FILES.items()]
+    arguments += [f"--relationships={rel_type}={file_list(name)}" for name, rel_type in RELATIONSHIP_FILES.items()]
+    return ' \\\n  '.join(arguments)
+
+def run_export(heights, block_source_factory, output_dir, options, workers=1):
+    """
+    Esporta i blocchi indicati come file CSV per neo4j-admin, con una parte per
+    shard. Con workers > 1 le parti vengono prodotte da processi separati.
+    Restituisce la lista delle altezze che non è stato possibile esportare.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    write_headers(output_dir)
+
+    shards = split_into_shards(list(heights), max(workers, 1), shards_per_worker=1)
+    failed_heights = []
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(_export_part, part, shard, block_source_factory, output_dir, options)
+                for part, shard in enumerate(shards)
+            ]
+            for future in futures:
+                failed_heights.extend(future.result())
+    else:
+        for part, shard in enumerate(shards):
+            failed_heights.extend(_export_part(part, shard, block_source_factory, output_dir, options))
+
+    print("\nEsportazione completata. Per importare i dati (a database fermo):")
+    print(build_import_command(output_dir, len(shards), options['compress']))
+    return sorted(failed_heights)
@@ -0,0 +1,164 @@
+"""
+Modalità follow: l'ETL resta connesso al nodo e carica ogni nuovo blocco
+appena compare sul tip, invece di lavorare su intervalli fissi. Il tip viene
+controllato con getbestblockhash a intervalli regolari oppure, se
+configurato, a ogni notifica ZMQ hashblock di Bitcoin Core. Le
+riorganizzazioni poco profonde vengono gestite eliminando dal grafo i
+blocchi orfani (transazioni, relazioni e indirizzi rimasti isolati) prima di
+caricare quelli della nuova catena.
+"""
+import time
+
+import metrics
+from analysis.queries import get_block_hashes_query, get_rollback_transactions_query, get_rollback_blocks_query
+from .checkpoint import get_ingested_range, save_etl_state
+from .parser import process_block
+
+class ReorgTooDeepError(RuntimeError):
+    pass
+
+class PollingNotifier:
+    """Attesa semplice tra due controlli del tip."""
+    def wait(self, timeout):
+        time.sleep(timeout)
+        return False
+
+    def close(self):
+        pass
+
+class ZmqBlockNotifier:
+    """
+    Attende le notifiche hashblock pubblicate da Bitcoin Core
+    (-zmqpubhashblock=<endpoint>). Richiede il pacchetto pyzmq.
+    """
+    def __init__(self, endpoint):
+        # Dipendenza opzionale: serve solo con FOLLOW_ZMQ_ENDPOINT
+        try:
+            import zmq
+        except ImportError:
+            raise RuntimeError("Le notifiche ZMQ richiedono il pacchetto pyzmq (pip install pyzmq).")
+        self._context = zmq.Context()
+        self._socket = self._context.socket(zmq.SUB)
+        self._socket.setsockopt(zmq.SUBSCRIBE, b'hashblock')
+        self._socket.connect(endpoint)
+
+    def wait(self, timeout):
+        """Attende al più timeout secondi; restituisce True se è arrivata una notifica."""
+        if not self._socket.poll(timeout * 1000):
+            return False
+        # Le notifiche accumulate valgono tutte un solo controllo del tip
+        while self._socket.poll(0):
+            self._socket.recv_multipart()
+        return True
+
+    def close(self):
+        self._socket.close(linger=0)
+        self._context.term()
+
+def _stored_hashes(neo4j_connector, from_height, to_height):
+    records = neo4j_connector.execute_query(
+        get_block_hashes_query(), parameters={'from_height': from_height, 'to_height': to_height}
+    )
+    return {record['height']: record['hash'] for record in records}
+
+def find_fork_height(btc_connector, neo4j_connector, high_water_mark, max_depth=100):
+    """
+    Restituisce l'altezza dell'ultimo blocco del grafo che si trova ancora
+    sulla catena del nodo: high_water_mark se non c'è stata una
+    riorganizzazione. Gli hash salvati sui nodi Block vengono confrontati con
+    quelli del nodo andando a ritroso per al più max_depth blocchi; il nodo
+    deve essere almeno all'altezza high_water_mark.
+    """
+    # Caso comune: il blocco più recente del grafo è ancora sulla catena del nodo
+    stored = _stored_hashes(neo4j_connector, high_water_mark, high_water_mark)
+    if stored.get(high_water_mark) == btc_connector.get_block_hashes([high_water_mark])[0]:
+        return high_water_mark
+
+    from_height = max(0, high_water_mark - max_depth)
+    stored = _stored_hashes(neo4j_connector, from_height, high_water_mark)
+    heights = sorted(stored, reverse=True)
+    node_hashes = dict(zip(heights, btc_connector.get_block_hashes(heights)))
+    for height in heights:
+        if node_hashes[height] == stored[height]:
+            return height
+    raise ReorgTooDeepError(
+        f"Nessun blocco in comune con il nodo tra le altezze {from_height} e {high_water_mark}: "
+        f"riorganizzazione più profonda di {max_depth} blocchi."
+    )
+
+def rollback_blocks(neo4j_connector, fork_height):
+    """Elimina dal grafo i blocchi oltre fork_height, in un'unica transazione di scrittura."""
+    neo4j_connector.execute_write([
+        (get_rollback_transactions_query(), {'fork_height': fork_height}),
+        (get_rollback_blocks_query(), {'fork_height': fork_height})
+    ])
+
+def follow_chain(btc_connector, neo4j_connector, start_height=None, poll_interval=1.0, max_reorg_depth=100,
+                 tx_chunk_size=0, prevout_store=None, id_registry=None, notifier=None, on_blocks=None,
+                 stop=None, fresh_load=False):
+    """
+    Segue il tip del nodo caricando ogni nuovo blocco con process_block.
+    Si riparte dal blocco successivo all'high-water mark del grafo oppure, se
+    il grafo è vuoto, da start_height (default: il tip corrente).
+    Dopo ogni gruppo di blocchi viene chiamata on_blocks(heights, fork_height),
+    con fork_height diverso da None se prima è stato fatto un rollback, per
+    clustering e analisi incrementali. Un blocco fallito viene ritentato al
+    controllo successivo. Termina quando stop() restituisce True.
+    Con fresh_load i blocchi oltre l'high-water mark vengono scritti con CREATE.
+    """
+    notifier = notifier or PollingNotifier()
+    _, high_water_mark = get_ingested_range(neo4j_connector)
+    if high_water_mark is None and start_height is None:
+        start_height = btc_connector.get_block_count()
+    print(f"[Follow] High-water mark {high_water_mark}: in attesa di nuovi blocchi "
+          f"(controllo ogni {poll_interval:g}s).")
+
+    last_tip_hash = None
+    while not (stop and stop()):
+        tip_hash = btc_connector.get_best_block_hash()
+        if tip_hash == last_tip_hash:
+            notifier.wait(poll_interval)
+            continue
+
+        detected = time.monotonic()
+        node_height = btc_connector.get_block_count()
+        if high_water_mark is not None and node_height < high_water_mark:
+            # Nodo in ritardo rispetto al grafo (es. in sincronizzazione): si attende senza rollback
+            print(f"[Follow] Il nodo è all'altezza {node_height}, il grafo a {high_water_mark}: in attesa.")
+            last_tip_hash = tip_hash
+            continue
+
+        fork_height = None
+        if high_water_mark is not None:
+            common_height = find_fork_height(btc_connector, neo4j_connector, high_water_mark, max_reorg_depth)
+            if common_height < high_water_mark:
+                print(f"[Follow] Riorganizzazione: rollback dei blocchi {common_height + 1}-{high_water_mark}.")
+                with metrics.timer('follow_rollback'):
+                    rollback_blocks(neo4j_connector, common_height)
+                metrics.inc('follow_reorgs')
+                metrics.inc('follow_rolled_back_blocks', high_water_mark - common_height)
+                fork_height = high_water_mark = common_height
+
+        heights = []
+        next_height = start_height if high_water_mark is None else high_water_mark + 1
+        for height in range(next_height, node_height + 1):
+            if not process_block(height, btc_connector, neo4j_connector, tx_chunk_size, prevout_store,
+                                 id_registry=id_registry, fresh=fresh_load):
+                break
+            heights.append(height)
+            high_water_mark = height
+            metrics.observe('follow_block_latency', time.monotonic() - detected)
+        # Con un blocco fallito il tip non è raggiunto: si riprova al prossimo controllo
+        completed = high_water_mark is not None and high_water_mark >= node_height
+        last_tip_hash = tip_hash if completed else None
+
+        if heights or fork_height is not None:
+            written = time.monotonic() - detected
+            save_etl_state(neo4j_connector, [] if completed else [next_height + len(heights)])
+            if on_blocks is not None:
+                on_blocks(heights, fork_height)
+            if heights:
+                print(f"[Follow] Blocchi {heights[0]}-{heights[-1]} interrogabili dopo {written:.2f}s "
+                      f"(clustering e analisi completati dopo {time.monotonic() - detected:.2f}s).")
+        if not completed:
+            notifier.wait(poll_interval)
@@ -0,0 +1,85 @@
+"""
+Identificativi compatti di transazioni e indirizzi. Il grafo usa come chiave
+(MERGE, vincoli di unicità, join) un intero a 63 bit derivato dall'hash
+blake2b della stringa: tid per i txid, aid per gli indirizzi. Le stringhe
+originali restano proprietà dei nodi. L'id dipende solo dalla stringa, quindi
+processi e shard diversi calcolano gli stessi valori senza coordinarsi; il
+registro opzionale IdRegistry verifica che due stringhe non collidano.
+"""
+import hashlib
+import sqlite3
+from collections import OrderedDict
+
+def compact_id(value):
+    """Intero non negativo a 63 bit (primi 8 byte di blake2b, bit di segno azzerato)."""
+    digest = hashlib.blake2b(value.encode(), digest_size=8).digest()
+    return int.from_bytes(digest, 'big') >> 1
+
+# Tabelle del registro: una per tipo di identificativo
+ID_KINDS = ('txids', 'addresses')
+
+class IdCollisionError(ValueError):
+    pass
+
+class IdRegistry:
+    """
+    Dizionario persistente id -> stringa (file SQLite, una tabella per i txid e
+    una per gli indirizzi) che rileva le collisioni degli id compatti. Davanti
+    al file c'è una cache LRU degli id già verificati.
+    """
+    def __init__(self, path, cache_size=500000):
+        self._conn = sqlite3.connect(path, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        for table in ID_KINDS:
+            self._conn.execute(f"CREATE TABLE IF NOT EXISTS {table} (id INTEGER PRIMARY KEY, value TEXT NOT NULL)")
+        self._conn.commit()
+        self._cache = OrderedDict()
+        self._cache_size = cache_size
+
+    def check(self, values, kind):
+        """
+        Registra le stringhe di tipo kind ('txids' o 'addresses') e solleva
+        IdCollisionError se una di esse ha lo stesso id di una stringa diversa
+        già registrata.
+        """
+        pending = {}
+        for value in values:
+            value_id = compact_id(value)
+            if self._cache.get((kind, value_id)) == value:
+                self._cache.move_to_end((kind, value_id))
+                continue
+            if pending.setdefault(value_id, value) != value:
+                raise IdCollisionError(f"Collisione dell'id {value_id}: {pending[value_id]} e {value}")
+        if not pending:
+            return
+
+        self._conn.executemany(f"INSERT OR IGNORE INTO {kind} VALUES (?, ?)", pending.items())
+        self._conn.commit()
+        ids = list(pending)
+        for start in range(0, len(ids), 500):
+            chunk = ids[start:start + 500]
+            rows = self._conn.execute(
+                f"SELECT id, value FROM {kind} WHERE id IN ({','.join('?' * len(chunk))})", chunk
+            ).fetchall()
+            for value_id, stored in rows:
+                if stored != pending[value_id]:
+                    raise IdCollisionError(f"Collisione dell'id {value_id}: {stored} e {pending[value_id]}")
+
+        for value_id, value in pending.items():
+            self._cache[(kind, value_id)] = value
+            self._cache.move_to_end((kind, value_id))
+        while len(self._cache) > self._cache_size:
+            self._cache.popitem(last=False)
+
+    def check_block_rows(self, rows):
+        """Verifica tutti i txid e gli indirizzi delle righe di un blocco (build_block_rows)."""
+        addresses = []
+        for tx in rows['transactions']:
+            addresses.extend(row['addr'] for row in tx['outputs'])
+            addresses.extend(row['addr'] for row in tx['inputs'])
+        self.check([tx['tx_id'] for tx in rows['transactions']], 'txids')
+        self.check(addresses, 'addresses')
+
+    def close(self):
+        self._conn.close()
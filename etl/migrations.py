@@ -0,0 +1,151 @@
+from analysis.queries import (
+    get_backfill_transaction_features_query, get_backfill_block_rollups_query,
+    get_transactions_without_ids_query, get_set_transaction_ids_query,
+    get_addresses_without_ids_query, get_set_address_ids_query,
+    get_blocks_without_edge_indexes_query, get_set_output_indexes_query, get_set_input_indexes_query,
+    get_batch_create_outputs_query, get_batch_create_inputs_query
+)
+from .checkpoint import get_ingested_range
+from .identifiers import compact_id
+from .parser import build_block_rows
+
+def _run_in_windows(neo4j_connector, query, batch_blocks, label):
+    """
+    Esegue una query di backfill su finestre di batch_blocks blocchi, da
+    $from_height a $to_height, una transazione di scrittura per finestra.
+    Le query saltano i nodi già migrati: la migrazione può quindi essere
+    interrotta e rilanciata. Restituisce il totale della colonna updated.
+    """
+    first_height, high_water_mark = get_ingested_range(neo4j_connector)
+    if high_water_mark is None:
+        print("Nessun blocco presente nel grafo.")
+        return 0
+
+    total_updated = 0
+    for from_height in range(first_height, high_water_mark + 1, batch_blocks):
+        to_height = min(from_height + batch_blocks - 1, high_water_mark)
+        records = neo4j_connector.execute_query(
+            query, parameters={'from_height': from_height, 'to_height': to_height}
+        )
+        total_updated += records[0]['updated'] if records else 0
+        print(f"  Blocchi {from_height}-{to_height}: {total_updated} {label} aggiornati finora.  \r",
+              end="", flush=True)
+
+    print()
+    print(f"Migrazione completata: {total_updated} {label} aggiornati.")
+    return total_updated
+
+def backfill_transaction_features(neo4j_connector, batch_blocks=100):
+    """
+    Calcola le feature delle transazioni (n_inputs, n_outputs, total_in,
+    total_out, fee, self_change, peel_ratio, change_address) per i grafi
+    caricati prima che il parser le salvasse.
+    """
+    print("\n--- Migrazione: calcolo delle feature delle transazioni ---")
+    return _run_in_windows(
+        neo4j_connector, get_backfill_transaction_features_query(), batch_blocks, "nodi Transaction"
+    )
+
+def backfill_block_rollups(neo4j_connector, batch_blocks=100):
+    """
+    Calcola le rollup di dormienza (cdd, spent_over_<N>y, max_age_days,
+    top_spend_ages) dei blocchi caricati prima che il parser le salvasse.
+    """
+    print("\n--- Migrazione: calcolo delle rollup di dormienza dei blocchi ---")
+    return _run_in_windows(neo4j_connector, get_backfill_block_rollups_query(), batch_blocks, "nodi Block")
+
+def backfill_compact_ids(neo4j_connector, batch_blocks=100, id_registry=None):
+    """
+    Calcola gli id compatti (tid, change_aid delle transazioni e aid degli
+    indirizzi) dei grafi caricati quando la chiave era la stringa. Va eseguita
+    prima delle altre migrazioni; con id_registry (IdRegistry) vengono
+    verificate anche le collisioni. Come le altre migrazioni salta i nodi già
+    migrati e può essere rilanciata.
+    """
+    print("\n--- Migrazione: calcolo degli id compatti di transazioni e indirizzi ---")
+    first_height, high_water_mark = get_ingested_range(neo4j_connector)
+    if high_water_mark is None:
+        print("Nessun blocco presente nel grafo.")
+        return 0
+
+    total_updated = 0
+    for from_height in range(first_height, high_water_mark + 1, batch_blocks):
+        parameters = {'from_height': from_height, 'to_height': min(from_height + batch_blocks - 1, high_water_mark)}
+        transactions = neo4j_connector.execute_query(get_transactions_without_ids_query(), parameters=parameters)
+        addresses = neo4j_connector.execute_query(get_addresses_without_ids_query(), parameters=parameters)
+        if id_registry is not None:
+            id_registry.check([record['txid'] for record in transactions], 'txids')
+            id_registry.check([record['address'] for record in addresses], 'addresses')
+
+        transaction_rows = [
+            {
+                'txid': record['txid'],
+                'tid': compact_id(record['txid']),
+                'change_aid': compact_id(record['change_address']) if record['change_address'] else None
+            }
+            for record in transactions
+        ]
+        address_rows = [{'address': record['address'], 'aid': compact_id(record['address'])} for record in addresses]
+        neo4j_connector.execute_write([
+            (get_set_transaction_ids_query(), {'rows': transaction_rows}),
+            (get_set_address_ids_query(), {'rows': address_rows})
+        ])
+        total_updated += len(transactions) + len(addresses)
+        print(f"  Blocchi {parameters['from_height']}-{parameters['to_height']}: "
+              f"{total_updated} nodi aggiornati finora.  \r", end="", flush=True)
+
+    print()
+    print(f"Migrazione completata: {total_updated} nodi Transaction e Address aggiornati.")
+    print("I vincoli sulle stringhe (txid, address) non servono più e possono essere rimossi.")
+    return total_updated
+
+def _first_per_edge(rows, index_column):
+    """
+    Righe con l'indice minimo per (tid, aid, val): il vecchio MERGE, con il
+    valore come chiave, fondeva questi output/input in un'unica relazione.
+    """
+    first = {}
+    for row in rows:
+        key = (row['tid'], row['aid'], row['val'])
+        if key not in first or row[index_column] < first[key][index_column]:
+            first[key] = row
+    return list(first.values())
+
+def backfill_edge_indexes(neo4j_connector, btc_connector, batch_blocks=100, prevout_store=None):
+    """
+    Aggiunge vout/vin alle relazioni RECEIVED/SENT caricate quando il MERGE
+    usava il valore come chiave: senza indice, ricaricare quei blocchi con le
+    query idempotenti duplicherebbe ogni relazione. I blocchi con relazioni
+    senza indice vengono riletti dal btc_connector; ogni relazione esistente
+    riceve l'indice più basso tra gli output/input con gli stessi estremi e
+    valore, e quelli che il vecchio MERGE aveva fuso vengono creati, tutto
+    nella stessa transazione. Può essere interrotta e rilanciata.
+    """
+    print("\n--- Migrazione: indici vout/vin delle relazioni RECEIVED e SENT ---")
+    first_height, high_water_mark = get_ingested_range(neo4j_connector)
+    if high_water_mark is None:
+        print("Nessun blocco presente nel grafo.")
+        return 0
+
+    total_updated = 0
+    for from_height in range(first_height, high_water_mark + 1, batch_blocks):
+        parameters = {'from_height': from_height, 'to_height': min(from_height + batch_blocks - 1, high_water_mark)}
+        records = neo4j_connector.execute_query(get_blocks_without_edge_indexes_query(), parameters=parameters)
+        for record in records:
+            height = record['height']
+            rows = build_block_rows(height, btc_connector.get_block_by_height(height), btc_connector, prevout_store)
+            outputs = [output for tx in rows['transactions'] for output in tx['outputs']]
+            inputs = [input_row for tx in rows['transactions'] for input_row in tx['inputs']]
+            neo4j_connector.execute_write([
+                (get_set_output_indexes_query(), {'outputs': _first_per_edge(outputs, 'vout')}),
+                (get_set_input_indexes_query(), {'inputs': _first_per_edge(inputs, 'vin')}),
+                (get_batch_create_outputs_query(), {'outputs': outputs}),
+                (get_batch_create_inputs_query(), {'inputs': inputs})
+            ])
+            total_updated += 1
+        print(f"  Blocchi {parameters['from_height']}-{parameters['to_height']}: "
+              f"{total_updated} blocchi aggiornati finora.  \r", end="", flush=True)
+
+    print()
+    print(f"Migrazione completata: relazioni di {total_updated} blocchi aggiornate.")
+    return total_updated
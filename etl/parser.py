@@ -1,73 +1,278 @@
+import heapq
+
+import metrics
+from .identifiers import compact_id
 from analysis.queries import (
-    get_create_transaction_query,
-    get_create_output_query,
-    get_create_input_query,
-    get_create_block_and_link_tx_query
+    DORMANCY_BANDS_YEARS,
+    DORMANCY_TOP_SPENDS,
+    get_batch_create_block_and_transactions_query,
+    get_batch_create_outputs_query,
+    get_batch_create_inputs_query,
+    get_fresh_create_block_and_transactions_query,
+    get_fresh_create_outputs_query,
+    get_fresh_create_inputs_query,
+    get_mark_block_ingested_query
 )
 
-def process_block(block_height,btc_connector, neo4j_connector):
+def _resolve_prevouts(block_data, btc_connector, prevout_store):
+    """
+    Risolve gli output spesi da tutti gli input del blocco.
+    Restituisce un dizionario {(txid, vout): (indirizzo, valore, timestamp)}.
+    Gli output non presenti nel prevout_store vengono recuperati raccogliendo
+    i txid sorgente distinti e chiedendoli al nodo con poche chiamate batch.
+    """
+    block_timestamp = block_data['time']
+    prevouts = {}
+    missing_txids = set()
+
+    for tx in block_data['tx']:
+        if tx['vin'][0].get('coinbase'):
+            continue
+        for vin in tx['vin']:
+            key = (vin['txid'], vin['vout'])
+            prevout = prevout_store.get(*key) if prevout_store is not None else None
+            if prevout is None:
+                missing_txids.add(vin['txid'])
+            else:
+                prevouts[key] = prevout
+
+    if missing_txids:
+        source_txs = btc_connector.get_transactions(sorted(missing_txids))
+        for source_txid, source_tx in source_txs.items():
+            source_tx_timestamp = source_tx.get('time', block_timestamp)
+            if prevout_store is not None:
+                prevout_store.add_transaction(source_tx, source_tx_timestamp, commit=False)
+            for n, source_vout in enumerate(source_tx['vout']):
+                prevouts[(source_txid, n)] = (
+                    source_vout['scriptPubKey'].get('address'),
+                    float(source_vout['value']),
+                    source_tx_timestamp
+                )
+        if prevout_store is not None:
+            prevout_store.commit()
+
+    return prevouts
+
+def _transaction_features(tx_row, fee):
+    """
+    Calcola le feature di una transazione salvate sul nodo Transaction, così
+    le analisi possono filtrare su proprietà indicizzate invece di espandere
+    le relazioni. Conteggi e totali riguardano, come nel grafo, solo input e
+    output con indirizzo; fee considera invece tutti gli input e output.
+    """
+    outputs, inputs = tx_row['outputs'], tx_row['inputs']
+    total_in = sum(row['val'] for row in inputs)
+    total_out = sum(row['val'] for row in outputs)
+    output_addresses = [row['addr'] for row in outputs]
+
+    self_change = (
+        len(inputs) == 1 and len(outputs) == 2 and output_addresses[0] != output_addresses[1]
+        and inputs[0]['addr'] in output_addresses
+    )
+    peel_ratio = None
+    change_output = None
+    if len(outputs) == 2:
+        if total_in > 0:
+            peel_ratio = min(row['val'] for row in outputs) / total_in
+        # A parità di valore si sceglie il secondo output, come nelle query di analisi
+        change_output = outputs[0] if outputs[0]['val'] > outputs[1]['val'] else outputs[1]
+
+    return {
+        'n_inputs': len(inputs),
+        'n_outputs': len(outputs),
+        'total_in': total_in,
+        'total_out': total_out,
+        'fee': fee,
+        'self_change': self_change,
+        'peel_ratio': peel_ratio,
+        'change_address': change_output['addr'] if change_output else None,
+        'change_aid': change_output['aid'] if change_output else None
+    }
+
+def _block_dormancy_rollup(transactions):
+    """
+    Calcola le rollup di dormienza di un blocco dagli input con indirizzo:
+    coin-days destroyed (valore x giorni), valore speso per fascia di età,
+    età massima e età delle spese più vecchie.
+    """
+    cdd = 0.0
+    spent_over = dict.fromkeys(DORMANCY_BANDS_YEARS, 0.0)
+    ages = []
+    for tx in transactions:
+        for row in tx['inputs']:
+            value, age = row['val'], row['age']
+            cdd += value * age
+            ages.append(age)
+            for years in DORMANCY_BANDS_YEARS:
+                if age >= years * 365:
+                    spent_over[years] += value
+
+    rollup = {
+        'cdd': cdd,
+        'max_age_days': max(ages, default=0.0),
+        'top_spend_ages': heapq.nlargest(DORMANCY_TOP_SPENDS, ages)
+    }
+    rollup.update({f'spent_over_{years}y': value for years, value in spent_over.items()})
+    return rollup
+
+def build_block_rows(block_height, block_data, btc_connector, prevout_store=None, id_registry=None):
+    """
+    Trasforma i dati grezzi di un blocco nelle righe da scrivere su Neo4j.
+    Gli input vengono risolti dal prevout_store (se presente) e, in caso di
+    miss, tramite chiamate batch al btc_connector. Ogni riga contiene anche
+    gli id compatti (tid, aid) usati come chiave nel grafo; con id_registry
+    (etl.identifiers.IdRegistry) le collisioni vengono rilevate come errore.
+    """
+    block_timestamp = block_data['time']
+    if prevout_store is not None:
+        # Gli output del blocco vanno registrati prima di risolvere gli input,
+        # perché una transazione può spendere un output dello stesso blocco.
+        prevout_store.add_block(block_data)
+    with metrics.timer('prevout_resolution'):
+        prevouts = _resolve_prevouts(block_data, btc_connector, prevout_store)
+
+    rows = {
+        'block': {
+            'block_height': block_height,
+            'block_hash': block_data['hash'],
+            'timestamp': block_timestamp
+        },
+        'transactions': []
+    }
+
+    for tx in block_data['tx']:
+        tx_id = tx['txid']
+        tid = compact_id(tx_id)
+        tx_row = {'tx_id': tx_id, 'tid': tid, 'outputs': [], 'inputs': []}
+
+        # 1. Output (vout è l'indice dell'output nella transazione)
+        for n, vout in enumerate(tx['vout']):
+            if 'address' in vout['scriptPubKey']:
+                address = vout['scriptPubKey']['address']
+                tx_row['outputs'].append({
+                    'tx_id': tx_id,
+                    'tid': tid,
+                    'addr': address,
+                    'aid': compact_id(address),
+                    'val': float(vout['value']),
+                    'vout': n
+                })
+
+        # 2. Input
+        fee = None
+        if not tx['vin'][0].get('coinbase'):
+            fee = -sum(float(vout['value']) for vout in tx['vout'])
+            for n, vin in enumerate(tx['vin']):
+                address, value, source_tx_timestamp = prevouts[(vin['txid'], vin['vout'])]
+                fee += value
+                if address is not None:
+                    # Calcolo dell'età
+                    age_in_seconds = block_timestamp - source_tx_timestamp
+                    age_in_days = age_in_seconds / (60 * 60 * 24) # 86400 secondi in un giorno
+
+                    tx_row['inputs'].append({
+                        'tx_id': tx_id,
+                        'tid': tid,
+                        'addr': address,
+                        'aid': compact_id(address),
+                        'val': value,
+                        'age': age_in_days,
+                        'vin': n
+                    })
+
+        # 3. Feature della transazione
+        tx_row['features'] = _transaction_features(tx_row, fee)
+        rows['transactions'].append(tx_row)
+
+    rows['block']['rollup'] = _block_dormancy_rollup(rows['transactions'])
+    if id_registry is not None:
+        id_registry.check_block_rows(rows)
+    return rows
+
+def write_block_rows(neo4j_connector, rows, tx_chunk_size=0, fresh=False):
+    """
+    Scrive le righe di un blocco con query UNWIND: ogni gruppo di al più
+    tx_chunk_size transazioni (0 = tutto il blocco) viene scritto in una sola
+    transazione esplicita composta da tre query. L'ultima transazione segna
+    anche il blocco come completato (checkpoint per --resume).
+    Con fresh il blocco deve essere nuovo: blocco, transazioni e relazioni
+    vengono creati con CREATE (solo gli Address con MERGE).
+    Restituisce il numero di query eseguite.
+    """
+    transactions = rows['transactions']
+    chunk_size = tx_chunk_size if tx_chunk_size > 0 else max(len(transactions), 1)
+
+    query_count = 0
+    for start in range(0, len(transactions), chunk_size):
+        chunk = transactions[start:start + chunk_size]
+        # Le righe sono ordinate per indirizzo: writer concorrenti acquisiscono
+        # così i lock sui nodi Address condivisi sempre nello stesso ordine,
+        # riducendo i deadlock tra processi.
+        outputs = sorted((output for tx in chunk for output in tx['outputs']), key=lambda row: row['aid'])
+        inputs = sorted((input_row for tx in chunk for input_row in tx['inputs']), key=lambda row: row['aid'])
+        if fresh:
+            block_query = get_fresh_create_block_and_transactions_query(create_block=start == 0)
+            outputs_query, inputs_query = get_fresh_create_outputs_query(), get_fresh_create_inputs_query()
+        else:
+            block_query = get_batch_create_block_and_transactions_query()
+            outputs_query, inputs_query = get_batch_create_outputs_query(), get_batch_create_inputs_query()
+        statements = [
+            (block_query,
+             dict(rows['block'], transactions=[
+                 {'tx_id': tx['tx_id'], 'tid': tx['tid'], 'features': tx['features']} for tx in chunk
+             ])),
+            (outputs_query, {'outputs': outputs}),
+            (inputs_query, {'inputs': inputs})
+        ]
+        if start + chunk_size >= len(transactions):
+            statements.append((get_mark_block_ingested_query(), {
+                'block_height': rows['block']['block_height'], 'rollup': rows['block']['rollup']
+            }))
+        query_count += neo4j_connector.execute_write(statements)
+    return query_count
+
+def process_block(block_height, btc_connector, neo4j_connector, tx_chunk_size=0, prevout_store=None,
+                  block_data=None, progress=None, id_registry=None, fresh=False):
     """
     Processa un singolo blocco, estraendo dati tramite il btc_connector
-    e caricandoli tramite il neo4j_connector.
+    e caricandoli tramite il neo4j_connector. Se block_data è già stato
+    scaricato (ad es. dal pipeline di prefetch) il blocco non viene richiesto di nuovo.
+    Tempi e contatori finiscono nel registro di metrics; l'avanzamento viene
+    stampato dal ProgressReporter progress (se presente), non a ogni blocco.
+    Con id_registry una collisione degli id compatti fa fallire il blocco.
+    Con fresh il blocco viene scritto con CREATE (write_block_rows); se
+    risulta già presente, anche in parte, viene riscritto con le query idempotenti.
+    Restituisce True se il blocco è stato scritto correttamente, False altrimenti.
     """
-    print(f"\n--- Inizio processamento del blocco {block_height} ---")
     try:
-        block_data = btc_connector.get_block_by_height(block_height)
-        transactions = block_data['tx']
-        block_hash = block_data['hash']
-        block_timestamp = block_data['time']
-
-        total_transactions = len(transactions)
-        print(f"Trovate {total_transactions} transazioni.")
-
-        for i, tx in enumerate(transactions):
-            print(f"  Processando transazione: {i + 1}/{total_transactions}  \r", end="", flush=True)
-
-            tx_id = tx['txid']
-            # 1. Usa la funzione per ottenere la query
-            neo4j_connector.execute_query(
-                get_create_transaction_query(),
-                parameters={'tx_id': tx_id, 'h': block_height}
-            )
-            # 2. Crea il nodo Blocco e collega la transazione ad esso
-            neo4j_connector.execute_query(
-                get_create_block_and_link_tx_query(),
-                parameters={
-                    'tx_id': tx_id,
-                    'block_height': block_height,
-                    'block_hash': block_hash,
-                    'timestamp': block_timestamp
-                }
-            )
-
-            # 3. Processa output
-            for vout in tx['vout']:
-                if 'address' in vout['scriptPubKey']:
-                    address = vout['scriptPubKey']['address']
-                    value = vout['value']
-                    # Usa la funzione per ottenere la query
-                    neo4j_connector.execute_query(
-                       get_create_output_query(),
-                       parameters={'tx_id': tx_id, 'addr': address, 'val': float(value)}
-                    )
-            # 4. Processa input
-            if not tx['vin'][0].get('coinbase'):
-                for vin in tx['vin']:
-                    source_tx = btc_connector.get_transaction(vin['txid'])
-                    source_vout = source_tx['vout'][vin['vout']]
-                    if 'address' in source_vout['scriptPubKey']:
-                        address = source_vout['scriptPubKey']['address']
-                        value = source_vout['value']
-                        
-                        # Calcolo dell'età
-                        source_tx_timestamp = source_tx.get('time', block_timestamp)
-                        age_in_seconds = block_timestamp - source_tx_timestamp
-                        age_in_days = age_in_seconds / (60 * 60 * 24) # 86400 secondi in un giorno
-
-                        neo4j_connector.execute_query(
-                            get_create_input_query(),
-                            parameters={'tx_id': tx_id, 'addr': address, 'val': float(value), 'age': age_in_days}
-                        )
-        print(f"--- Fine processamento del blocco {block_height} ---")
+        with metrics.timer('process_block'):
+            if block_data is None:
+                block_data = btc_connector.get_block_by_height(block_height)
+            with metrics.timer('build_block_rows'):
+                rows = build_block_rows(block_height, block_data, btc_connector, prevout_store, id_registry)
+            with metrics.timer('write_block_rows'):
+                if fresh:
+                    try:
+                        statements = write_block_rows(neo4j_connector, rows, tx_chunk_size, fresh=True)
+                    except Exception as e:
+                        metrics.inc('etl_fresh_fallbacks')
+                        print(f"Blocco {block_height} non scrivibile con CREATE ({e}): uso delle query idempotenti.")
+                        statements = write_block_rows(neo4j_connector, rows, tx_chunk_size)
+                else:
+                    statements = write_block_rows(neo4j_connector, rows, tx_chunk_size)
+
+        transactions = rows['transactions']
+        metrics.inc('etl_blocks')
+        metrics.inc('etl_statements', statements)
+        metrics.inc('etl_transactions', len(transactions))
+        metrics.inc('etl_outputs', sum(len(tx['outputs']) for tx in transactions))
+        metrics.inc('etl_inputs', sum(len(tx['inputs']) for tx in transactions))
+        if progress is not None:
+            progress.update(transazioni=len(transactions))
+        return True
     except Exception as e:
-        print(f"Errore durante il processamento del blocco {block_height}: {e}")
\ No newline at end of file
+        metrics.inc('etl_blocks_failed')
+        print(f"Errore durante il processamento del blocco {block_height}: {e}")
+        if progress is not None:
+            progress.update()
+        return False
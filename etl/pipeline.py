@@ -0,0 +1,83 @@
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+
+from metrics import ProgressReporter
+from .parser import process_block
+
+def run_pipeline(heights, btc_connector_factory, btc_connector, neo4j_connector,
+                 prefetch_depth=8, fetch_workers=2, tx_chunk_size=0, prevout_store=None,
+                 progress_interval=5.0, profiler=None, id_registry=None, fresh_from=None):
+    """
+    Esegue l'ETL sulle altezze indicate (in ordine crescente) con uno schema
+    produttore/consumatore: un pool di fetch_workers thread scarica e decodifica
+    i blocchi in anticipo mentre il thread chiamante li scrive su Neo4j in
+    ordine di altezza.
+
+    Ogni worker usa una propria connessione creata da btc_connector_factory,
+    perché AuthServiceProxy non è thread-safe. Al più prefetch_depth blocchi
+    sono in volo o in attesa di scrittura, così la memoria resta limitata.
+    Con fetch_workers <= 0 i blocchi vengono processati in modo seriale.
+    L'avanzamento viene stampato al più ogni progress_interval secondi; con
+    profiler (BlockRangeProfiler) la scrittura dei blocchi viene profilata.
+    Con id_registry (IdRegistry) vengono verificate le collisioni degli id compatti.
+    Le altezze da fresh_from in poi vengono scritte con CREATE (vedi
+    get_fresh_load_height); None per usare sempre le query idempotenti.
+    Restituisce la lista delle altezze il cui processamento è fallito.
+    """
+    progress = ProgressReporter('ETL', len(heights) if hasattr(heights, '__len__') else None, progress_interval)
+    heights = iter(heights)
+    failed_heights = []
+
+    def write(height, block_data=None):
+        if profiler is not None:
+            profiler.block_started(height)
+        fresh = fresh_from is not None and height >= fresh_from
+        if not process_block(height, btc_connector, neo4j_connector, tx_chunk_size, prevout_store,
+                             block_data, progress, id_registry, fresh):
+            failed_heights.append(height)
+        if profiler is not None:
+            profiler.block_finished(height)
+
+    if fetch_workers <= 0:
+        for height in heights:
+            write(height)
+        _finish(progress, profiler)
+        return failed_heights
+
+    local = threading.local()
+
+    def fetch(height):
+        if not hasattr(local, 'connector'):
+            local.connector = btc_connector_factory()
+        return local.connector.get_block_by_height(height)
+
+    prefetch_depth = max(1, prefetch_depth)
+    with ThreadPoolExecutor(max_workers=fetch_workers, thread_name_prefix='fetch') as executor:
+        # La coda è limitata: si sottomette un nuovo blocco solo quando il
+        # writer ne preleva uno (backpressure).
+        pending = deque((height, executor.submit(fetch, height)) for height in islice(heights, prefetch_depth))
+
+        while pending:
+            height, future = pending.popleft()
+            next_height = next(heights, None)
+            if next_height is not None:
+                pending.append((next_height, executor.submit(fetch, next_height)))
+
+            try:
+                block_data = future.result()
+            except Exception as e:
+                # Il blocco verrà richiesto di nuovo dal writer con la sua connessione
+                print(f"\nErrore nel prefetch del blocco {height}: {e}. Nuovo tentativo in linea.")
+                block_data = None
+
+            write(height, block_data)
+
+    _finish(progress, profiler)
+    return failed_heights
+
+def _finish(progress, profiler):
+    progress.report()
+    if profiler is not None:
+        profiler.dump()
@@ -0,0 +1,90 @@
+import sqlite3
+from collections import OrderedDict
+
+class PrevoutStore:
+    """
+    Indice locale e persistente degli output già visti, con chiave (txid, vout).
+    Permette di risolvere gli input di una transazione senza chiamare
+    getrawtransaction sul nodo. Davanti al file SQLite c'è una cache LRU
+    in memoria di dimensione limitata.
+    """
+    def __init__(self, path, cache_size=200000):
+        self._conn = sqlite3.connect(path, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS prevouts ("
+            "txid TEXT NOT NULL, vout INTEGER NOT NULL, "
+            "address TEXT, value REAL NOT NULL, time INTEGER NOT NULL, "
+            "PRIMARY KEY (txid, vout)) WITHOUT ROWID"
+        )
+        self._conn.commit()
+        self._cache = OrderedDict()
+        self._cache_size = cache_size
+
+        # Contatori esposti tramite stats()
+        self.cache_hits = 0
+        self.store_hits = 0
+        self.misses = 0
+
+    def _cache_put(self, key, prevout):
+        self._cache[key] = prevout
+        self._cache.move_to_end(key)
+        if len(self._cache) > self._cache_size:
+            self._cache.popitem(last=False)
+
+    def add_transaction(self, tx, timestamp, commit=True):
+        """Registra tutti gli output di una transazione decodificata."""
+        rows = []
+        for n, vout in enumerate(tx['vout']):
+            prevout = (vout['scriptPubKey'].get('address'), float(vout['value']), timestamp)
+            self._cache_put((tx['txid'], n), prevout)
+            rows.append((tx['txid'], n) + prevout)
+        self._conn.executemany("INSERT OR REPLACE INTO prevouts VALUES (?, ?, ?, ?, ?)", rows)
+        if commit:
+            self._conn.commit()
+
+    def add_block(self, block_data):
+        """Registra gli output di tutte le transazioni di un blocco."""
+        for tx in block_data['tx']:
+            self.add_transaction(tx, block_data['time'], commit=False)
+        self._conn.commit()
+
+    def get(self, txid, vout):
+        """
+        Restituisce (indirizzo, valore, timestamp) dell'output richiesto,
+        oppure None se non è presente nell'indice.
+        """
+        key = (txid, vout)
+        prevout = self._cache.get(key)
+        if prevout is not None:
+            self._cache.move_to_end(key)
+            self.cache_hits += 1
+            return prevout
+
+        row = self._conn.execute(
+            "SELECT address, value, time FROM prevouts WHERE txid = ? AND vout = ?", key
+        ).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+
+        prevout = tuple(row)
+        self._cache_put(key, prevout)
+        self.store_hits += 1
+        return prevout
+
+    def commit(self):
+        self._conn.commit()
+
+    def stats(self):
+        """Restituisce i contatori di hit/miss accumulati finora."""
+        return {
+            'cache_hits': self.cache_hits,
+            'store_hits': self.store_hits,
+            'misses': self.misses
+        }
+
+    def close(self):
+        self._conn.commit()
+        self._conn.close()
@@ -0,0 +1,114 @@
+import inspect
+import re
+
+from analysis import queries
+from analysis.queries import get_schema_queries, get_show_schema_query, get_await_indexes_query
+
+# Operatori di scansione che non devono comparire nei piani delle query
+FORBIDDEN_OPERATORS = {'AllNodesScan', 'NodeByLabelScan'}
+
+# Query builder che, per natura, devono esaminare tutte le transazioni (o tutti
+# i blocchi) e per cui una NodeByLabelScan è attesa. Le loro varianti
+# incrementali e per finestre invece devono usare l'indice su block_height,
+# quelle paginate l'indice su tid.
+EXPECTED_LABEL_SCANS = {
+    'get_fan_out_query',
+    'get_fan_in_query',
+    'get_peeling_chain_link_query',
+    'get_full_peeling_chain_query',
+    'get_self_change_peel_link_query',
+    'get_peel_links_with_successors_query',
+    'get_memory_transactions_query',
+    'get_memory_received_query',
+    'get_memory_sent_query',
+    'get_dormancy_summary_query',
+    'get_graph_fingerprint_query',
+    # Migrazione agli id compatti: cercano per txid/address, indicizzati solo
+    # nei grafi da migrare
+    'get_set_transaction_ids_query',
+    'get_set_address_ids_query',
+}
+
+# Funzioni di queries.py che non sono query da verificare con EXPLAIN
+NOT_CHECKED = {
+    'get_clear_database_query',
+    'get_schema_queries',
+    'get_show_schema_query',
+    'get_await_indexes_query',
+}
+
+def ensure_schema(neo4j_connector, timeout=300):
+    """
+    Crea (se mancanti) vincoli di unicità e indici, attende che siano ONLINE
+    e verifica che siano tutti presenti. Restituisce True se lo schema è completo.
+    """
+    schema_queries = get_schema_queries()
+    for query in schema_queries.values():
+        neo4j_connector.execute_query(query)
+    neo4j_connector.execute_query(get_await_indexes_query(), parameters={'timeout': timeout})
+
+    states = {record['name']: record['state'] for record in neo4j_connector.execute_query(get_show_schema_query())}
+    problems = [
+        f"{name}: {states.get(name, 'MANCANTE')}"
+        for name in schema_queries if states.get(name) != 'ONLINE'
+    ]
+    if problems:
+        print(f"Schema incompleto: {', '.join(problems)}")
+        return False
+    print(f"Schema verificato: {len(schema_queries)} vincoli/indici ONLINE.")
+    return True
+
+def _iter_query_variants():
+    """Genera (etichetta, nome builder, query) per ogni query builder di queries.py."""
+    for name, builder in inspect.getmembers(queries, inspect.isfunction):
+        if not name.startswith('get_') or name in NOT_CHECKED or builder.__module__ != queries.__name__:
+            continue
+        yield name, name, builder()
+        parameters = inspect.signature(builder).parameters
+        if 'incremental' in parameters:
+            yield f"{name}(incremental)", name, builder(incremental=True)
+        if 'windowed' in parameters:
+            yield f"{name}(windowed)", name, builder(windowed=True)
+        if 'paged' in parameters:
+            yield f"{name}(paged)", name, builder(paged=True)
+        if 'backward' in parameters:
+            yield f"{name}(backward)", name, builder(backward=True)
+
+def _plan_operators(plan):
+    """Restituisce tutti gli operatori di un piano, senza il suffisso '@database'."""
+    operators = [plan['operatorType'].split('@')[0]]
+    for child in plan.get('children', []):
+        operators.extend(_plan_operators(child))
+    return operators
+
+def check_query_plans(neo4j_connector):
+    """
+    Esegue EXPLAIN su ogni query di analysis/queries.py e segnala i piani che
+    contengono AllNodesScan o NodeByLabelScan non attese.
+    Restituisce True se tutti i piani sono conformi.
+    """
+    print("\n--- Verifica dei piani di esecuzione ---")
+    failures = 0
+    for label, name, query in _iter_query_variants():
+        # I valori dei parametri sono irrilevanti per EXPLAIN, basta che siano presenti
+        parameters = {param: None for param in re.findall(r'\$(\w+)', query)}
+        try:
+            operators = _plan_operators(neo4j_connector.explain_query(query, parameters))
+        except Exception as e:
+            print(f"  [ERRORE] {label}: {e}")
+            failures += 1
+            continue
+
+        scans = sorted(FORBIDDEN_OPERATORS.intersection(operators))
+        allowed = label == name and name in EXPECTED_LABEL_SCANS and scans == ['NodeByLabelScan']
+        if scans and not allowed:
+            print(f"  [FALLITO] {label}: {', '.join(scans)}")
+            failures += 1
+        else:
+            print(f"  [OK] {label}")
+
+    if failures:
+        print(f"  > {failures} query con piani non conformi.")
+        return False
+    print("  > Tutti i piani sono conformi.")
+    return True
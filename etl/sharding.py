@@ -0,0 +1,156 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+from metrics import JsonMetricsWriter, BlockRangeProfiler
+from .pipeline import run_pipeline
+from .prevout_store import PrevoutStore
+from .identifiers import IdRegistry
+
+def split_into_shards(heights, workers, shards_per_worker=4):
+    """
+    Divide la lista ordinata di altezze in gruppi contigui. Si creano più shard
+    che worker così che i processi più veloci ne prendano di nuovi.
+    """
+    shard_size = max(1, -(-len(heights) // (workers * shards_per_worker)))
+    return [heights[start:start + shard_size] for start in range(0, len(heights), shard_size)]
+
+def _run_shard(heights, btc_connector_factory, neo4j_connector_factory, options):
+    """
+    Eseguito in un processo figlio: apre connettori propri, processa le
+    altezze dello shard e restituisce le statistiche di esecuzione.
+    Metriche (<metrics_file>.<pid>) e profili (<profile_dir>/<pid>) sono per processo.
+    """
+    started = time.monotonic()
+    neo4j_connector = neo4j_connector_factory()
+    prevout_store = None
+    if options['prevout_db_path']:
+        prevout_store = PrevoutStore(options['prevout_db_path'], options['prevout_cache_size'])
+    id_registry = None
+    if options['id_registry_path']:
+        id_registry = IdRegistry(options['id_registry_path'], options['id_registry_cache_size'])
+    metrics_writer = None
+    if options['metrics_file']:
+        metrics_writer = JsonMetricsWriter(f"{options['metrics_file']}.{os.getpid()}", options['metrics_interval'])
+    profiler = None
+    if options['profile_dir']:
+        profiler = BlockRangeProfiler(os.path.join(options['profile_dir'], str(os.getpid())),
+                                      options['profile_blocks'])
+    try:
+        btc_connector = btc_connector_factory()
+        failed_heights = run_pipeline(
+            heights, btc_connector_factory, btc_connector, neo4j_connector,
+            prefetch_depth=options['prefetch_depth'],
+            fetch_workers=options['fetch_workers'],
+            tx_chunk_size=options['tx_chunk_size'],
+            prevout_store=prevout_store,
+            progress_interval=options['progress_interval'],
+            profiler=profiler,
+            id_registry=id_registry,
+            fresh_from=options['fresh_from']
+        )
+    finally:
+        if prevout_store is not None:
+            prevout_store.close()
+        if id_registry is not None:
+            id_registry.close()
+        if metrics_writer is not None:
+            metrics_writer.close()
+        neo4j_connector.close()
+
+    return {
+        'pid': os.getpid(),
+        'blocks': len(heights) - len(failed_heights),
+        'failed_heights': failed_heights,
+        'elapsed': time.monotonic() - started
+    }
+
+def run_sharded(heights, workers, btc_connector_factory, neo4j_connector_factory,
+                options, max_retries=2):
+    """
+    Coordinatore dell'ETL multi-processo. Suddivide le altezze in shard,
+    li esegue in workers processi separati (ognuno con i propri connettori)
+    e tiene traccia dello stato di ciascuno. Gli shard falliti, o i singoli
+    blocchi falliti al loro interno (ad es. per deadlock persistenti sui nodi
+    Address condivisi), vengono rimessi in coda fino a max_retries volte.
+
+    Le factory devono essere funzioni definite a livello di modulo, perché
+    vengono passate ai processi figli.
+    Restituisce la lista delle altezze non processate dopo tutti i tentativi.
+    """
+    shards = split_into_shards(list(heights), workers)
+    # Stato per shard: altezze, tentativi effettuati e stato corrente
+    state = {
+        i: {'heights': shard_heights, 'attempts': 0, 'status': 'in attesa'}
+        for i, shard_heights in enumerate(shards)
+    }
+    queue = list(state)
+    worker_stats = {}
+    unrecoverable = []
+
+    print(f"Avvio di {workers} processi su {len(shards)} shard.")
+    started = time.monotonic()
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        running = {}
+
+        def submit(shard_id):
+            shard = state[shard_id]
+            shard['attempts'] += 1
+            shard['status'] = 'in esecuzione'
+            future = executor.submit(
+                _run_shard, shard['heights'], btc_connector_factory, neo4j_connector_factory, options
+            )
+            running[future] = shard_id
+
+        while queue or running:
+            while queue and len(running) < workers:
+                submit(queue.pop(0))
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                shard_id = running.pop(future)
+                shard = state[shard_id]
+                heights = shard['heights']
+                try:
+                    result = future.result()
+                except Exception as e:
+                    print(f"\n[Coordinatore] Shard {shard_id} ({heights[0]}-{heights[-1]}) terminato con errore: {e}")
+                    failed_heights = list(heights)
+                else:
+                    failed_heights = result['failed_heights']
+                    stats = worker_stats.setdefault(result['pid'], {'blocks': 0, 'elapsed': 0.0})
+                    stats['blocks'] += result['blocks']
+                    stats['elapsed'] += result['elapsed']
+                    print(f"\n[Coordinatore] Shard {shard_id} ({heights[0]}-{heights[-1]}) completato dal processo "
+                          f"{result['pid']}: {result['blocks']} blocchi in {result['elapsed']:.1f}s.")
+
+                if not failed_heights:
+                    shard['status'] = 'completato'
+                elif shard['attempts'] <= max_retries:
+                    # Si ritentano solo le altezze fallite
+                    shard['heights'] = failed_heights
+                    shard['status'] = 'in attesa'
+                    queue.append(shard_id)
+                    print(f"[Coordinatore] Shard {shard_id}: {len(failed_heights)} blocchi da ritentare "
+                          f"(tentativo {shard['attempts'] + 1}/{max_retries + 1}).")
+                else:
+                    shard['status'] = 'fallito'
+                    unrecoverable.extend(failed_heights)
+
+            completed = sum(1 for shard in state.values() if shard['status'] == 'completato')
+            print(f"[Coordinatore] Shard completati: {completed}/{len(shards)}")
+
+    elapsed = time.monotonic() - started
+    total_blocks = sum(stats['blocks'] for stats in worker_stats.values())
+
+    print("\n--- Throughput ETL multi-processo ---")
+    for pid, stats in sorted(worker_stats.items()):
+        rate = stats['blocks'] / stats['elapsed'] if stats['elapsed'] else 0.0
+        print(f"  Processo {pid}: {stats['blocks']} blocchi, {rate:.2f} blocchi/s")
+    total_rate = total_blocks / elapsed if elapsed else 0.0
+    print(f"  Totale: {total_blocks} blocchi in {elapsed:.1f}s, {total_rate:.2f} blocchi/s")
+    if unrecoverable:
+        print(f"  Blocchi non processati dopo {max_retries + 1} tentativi: {sorted(unrecoverable)}")
+
+    return sorted(unrecoverable)
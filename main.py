@@ -1,31 +1,364 @@
 import argparse
+import atexit
+import os
 import sys
+from functools import partial
 import config
+import metrics
 from connectors.bitcoin_connector import BitcoinConnector
+from connectors.blk_file_connector import BlkFileConnector
 from connectors.neo4j_connector import Neo4jConnector
-from etl.parser import process_block
-from etl.clustering import *
+from etl.pipeline import run_pipeline
+from etl.sharding import run_sharded
+from etl.export import run_export
+from etl.parser import build_block_rows
+from etl.prevout_store import PrevoutStore
+from etl.identifiers import IdRegistry
+from etl.schema import ensure_schema, check_query_plans
+from etl.checkpoint import (
+    get_ingested_range, get_pending_heights, save_etl_state, get_graph_watermark, get_fresh_load_height
+)
+from etl.clustering import apply_common_input_ownership, rewind_cluster_state
+from etl.follow import follow_chain, ZmqBlockNotifier
+from etl.migrations import (
+    backfill_compact_ids, backfill_edge_indexes, backfill_transaction_features, backfill_block_rollups
+)
 from analysis import fan_analysis, peel_chain_analysis, dormant_funds_analysis, self_change_peel_analysis
+from analysis import trace_analysis
+from analysis.executor import run_analyses
+from analysis.windows import split_windows, height_parameters
+from analysis.queries import get_transactions_without_features_query
+from analysis.cache import AnalysisCache, cached
+from analysis.sinks import SINK_FORMATS, with_sink
+from analysis import memory_graph
 
 
+def create_btc_connector():
+    """Crea una nuova connessione RPC al nodo Bitcoin usando la configurazione."""
+    return BitcoinConnector(
+        config.RPC_USER, config.RPC_PASS, config.RPC_HOST, config.RPC_PORT, config.RPC_BATCH_SIZE
+    )
 
-def run_analysis(neo4j_conn, analysis_type='all', dormant_years=5):
+def create_block_source(source='rpc'):
+    """
+    Crea la sorgente dei blocchi: 'rpc' interroga il nodo, 'blk' legge
+    direttamente i file blk*.dat (con il nodo RPC come fallback, se configurato).
+    """
+    if source == 'blk':
+        fallback = create_btc_connector() if config.RPC_HOST else None
+        return BlkFileConnector(config.BLOCKS_DIR, config.BITCOIN_NETWORK, fallback, config.BLK_MAX_OPEN_FILES)
+    return create_btc_connector()
+
+def create_neo4j_connector():
+    """Crea una nuova connessione a Neo4j usando la configurazione."""
+    return Neo4jConnector(
+        config.NEO4J_URI, config.NEO4J_USER, config.NEO4J_PASS, config.NEO4J_MAX_RETRY_TIME,
+        fetch_size=config.NEO4J_FETCH_SIZE,
+        query_timeout=config.NEO4J_QUERY_TIMEOUT or None,
+        max_connection_pool_size=config.NEO4J_MAX_POOL_SIZE
+    )
+
+def count_transactions_without_features(neo4j_conn, heights=None, window=None):
+    """
+    Conta le transazioni dei blocchi in heights, della finestra window o (senza
+    nessuno dei due) dell'intervallo dei blocchi completati che non hanno le feature.
+    """
+    if heights is None and window is None:
+        first_height, high_water_mark = get_ingested_range(neo4j_conn)
+        if high_water_mark is None:
+            return 0
+        window = (first_height, high_water_mark)
+    records = neo4j_conn.execute_query(
+        get_transactions_without_features_query(incremental=heights is not None),
+        parameters=height_parameters(heights, window)
+    )
+    return records[0]['transactions'] if records else 0
+
+def run_analysis(neo4j_conn, analysis_type='all', dormant_years=5, heights=None, use_features=True, graph=None,
+                 cache=None, sink_options=None, trace_options=None, window=None):
     """
     Avvia l'esecuzione dei moduli di analisi in base al tipo scelto.
+    Se heights è indicato, le analisi considerano solo le transazioni di quei blocchi;
+    altrimenti solo quelle dell'intervallo di altezze window (da, a), se indicato.
+    Su Neo4j l'intervallo (o, senza window, quello dei blocchi completati) viene
+    diviso in finestre di ANALYSIS_WINDOW_SIZE blocchi, lette in parallelo
+    (ANALYSIS_WINDOW_WORKERS per analisi).
+    Con use_features le analisi usano le feature delle transazioni salvate in fase
+    di ingest (per i grafi caricati in precedenza serve --action migrate): se
+    alcune transazioni ne sono prive vengono usate le query complete.
+    Le analisi sono indipendenti e vengono eseguite in parallelo (ANALYSIS_WORKERS).
+    Con graph (MemoryGraph) le analisi vengono eseguite in memoria e neo4j_conn non è usato.
+    Con cache (AnalysisCache, solo sull'intero grafo Neo4j) i risultati già
+    calcolati per gli stessi parametri e gli stessi blocchi vengono riutilizzati.
+    Con sink_options (format, output_dir, compress, batch_size) i risultati
+    vengono scritti in file JSONL/Parquet e la cache non viene usata.
+    Il tracciamento dei fondi ('trace', non incluso in 'all') usa trace_options
+    (punti di partenza e limiti della visita, vedi create_trace_options).
     """
     print(f"\n--- AVVIO FASE DI ANALISI (Tipo: {analysis_type.upper()}) ---")
 
+    if use_features and graph is None and analysis_type != 'trace':
+        missing = count_transactions_without_features(neo4j_conn, heights, window)
+        if missing:
+            print(f"ATTENZIONE: {missing} transazioni senza feature (eseguire --action migrate): "
+                  "uso delle query complete.")
+            use_features = False
+
+    windows = None
+    if heights is None and graph is not None:
+        # In memoria non serve dividere: il filtro sulle altezze è una maschera NumPy
+        windows = [window] if window is not None else None
+    elif heights is None and config.ANALYSIS_WINDOW_SIZE > 0:
+        span = window
+        if span is None:
+            first_height, high_water_mark = get_ingested_range(neo4j_conn)
+            span = (first_height, high_water_mark) if high_water_mark is not None else None
+        if span is not None:
+            windows = split_windows(span[0], span[1], config.ANALYSIS_WINDOW_SIZE)
+            print(f"Blocchi {span[0]}-{span[1]} in {len(windows)} finestre di al più "
+                  f"{config.ANALYSIS_WINDOW_SIZE} blocchi.")
+    elif heights is None and window is not None:
+        windows = [window]
+    window_options = {'windows': windows, 'window_workers': config.ANALYSIS_WINDOW_WORKERS}
+
+    # (nome, funzione, parametri che determinano il risultato)
+    tasks = []
     if analysis_type == 'fan' or analysis_type == 'all':
-        fan_analysis.run(neo4j_conn)
+        tasks.append(('fan', partial(fan_analysis.run, neo4j_conn, heights=heights, use_features=use_features,
+                                     page_size=config.ANALYSIS_PAGE_SIZE, graph=graph, **window_options),
+                      {'use_features': use_features}))
     
     if analysis_type == 'peel-sc' or analysis_type == 'all':
-        self_change_peel_analysis.run(neo4j_conn)
+        tasks.append(('peel-sc', partial(self_change_peel_analysis.run, neo4j_conn, heights=heights,
+                                         use_features=use_features, graph=graph, **window_options),
+                      {'use_features': use_features}))
     
     if analysis_type == 'peel-heuristic' or analysis_type == 'all':
-        peel_chain_analysis.run(neo4j_conn)
+        tasks.append(('peel-heuristic', partial(peel_chain_analysis.run, neo4j_conn, heights=heights,
+                                                use_features=use_features, graph=graph, **window_options),
+                      {'use_features': use_features}))
     
     if analysis_type == 'dormant' or analysis_type == 'all':
-        dormant_funds_analysis.run(neo4j_conn, dormant_years)
+        tasks.append(('dormant', partial(dormant_funds_analysis.run, neo4j_conn, dormant_years, heights=heights,
+                                         graph=graph, use_rollups=use_features, **window_options),
+                      {'min_age_years': dormant_years, 'use_rollups': use_features}))
+
+    if analysis_type == 'trace':
+        tasks.append(('trace', partial(trace_analysis.run, neo4j_conn, graph=graph, **trace_options), trace_options))
+
+    if sink_options is not None:
+        tasks = [(name, with_sink(function, name, **sink_options), parameters) for name, function, parameters in tasks]
+    elif cache is not None and graph is None and heights is None and window is None:
+        watermark = get_graph_watermark(neo4j_conn)
+        return run_analyses(
+            [(name, cached(cache, name, function, parameters, watermark)) for name, function, parameters in tasks],
+            max_workers=config.ANALYSIS_WORKERS
+        )
+    return run_analyses([(name, function) for name, function, _ in tasks], max_workers=config.ANALYSIS_WORKERS)
+
+def create_sink_options(args):
+    """Opzioni dell'output strutturato delle analisi scelte da riga di comando (None per la console)."""
+    if args.output_format == 'console':
+        return None
+    return {
+        'format': args.output_format,
+        'output_dir': args.results_dir,
+        'compress': args.compress,
+        'batch_size': config.ANALYSIS_SINK_BATCH_SIZE
+    }
+
+def create_trace_options(args):
+    """Punti di partenza e limiti del tracciamento dei fondi scelti da riga di comando."""
+    return {
+        'txids': args.trace_txid or [],
+        'addresses': args.trace_address or [],
+        'direction': args.direction,
+        'max_depth': args.depth,
+        'max_fanout': args.max_fanout,
+        'min_value': args.min_value,
+        'max_frontier': config.TRACE_MAX_FRONTIER,
+        'batch_size': config.TRACE_BATCH_SIZE
+    }
+
+def create_analysis_window(args, neo4j_conn):
+    """
+    Intervallo di altezze (da, a) delle analisi scelto con --from-height e
+    --to-height (None per l'intero grafo). Senza --to-height si arriva
+    all'high-water mark, senza --from-height si parte da 0.
+    """
+    if args.from_height is None and args.to_height is None:
+        return None
+    from_height = args.from_height if args.from_height is not None else 0
+    to_height = args.to_height
+    if to_height is None:
+        _, high_water_mark = get_ingested_range(neo4j_conn)
+        to_height = high_water_mark if high_water_mark is not None else from_height
+    return from_height, to_height
+
+def create_analysis_cache(enabled=True):
+    """Crea la cache dei risultati delle analisi configurata (None se disattivata)."""
+    if not enabled or not config.ANALYSIS_CACHE_DIR:
+        return None
+    return AnalysisCache(config.ANALYSIS_CACHE_DIR, config.ANALYSIS_CACHE_MAX_MB << 20)
+
+def run_clustering(neo4j_conn, heights=None):
+    """Aggiorna i cluster di indirizzi (entity_id) con lo stato persistente configurato."""
+    apply_common_input_ownership(
+        neo4j_conn, heights,
+        state_path=config.CLUSTER_STATE_PATH,
+        page_blocks=config.CLUSTER_PAGE_BLOCKS,
+        write_batch_size=config.CLUSTER_WRITE_BATCH_SIZE,
+        # Le riorganizzazioni più profonde non vengono comunque gestite dal follow
+        history_blocks=config.FOLLOW_MAX_REORG_DEPTH
+    )
+
+def build_memory_graph(heights, block_source):
+    """
+    ETL verso il backend in memoria: i blocchi vengono letti dalla sorgente e
+    caricati direttamente nel MemoryGraph, senza passare da Neo4j.
+    Restituisce (grafo, altezze fallite).
+    """
+    prevout_store = None
+    if config.PREVOUT_DB_PATH:
+        prevout_store = PrevoutStore(config.PREVOUT_DB_PATH, config.PREVOUT_CACHE_SIZE)
+
+    builder = memory_graph.MemoryGraphBuilder()
+    failed_heights = []
+    for height in heights:
+        try:
+            block_data = block_source.get_block_by_height(height)
+            builder.add_block_rows(build_block_rows(height, block_data, block_source, prevout_store))
+            print(f"Blocco {height} caricato in memoria.  \r", end="", flush=True)
+        except Exception as e:
+            print(f"\nErrore durante il caricamento del blocco {height}: {e}")
+            failed_heights.append(height)
+
+    if prevout_store is not None:
+        prevout_store.close()
+    graph = builder.build()
+    print(f"\nGrafo in memoria: {len(graph)} transazioni, {len(graph.addresses)} indirizzi.")
+    return graph, failed_heights
+
+def run_etl(args, heights, btc_conn, neo4j_conn):
+    """
+    Esegue l'ETL sulle altezze indicate, in un solo processo o in più shard.
+    Restituisce la lista delle altezze fallite.
+    """
+    # partial di una funzione di modulo: può essere passata anche ai processi figli
+    block_source_factory = partial(create_block_source, args.source)
+    # Altezza calcolata una sola volta, prima di dividere il lavoro tra i processi
+    fresh_from = get_fresh_load_height(neo4j_conn) if config.ETL_FRESH_LOAD else None
+
+    if args.workers > 1:
+        # Ogni processo apre le proprie connessioni e il proprio accesso all'indice prevout
+        return run_sharded(
+            heights, args.workers, block_source_factory, create_neo4j_connector,
+            options={
+                'prefetch_depth': args.prefetch,
+                'fetch_workers': args.fetch_workers,
+                'tx_chunk_size': config.ETL_TX_CHUNK_SIZE,
+                'prevout_db_path': config.PREVOUT_DB_PATH,
+                'prevout_cache_size': config.PREVOUT_CACHE_SIZE,
+                'id_registry_path': config.ID_REGISTRY_PATH,
+                'id_registry_cache_size': config.ID_REGISTRY_CACHE_SIZE,
+                'progress_interval': config.ETL_PROGRESS_INTERVAL,
+                'metrics_file': args.metrics_file,
+                'metrics_interval': config.METRICS_INTERVAL,
+                'profile_dir': args.profile_dir,
+                'profile_blocks': config.PROFILE_BLOCKS,
+                'fresh_from': fresh_from
+            },
+            max_retries=config.ETL_SHARD_RETRIES
+        )
+
+    prevout_store = None
+    if config.PREVOUT_DB_PATH:
+        prevout_store = PrevoutStore(config.PREVOUT_DB_PATH, config.PREVOUT_CACHE_SIZE)
+    id_registry = None
+    if config.ID_REGISTRY_PATH:
+        id_registry = IdRegistry(config.ID_REGISTRY_PATH, config.ID_REGISTRY_CACHE_SIZE)
+    profiler = None
+    if args.profile_dir:
+        profiler = metrics.BlockRangeProfiler(args.profile_dir, config.PROFILE_BLOCKS)
+
+    failed_heights = run_pipeline(
+        heights, block_source_factory, btc_conn, neo4j_conn,
+        prefetch_depth=args.prefetch,
+        fetch_workers=args.fetch_workers,
+        tx_chunk_size=config.ETL_TX_CHUNK_SIZE,
+        prevout_store=prevout_store,
+        progress_interval=config.ETL_PROGRESS_INTERVAL,
+        profiler=profiler,
+        id_registry=id_registry,
+        fresh_from=fresh_from
+    )
+    if id_registry is not None:
+        id_registry.close()
+
+    if prevout_store is not None:
+        stats = prevout_store.stats()
+        print(f"\nIndice prevout: {stats['cache_hits']} hit in cache, "
+              f"{stats['store_hits']} hit su disco, {stats['misses']} miss (RPC).")
+        prevout_store.close()
+    return failed_heights
+
+def run_follow(args, btc_conn, neo4j_conn):
+    """
+    Segue il tip del nodo: ogni nuovo blocco viene caricato appena compare e
+    clustering e analisi (--type) vengono eseguiti solo sui blocchi aggiunti.
+    Dopo una riorganizzazione lo stato del clustering viene riportato al
+    punto di fork e la cache dei risultati viene svuotata.
+    """
+    prevout_store = None
+    if config.PREVOUT_DB_PATH:
+        prevout_store = PrevoutStore(config.PREVOUT_DB_PATH, config.PREVOUT_CACHE_SIZE)
+    id_registry = None
+    if config.ID_REGISTRY_PATH:
+        id_registry = IdRegistry(config.ID_REGISTRY_PATH, config.ID_REGISTRY_CACHE_SIZE)
+    notifier = ZmqBlockNotifier(config.FOLLOW_ZMQ_ENDPOINT) if config.FOLLOW_ZMQ_ENDPOINT else None
+    sink_options = create_sink_options(args)
+
+    def on_blocks(heights, fork_height):
+        if fork_height is not None:
+            rewind_cluster_state(
+                neo4j_conn, config.CLUSTER_STATE_PATH, fork_height, config.CLUSTER_WRITE_BATCH_SIZE
+            )
+            cache = create_analysis_cache()
+            if cache is not None:
+                cache.clear()
+        if not heights:
+            return
+        run_clustering(neo4j_conn, heights=heights)
+        if args.type != 'none':
+            # Una cartella di risultati per ogni gruppo di blocchi, invece di riscrivere sempre gli stessi file
+            block_sink_options = sink_options and dict(
+                sink_options, output_dir=os.path.join(sink_options['output_dir'], f"blocks-{heights[0]}-{heights[-1]}")
+            )
+            run_analysis(neo4j_conn, args.type, args.years, heights=heights, use_features=not args.legacy_queries,
+                         sink_options=block_sink_options, trace_options=create_trace_options(args))
+
+    try:
+        follow_chain(
+            btc_conn, neo4j_conn,
+            start_height=args.start_block,
+            poll_interval=config.FOLLOW_POLL_INTERVAL,
+            max_reorg_depth=config.FOLLOW_MAX_REORG_DEPTH,
+            tx_chunk_size=config.ETL_TX_CHUNK_SIZE,
+            prevout_store=prevout_store,
+            id_registry=id_registry,
+            notifier=notifier,
+            on_blocks=on_blocks,
+            fresh_load=config.ETL_FRESH_LOAD
+        )
+    except KeyboardInterrupt:
+        print("\n[Follow] Interrotto.")
+    finally:
+        if notifier is not None:
+            notifier.close()
+        if id_registry is not None:
+            id_registry.close()
+        if prevout_store is not None:
+            prevout_store.close()
     
 def main():
     parser = argparse.ArgumentParser(
@@ -35,22 +368,53 @@ def main():
     parser.add_argument(
         '--action', 
         required=True, 
-        choices=['etl', 'analyze'], 
+        choices=['etl', 'follow', 'analyze', 'export', 'check-schema', 'migrate'], 
         help=(
             "'etl': Esegue l'estrazione dei blocchi, il clustering e l'analisi.\n"
-            "'analyze': Esegue solo clustering e analisi sui dati esistenti."
+            "'follow': Resta connesso al nodo e carica ogni nuovo blocco appena compare\n"
+            "  (con rollback delle riorganizzazioni), con clustering e analisi incrementali.\n"
+            "'export': Esporta i blocchi in file CSV per 'neo4j-admin database import'.\n"
+            "'analyze': Esegue solo clustering e analisi sui dati esistenti.\n"
+            "'check-schema': Verifica vincoli/indici e i piani (EXPLAIN) di tutte le query.\n"
+            "'migrate': Calcola id compatti, indici vout/vin delle relazioni, feature delle transazioni\n"
+            "  e rollup dei blocchi caricati in precedenza (gli indici richiedono la sorgente dei blocchi)."
         )
     )
     
-    parser.add_argument('--start-block', type=int, help="Il blocco di partenza per l'ETL.")
+    parser.add_argument('--start-block', type=int,
+                        help="Il blocco di partenza per l'ETL (con --action follow: solo se il grafo è vuoto).")
     parser.add_argument('--end-block', type=int, help="Il blocco di fine per l'ETL.")
     
     parser.add_argument(
         '--type',
-        choices=['fan', 'peel-sc', 'peel-heuristic', 'dormant', 'all'],
+        choices=['fan', 'peel-sc', 'peel-heuristic', 'dormant', 'all', 'none', 'trace'],
         default='all',
-        help="Specifica il tipo di analisi da eseguire (usato con --action analyze)."
+        help=(
+            "Specifica il tipo di analisi da eseguire (usato con --action analyze e follow;\n"
+            "'none' per il solo clustering). 'trace' segue i fondi a partire da\n"
+            "--trace-txid/--trace-address e non è incluso in 'all'."
+        )
+    )
+    parser.add_argument('--trace-txid', action='append', help="Transazione di partenza di --type trace (ripetibile).")
+    parser.add_argument('--trace-address', action='append', help="Indirizzo di partenza di --type trace (ripetibile).")
+    parser.add_argument(
+        '--direction',
+        choices=trace_analysis.TRACE_DIRECTIONS,
+        default='forward',
+        help="Con --type trace: 'forward' segue dove vengono spesi i fondi, 'backward' da dove provengono."
     )
+    parser.add_argument('--depth', type=int, default=config.TRACE_MAX_DEPTH,
+                        help=f"Livelli visitati da --type trace (default: {config.TRACE_MAX_DEPTH}).")
+    parser.add_argument('--max-fanout', type=int, default=config.TRACE_MAX_FANOUT,
+                        help=f"Archi seguiti al più per nodo da --type trace (default: {config.TRACE_MAX_FANOUT}).")
+    parser.add_argument('--min-value', type=float, default=config.TRACE_MIN_VALUE,
+                        help=f"Valore minimo in BTC degli archi seguiti da --type trace (default: {config.TRACE_MIN_VALUE:g}).")
+
+    parser.add_argument('--from-height', type=int,
+                        help="Con --action analyze: analizza solo i blocchi da questa altezza (default: 0).")
+    parser.add_argument('--to-height', type=int,
+                        help="Con --action analyze: analizza solo i blocchi fino a questa altezza "
+                             "(default: high-water mark).")
 
     parser.add_argument(
         '--years',
@@ -58,45 +422,297 @@ def main():
         default=5,
         help="Anni minimi di inattività per l'analisi dei fondi dormienti (default: 5)."
     )
+
+    parser.add_argument(
+        '--prefetch',
+        type=int,
+        default=config.ETL_PREFETCH_DEPTH,
+        help=f"Numero massimo di blocchi scaricati in anticipo durante l'ETL (default: {config.ETL_PREFETCH_DEPTH})."
+    )
+    parser.add_argument(
+        '--fetch-workers',
+        type=int,
+        default=config.ETL_FETCH_WORKERS,
+        help=f"Thread di download dei blocchi, 0 per l'ETL seriale (default: {config.ETL_FETCH_WORKERS})."
+    )
+    parser.add_argument(
+        '--source',
+        choices=['rpc', 'blk'],
+        default=config.BLOCK_SOURCE,
+        help=(
+            "Sorgente dei blocchi per l'ETL: 'rpc' (getblock sul nodo) oppure 'blk'\n"
+            f"(lettura diretta dei file blk*.dat in BLOCKS_DIR). Default: {config.BLOCK_SOURCE}."
+        )
+    )
+    parser.add_argument(
+        '--output-dir',
+        default=config.EXPORT_DIR,
+        help=f"Cartella dei file CSV prodotti da --action export (default: {config.EXPORT_DIR})."
+    )
+    parser.add_argument(
+        '--compress',
+        action='store_true',
+        help="Comprime i file CSV di --action export (gzip) e i risultati JSONL (gzip) o Parquet (zstd)."
+    )
+    parser.add_argument(
+        '--resume',
+        action='store_true',
+        help=(
+            "Con --action etl: salta i blocchi già completati, ritenta quelli falliti e\n"
+            "arriva fino al tip del nodo se --end-block non è indicato. Clustering e analisi\n"
+            "vengono eseguiti solo sui blocchi aggiunti."
+        )
+    )
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=1,
+        help="Numero di processi per l'ETL: con N > 1 l'intervallo di blocchi viene diviso in shard (default: 1)."
+    )
+    parser.add_argument(
+        '--backend',
+        choices=['neo4j', 'memory'],
+        default='neo4j',
+        help=(
+            "Motore delle analisi: 'neo4j' (query Cypher) oppure 'memory' (array NumPy\n"
+            "in memoria). Con --action etl il grafo in memoria viene caricato direttamente\n"
+            "dai blocchi senza scrivere su Neo4j; con --action analyze viene letto da Neo4j."
+        )
+    )
+    parser.add_argument(
+        '--legacy-queries',
+        action='store_true',
+        help=(
+            "Esegue le analisi espandendo le relazioni SENT/RECEIVED invece di usare\n"
+            "le feature delle transazioni e le rollup dei blocchi (grafi non ancora migrati)."
+        )
+    )
+    parser.add_argument(
+        '--metrics-port',
+        type=int,
+        default=config.METRICS_PORT,
+        help="Porta dell'endpoint Prometheus /metrics, 0 per disattivarlo (default: da METRICS_PORT)."
+    )
+    parser.add_argument(
+        '--metrics-file',
+        default=config.METRICS_FILE,
+        help=(
+            f"File JSON con le metriche, riscritto ogni {config.METRICS_INTERVAL:g}s e a fine processo\n"
+            "(con --workers > 1 un file <nome>.<pid> per processo). Default: da METRICS_FILE."
+        )
+    )
+    parser.add_argument(
+        '--profile-dir',
+        default=config.PROFILE_DIR,
+        help=(
+            "Con --action etl: salva in questa cartella un dump cProfile ogni\n"
+            f"{config.PROFILE_BLOCKS} blocchi (PROFILE_BLOCKS). Default: da PROFILE_DIR."
+        )
+    )
+    parser.add_argument(
+        '--output-format',
+        choices=('console',) + SINK_FORMATS,
+        default=config.ANALYSIS_OUTPUT_FORMAT,
+        help=(
+            "Destinazione dei risultati delle analisi: 'console' (testo) oppure file\n"
+            "'jsonl'/'parquet' per tabella in --results-dir, con un riepilogo a console.\n"
+            f"Default: {config.ANALYSIS_OUTPUT_FORMAT}."
+        )
+    )
+    parser.add_argument(
+        '--results-dir',
+        default=config.ANALYSIS_OUTPUT_DIR,
+        help=f"Cartella dei file dei risultati con --output-format jsonl/parquet (default: {config.ANALYSIS_OUTPUT_DIR})."
+    )
+    parser.add_argument(
+        '--no-cache',
+        action='store_true',
+        help=(
+            "Con --action analyze: ricalcola tutte le analisi ignorando la cache dei\n"
+            f"risultati (ANALYSIS_CACHE_DIR, default: {config.ANALYSIS_CACHE_DIR or 'disattivata'})."
+        )
+    )
     args = parser.parse_args()
 
-    # Controllo logico: se l'azione è 'etl', start e end block sono obbligatori
-    if args.action == 'etl' and (args.start_block is None or args.end_block is None):
-        print("Errore: Per l'azione 'etl' è necessario specificare --start-block e --end-block.")
+    # Controllo logico: per 'etl' (salvo --resume) ed 'export' start e end block sono obbligatori
+    needs_range = args.action == 'export' or (args.action == 'etl' and not args.resume)
+    if needs_range and (args.start_block is None or args.end_block is None):
+        print(f"Errore: Per l'azione '{args.action}' è necessario specificare --start-block e --end-block.")
         sys.exit(1)
-    if args.action == 'etl' and args.start_block > args.end_block:
+    if (args.action in ('etl', 'export') and args.start_block is not None and args.end_block is not None
+            and args.start_block > args.end_block):
         print("Errore: --start-block non può essere maggiore di --end-block.")
         sys.exit(1)
+    if args.from_height is not None and args.to_height is not None and args.from_height > args.to_height:
+        print("Errore: --from-height non può essere maggiore di --to-height.")
+        sys.exit(1)
+
+    if args.backend == 'memory' and args.action == 'etl' and args.resume:
+        print("Errore: --resume non è disponibile con --backend memory.")
+        sys.exit(1)
+    if args.type == 'trace' and not (args.trace_txid or args.trace_address):
+        print("Errore: --type trace richiede almeno un --trace-txid o --trace-address.")
+        sys.exit(1)
+    if args.backend == 'memory' and args.action == 'follow':
+        print("Errore: --action follow scrive su Neo4j e non è disponibile con --backend memory.")
+        sys.exit(1)
 
     print(f"Avvio del processo in modalità: {args.action.upper()}")
-    
+
+    if args.metrics_port:
+        metrics.start_metrics_server(args.metrics_port)
+    if args.metrics_file and not (args.action == 'etl' and args.workers > 1):
+        # Con l'ETL multi-processo ogni figlio scrive il proprio file
+        atexit.register(metrics.JsonMetricsWriter(args.metrics_file, config.METRICS_INTERVAL).close)
+
+    if args.action == 'etl' and args.backend == 'memory':
+        # Nessuna scrittura su Neo4j: blocchi, clustering e analisi restano in memoria
+        print(f"\n--- FASE ETL IN MEMORIA: Dal blocco {args.start_block} al {args.end_block} ---")
+        try:
+            block_source = create_block_source(args.source)
+        except Exception:
+            print("Impossibile inizializzare la sorgente dei blocchi. Uscita.")
+            return
+        graph, failed_heights = build_memory_graph(range(args.start_block, args.end_block + 1), block_source)
+        if failed_heights:
+            print(f"Blocchi non caricati: {failed_heights}")
+        memory_graph.apply_common_input_ownership(graph)
+        run_analysis(None, args.type, args.years, graph=graph, sink_options=create_sink_options(args),
+                     trace_options=create_trace_options(args))
+        print("\n--- Processo completato ---")
+        return
+
+    if args.action == 'export':
+        # L'esportazione non scrive su Neo4j: il database viene popolato da neo4j-admin
+        print(f"\n--- FASE EXPORT: Dal blocco {args.start_block} al {args.end_block} in {args.output_dir} ---")
+        failed_heights = run_export(
+            range(args.start_block, args.end_block + 1),
+            partial(create_block_source, args.source),
+            args.output_dir,
+            options={
+                'compress': args.compress,
+                'dedup_cache_size': config.EXPORT_DEDUP_CACHE_SIZE,
+                'prevout_db_path': config.PREVOUT_DB_PATH,
+                'prevout_cache_size': config.PREVOUT_CACHE_SIZE,
+                'id_registry_path': config.ID_REGISTRY_PATH,
+                'id_registry_cache_size': config.ID_REGISTRY_CACHE_SIZE
+            },
+            workers=args.workers
+        )
+        if failed_heights:
+            print(f"Blocchi non esportati: {failed_heights}")
+            sys.exit(1)
+        print("\n--- Processo completato ---")
+        return
+
     try:
-        neo4j_conn = Neo4jConnector(config.NEO4J_URI, config.NEO4J_USER, config.NEO4J_PASS)
+        neo4j_conn = create_neo4j_connector()
     except Exception:
         print("Impossibile inizializzare il connettore Neo4j. Uscita.")
         return
 
+    # Vincoli e indici vanno creati prima di qualsiasi MERGE o analisi
+    schema_ok = ensure_schema(neo4j_conn)
+
     if args.action == 'etl':
-        print(f"\n--- FASE ETL: Dal blocco {args.start_block} al {args.end_block} ---")
         try:
-            btc_conn = BitcoinConnector(config.RPC_USER, config.RPC_PASS, config.RPC_HOST, config.RPC_PORT)
+            btc_conn = create_block_source(args.source)
         except Exception:
-            print("Impossibile inizializzare il connettore Bitcoin. Uscita.")
+            print("Impossibile inizializzare la sorgente dei blocchi. Uscita.")
             neo4j_conn.close()
             return
-            
-        for height in range(args.start_block, args.end_block + 1):
-            process_block(height, btc_conn, neo4j_conn)
-        
-        print("\n--- FASE DI CLUSTERING ---")
-        apply_common_input_ownership(neo4j_conn)
-        
-        run_analysis(neo4j_conn)
+
+        start_block, end_block = args.start_block, args.end_block
+        if args.resume:
+            first_height, high_water_mark = get_ingested_range(neo4j_conn)
+            if start_block is None:
+                start_block = first_height if first_height is not None else 0
+            if end_block is None:
+                end_block = btc_conn.get_block_count()
+            heights = get_pending_heights(neo4j_conn, start_block, end_block)
+            print(f"\nRipresa ETL: high-water mark {high_water_mark}, "
+                  f"{len(heights)} blocchi da processare tra {start_block} e {end_block}.")
+        else:
+            heights = list(range(start_block, end_block + 1))
+
+        print(f"\n--- FASE ETL: Dal blocco {start_block} al {end_block} ---")
+        failed_heights = run_etl(args, heights, btc_conn, neo4j_conn)
+        high_water_mark = save_etl_state(neo4j_conn, failed_heights)
+        print(f"\nHigh-water mark: {high_water_mark}. Blocchi falliti: {len(failed_heights)}.")
+
+        # In modalità --resume clustering e analisi lavorano solo sui blocchi appena aggiunti
+        new_heights = None
+        if args.resume:
+            failed = set(failed_heights)
+            new_heights = [height for height in heights if height not in failed]
+
+        if new_heights is not None and not new_heights:
+            print("\nNessun nuovo blocco aggiunto: clustering e analisi non necessari.")
+        else:
+            # Il clustering parte solo dopo che tutti i blocchi (e tutti gli shard) sono stati scritti
+            print("\n--- FASE DI CLUSTERING ---")
+            run_clustering(neo4j_conn, heights=new_heights)
+
+            run_analysis(neo4j_conn, heights=new_heights, use_features=not args.legacy_queries,
+                         sink_options=create_sink_options(args))
+
+    elif args.action == 'follow':
+        # Il tip si segue sempre tramite RPC: i file blk*.dat non notificano i nuovi blocchi
+        try:
+            btc_conn = create_btc_connector()
+        except Exception:
+            print("Impossibile connettersi al nodo Bitcoin. Uscita.")
+            neo4j_conn.close()
+            return
+        print("\n--- FASE FOLLOW: caricamento continuo dei nuovi blocchi (Ctrl+C per terminare) ---")
+        run_follow(args, btc_conn, neo4j_conn)
+
+    elif args.action == 'analyze' and args.backend == 'memory':
+        print("\n--- FASE DI CLUSTERING E ANALISI (in memoria) ---")
+        print("Caricamento del grafo da Neo4j...")
+        graph = memory_graph.load_from_neo4j(neo4j_conn)
+        print(f"Grafo in memoria: {len(graph)} transazioni, {len(graph.addresses)} indirizzi.")
+        memory_graph.apply_common_input_ownership(graph)
+        run_analysis(None, args.type, args.years, graph=graph, sink_options=create_sink_options(args),
+                     trace_options=create_trace_options(args), window=create_analysis_window(args, neo4j_conn))
 
     elif args.action == 'analyze':
         print("\n--- FASE DI CLUSTERING E ANALISI ---")
-        apply_common_input_ownership(neo4j_conn)
-        run_analysis(neo4j_conn,args.type,args.years)
+        run_clustering(neo4j_conn)
+        run_analysis(neo4j_conn, args.type, args.years, use_features=not args.legacy_queries,
+                     cache=create_analysis_cache(not args.no_cache), sink_options=create_sink_options(args),
+                     trace_options=create_trace_options(args), window=create_analysis_window(args, neo4j_conn))
+
+    elif args.action == 'migrate':
+        id_registry = IdRegistry(config.ID_REGISTRY_PATH, config.ID_REGISTRY_CACHE_SIZE) if config.ID_REGISTRY_PATH else None
+        backfill_compact_ids(neo4j_conn, config.MIGRATION_BATCH_BLOCKS, id_registry)
+        if id_registry is not None:
+            id_registry.close()
+        try:
+            btc_conn = create_block_source(args.source)
+        except Exception:
+            btc_conn = None
+            print("Sorgente dei blocchi non disponibile: indici vout/vin delle relazioni non aggiornati.")
+        if btc_conn is not None:
+            prevout_store = None
+            if config.PREVOUT_DB_PATH:
+                prevout_store = PrevoutStore(config.PREVOUT_DB_PATH, config.PREVOUT_CACHE_SIZE)
+            backfill_edge_indexes(neo4j_conn, btc_conn, config.MIGRATION_BATCH_BLOCKS, prevout_store)
+            if prevout_store is not None:
+                prevout_store.close()
+        backfill_transaction_features(neo4j_conn, config.MIGRATION_BATCH_BLOCKS)
+        backfill_block_rollups(neo4j_conn, config.MIGRATION_BATCH_BLOCKS)
+        # Le rollup e le feature cambiano senza che cambino i blocchi: i risultati salvati non valgono più
+        cache = create_analysis_cache()
+        if cache is not None:
+            cache.clear()
+
+    elif args.action == 'check-schema':
+        plans_ok = check_query_plans(neo4j_conn)
+        neo4j_conn.close()
+        if not (schema_ok and plans_ok):
+            sys.exit(1)
+        return
 
     # Chiudi connessioni
     neo4j_conn.close()
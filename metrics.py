@@ -0,0 +1,206 @@
+"""
+Strumentazione di ETL e analisi: contatori e timer thread-safe in un registro
+di processo, report di avanzamento limitato nel tempo, esposizione delle
+metriche in formato testo Prometheus (endpoint HTTP) o come file JSON
+periodico e dump cProfile per intervalli di blocchi.
+"""
+import cProfile
+import json
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+class Metrics:
+    """
+    Registro delle metriche. I contatori sono somme; i timer registrano
+    numero di osservazioni, tempo totale e tempo massimo (in secondi).
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._timers = {}
+        self.started = time.time()
+
+    def inc(self, name, value=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def observe(self, name, seconds):
+        with self._lock:
+            count, total, maximum = self._timers.get(name, (0, 0.0, 0.0))
+            self._timers[name] = (count + 1, total + seconds, max(maximum, seconds))
+
+    @contextmanager
+    def timer(self, name):
+        """Misura il blocco with; se solleva un'eccezione incrementa anche <name>_errors."""
+        started = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            self.inc(f"{name}_errors")
+            raise
+        finally:
+            self.observe(name, time.perf_counter() - started)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'uptime_s': time.time() - self.started,
+                'counters': dict(self._counters),
+                'timers': {
+                    name: {'count': count, 'total_s': total, 'max_s': maximum}
+                    for name, (count, total, maximum) in self._timers.items()
+                }
+            }
+
+    def to_prometheus(self, prefix='pichain'):
+        """Metriche nel formato testo di esposizione di Prometheus."""
+        def metric_name(name):
+            return f"{prefix}_{re.sub(r'[^a-zA-Z0-9_]', '_', name)}"
+
+        snapshot = self.snapshot()
+        lines = [f"{prefix}_uptime_seconds {snapshot['uptime_s']:.3f}"]
+        for name, value in sorted(snapshot['counters'].items()):
+            lines += [f"# TYPE {metric_name(name)}_total counter", f"{metric_name(name)}_total {value}"]
+        for name, timer in sorted(snapshot['timers'].items()):
+            base = metric_name(name) + "_seconds"
+            lines += [
+                f"# TYPE {base} summary",
+                f"{base}_count {timer['count']}",
+                f"{base}_sum {timer['total_s']:.6f}",
+                f"{base}_max {timer['max_s']:.6f}",
+            ]
+        return "\n".join(lines) + "\n"
+
+# Registro di processo usato da connettori, ETL e analisi
+REGISTRY = Metrics()
+
+def inc(name, value=1):
+    REGISTRY.inc(name, value)
+
+def observe(name, seconds):
+    REGISTRY.observe(name, seconds)
+
+def timer(name):
+    return REGISTRY.timer(name)
+
+class ProgressReporter:
+    """
+    Stampa l'avanzamento al più ogni interval secondi invece che a ogni
+    unità di lavoro, con velocità media e contatori aggiuntivi.
+    """
+    def __init__(self, label, total=None, interval=5.0, unit='blocchi'):
+        self._label = label
+        self._total = total
+        self._interval = interval
+        self._unit = unit
+        self._started = time.monotonic()
+        self._last_report = self._started
+        self.done = 0
+        self.extra = {}
+
+    def update(self, done=1, force=False, **extra):
+        self.done += done
+        for name, value in extra.items():
+            self.extra[name] = self.extra.get(name, 0) + value
+        now = time.monotonic()
+        if force or now - self._last_report >= self._interval:
+            self._last_report = now
+            self.report()
+
+    def report(self):
+        elapsed = max(time.monotonic() - self._started, 1e-9)
+        position = f"{self.done}/{self._total}" if self._total else str(self.done)
+        if self._total:
+            position += f" ({100 * self.done / self._total:.1f}%)"
+        rates = [f"{self.done / elapsed:.2f} {self._unit}/s"]
+        rates += [f"{value / elapsed:.1f} {name}/s" for name, value in self.extra.items()]
+        print(f"[{self._label}] {position} {self._unit}, {', '.join(rates)}")
+
+def start_metrics_server(port, host='0.0.0.0', registry=REGISTRY):
+    """Avvia in un thread daemon un endpoint HTTP /metrics in formato Prometheus."""
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            data = registry.to_prometheus().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"Metriche disponibili su http://{host}:{server.server_address[1]}/metrics")
+    return server
+
+class JsonMetricsWriter:
+    """Scrive periodicamente (e alla chiusura) lo snapshot delle metriche in un file JSON."""
+    def __init__(self, path, interval=10.0, registry=REGISTRY):
+        self._path = path
+        self._interval = interval
+        self._registry = registry
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self._interval):
+            self.write()
+
+    def write(self):
+        # Scrittura atomica: chi legge il file non vede mai uno snapshot a metà
+        tmp_path = self._path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(dict(self._registry.snapshot(), pid=os.getpid()), f, indent=2)
+        os.replace(tmp_path, self._path)
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+        self.write()
+
+class BlockRangeProfiler:
+    """
+    Profila con cProfile il thread che scrive i blocchi e salva un dump
+    (profile-<prima altezza>-<ultima altezza>.prof) ogni blocks_per_dump blocchi.
+    """
+    def __init__(self, output_dir, blocks_per_dump=1000):
+        os.makedirs(output_dir, exist_ok=True)
+        self._output_dir = output_dir
+        self._blocks_per_dump = max(1, blocks_per_dump)
+        self._profile = None
+        self._first_height = None
+        self._last_height = None
+        self._blocks = 0
+
+    def block_started(self, height):
+        if self._profile is None:
+            self._profile = cProfile.Profile()
+            self._first_height = height
+            self._profile.enable()
+
+    def block_finished(self, height):
+        self._blocks += 1
+        self._last_height = height
+        if self._blocks >= self._blocks_per_dump:
+            self.dump()
+
+    def dump(self):
+        """Salva il profilo dei blocchi finora raccolti (da chiamare anche a fine ETL)."""
+        if self._profile is None:
+            return
+        self._profile.disable()
+        path = os.path.join(self._output_dir, f"profile-{self._first_height}-{self._last_height}.prof")
+        self._profile.dump_stats(path)
+        print(f"Profilo dei blocchi {self._first_height}-{self._last_height} salvato in {path}")
+        self._profile, self._first_height, self._last_height, self._blocks = None, None, None, 0
@@ -0,0 +1,22 @@
+"""Catena sintetica e server RPC condivisi dai test di ETL e analisi."""
+import pytest
+
+import config
+from benchmarks.fake_rpc import FakeBitcoinRpcServer
+from benchmarks.synthetic_chain import SyntheticChain
+from connectors.bitcoin_connector import BitcoinConnector
+
+@pytest.fixture(scope='session')
+def chain():
+    return SyntheticChain(blocks=40, txs_per_block=15, seed=7, peel_chains=3, dormant_coins=12)
+
+@pytest.fixture
+def rpc_server(chain):
+    server = FakeBitcoinRpcServer(chain)
+    server.start()
+    yield server
+    server.stop()
+
+@pytest.fixture
+def btc_connector(rpc_server):
+    return BitcoinConnector('test', 'test', rpc_server.host, rpc_server.port, config.RPC_BATCH_SIZE)
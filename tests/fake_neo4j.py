@@ -0,0 +1,306 @@
+"""
+Sostituto di Neo4jConnector per i test: interpreta in Python le query di
+analysis/queries.py usate da ETL, checkpoint, rollback, migrazioni e
+analisi dei fondi dormienti, riconosciute dal testo esatto prodotto dai
+builder. Ogni execute_write è atomica (in caso di errore lo stato torna a
+prima della transazione) e i vincoli di unicità su Block.height e
+Transaction.tid fanno fallire le CREATE come in Neo4j.
+"""
+import copy
+from itertools import product
+
+from analysis import queries
+from analysis.queries import DORMANCY_BANDS_YEARS
+
+class ConstraintError(Exception):
+    pass
+
+def _variants(builder):
+    """Testi di una query di analisi per tutte le combinazioni di incremental e windowed."""
+    return [builder(incremental=incremental, windowed=windowed)
+            for incremental, windowed in product((False, True), repeat=2)]
+
+class FakeNeo4j:
+    def __init__(self):
+        self.blocks = {}          # altezza -> proprietà
+        self.transactions = {}    # tid -> proprietà
+        self.included = set()     # (tid, altezza)
+        self.addresses = {}       # aid -> proprietà
+        self.received = []        # {'tid', 'aid', 'vout', 'value'}
+        self.sent = []            # {'aid', 'tid', 'vin', 'value', 'age_days'}
+        self.etl_state = {}
+        self.write_transactions = 0
+        self.failed_transactions = 0
+
+        handlers = {
+            queries.get_batch_create_block_and_transactions_query(): self._merge_block,
+            queries.get_fresh_create_block_and_transactions_query(create_block=True):
+                lambda p: self._create_block(p, create_block=True),
+            queries.get_fresh_create_block_and_transactions_query(create_block=False):
+                lambda p: self._create_block(p, create_block=False),
+            queries.get_batch_create_outputs_query(): self._merge_outputs,
+            queries.get_batch_create_inputs_query(): self._merge_inputs,
+            queries.get_fresh_create_outputs_query(): self._create_outputs,
+            queries.get_fresh_create_inputs_query(): self._create_inputs,
+            queries.get_mark_block_ingested_query(): self._mark_ingested,
+            queries.get_max_block_height_query(): self._max_height,
+            queries.get_ingested_heights_query(): self._ingested_heights,
+            queries.get_ingested_range_query(): self._ingested_range,
+            queries.get_graph_watermark_query(): self._watermark,
+            queries.get_block_hashes_query(): self._block_hashes,
+            queries.get_rollback_transactions_query(): self._rollback_transactions,
+            queries.get_rollback_blocks_query(): self._rollback_blocks,
+            queries.get_update_etl_state_query(): self._update_etl_state,
+            queries.get_blocks_without_edge_indexes_query(): self._blocks_without_edge_indexes,
+            queries.get_transactions_without_features_query(incremental=False): self._transactions_without_features,
+            queries.get_transactions_without_features_query(incremental=True): self._transactions_without_features,
+            queries.get_set_output_indexes_query(): self._set_output_indexes,
+            queries.get_set_input_indexes_query(): self._set_input_indexes,
+        }
+        for query in _variants(queries.get_dormancy_summary_query):
+            handlers[query] = self._dormancy_summary
+        for query in _variants(queries.get_blocks_without_rollups_query):
+            handlers[query] = self._blocks_without_rollups
+        for query in _variants(queries.get_dormant_funds_rollup_query):
+            handlers[query] = lambda p: self._dormant_funds(p, rollups=True)
+        for query in _variants(queries.get_dormant_funds_query):
+            handlers[query] = lambda p: self._dormant_funds(p, rollups=False)
+        self._handlers = handlers
+
+    # --- Interfaccia di Neo4jConnector ---
+    def _run(self, query, parameters):
+        if query not in self._handlers:
+            raise NotImplementedError(f"Query non supportata dal FakeNeo4j: {query[:80]}")
+        return self._handlers[query](parameters or {}) or []
+
+    def execute_query(self, query, parameters=None):
+        return list(self._run(query, parameters))
+
+    def stream_query(self, query, parameters=None, fetch_size=None, timeout=None):
+        return iter(self._run(query, parameters))
+
+    def execute_write(self, statements):
+        state = copy.deepcopy(self._state())
+        try:
+            for query, parameters in statements:
+                self._run(query, parameters)
+        except Exception:
+            self._restore(state)
+            self.failed_transactions += 1
+            raise
+        self.write_transactions += 1
+        return len(statements)
+
+    def close(self):
+        pass
+
+    def _state(self):
+        return {name: getattr(self, name) for name in
+                ('blocks', 'transactions', 'included', 'addresses', 'received', 'sent', 'etl_state')}
+
+    def _restore(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
+
+    def snapshot(self):
+        """Stato del grafo con le relazioni ordinate, confrontabile tra due caricamenti."""
+        def edges(items):
+            return sorted(items, key=lambda edge: sorted((name, str(value)) for name, value in edge.items()))
+        return {'blocks': self.blocks, 'transactions': self.transactions, 'included': self.included,
+                'addresses': self.addresses, 'received': edges(self.received), 'sent': edges(self.sent)}
+
+    def counts(self):
+        """Numero di nodi per etichetta e di relazioni per tipo."""
+        return {
+            'Block': len(self.blocks), 'Transaction': len(self.transactions), 'Address': len(self.addresses),
+            'INCLUDED_IN': len(self.included), 'RECEIVED': len(self.received), 'SENT': len(self.sent),
+        }
+
+    # --- Scrittura dei blocchi ---
+    def _block_node(self, parameters):
+        block = self.blocks.setdefault(parameters['block_height'], {'height': parameters['block_height']})
+        block.update(hash=parameters['block_hash'], timestamp=parameters['timestamp'])
+        return block
+
+    def _merge_block(self, parameters):
+        height = parameters['block_height']
+        self._block_node(parameters)
+        for row in parameters['transactions']:
+            tx = self.transactions.setdefault(row['tid'], {'tid': row['tid'], 'txid': row['tx_id']})
+            tx['block_height'] = height
+            tx.update(row['features'])
+            self.included.add((row['tid'], height))
+
+    def _create_block(self, parameters, create_block):
+        height = parameters['block_height']
+        if create_block:
+            if height in self.blocks:
+                raise ConstraintError(f"Block {height} esiste già")
+            self._block_node(parameters)
+        elif height not in self.blocks:
+            return
+        else:
+            self._block_node(parameters)
+        for row in parameters['transactions']:
+            if row['tid'] in self.transactions:
+                raise ConstraintError(f"Transaction {row['tid']} esiste già")
+            self.transactions[row['tid']] = dict(row['features'], tid=row['tid'], txid=row['tx_id'],
+                                                 block_height=height)
+            self.included.add((row['tid'], height))
+
+    def _address(self, row):
+        self.addresses.setdefault(row['aid'], {'aid': row['aid'], 'address': row['addr']})
+
+    def _merge_outputs(self, parameters):
+        for row in parameters['outputs']:
+            if row['tid'] not in self.transactions:
+                continue
+            self._address(row)
+            edge = next((edge for edge in self.received if edge['tid'] == row['tid'] and edge['aid'] == row['aid']
+                         and edge['vout'] == row['vout']), None)
+            if edge is None:
+                self.received.append({'tid': row['tid'], 'aid': row['aid'], 'vout': row['vout'], 'value': row['val']})
+            else:
+                edge['value'] = row['val']
+
+    def _merge_inputs(self, parameters):
+        for row in parameters['inputs']:
+            if row['tid'] not in self.transactions:
+                continue
+            self._address(row)
+            edge = next((edge for edge in self.sent if edge['tid'] == row['tid'] and edge['aid'] == row['aid']
+                         and edge['vin'] == row['vin']), None)
+            if edge is None:
+                self.sent.append({'aid': row['aid'], 'tid': row['tid'], 'vin': row['vin'], 'value': row['val'],
+                                  'age_days': row['age']})
+            else:
+                edge.update(value=row['val'], age_days=row['age'])
+
+    def _create_outputs(self, parameters):
+        for row in parameters['outputs']:
+            if row['tid'] in self.transactions:
+                self._address(row)
+                self.received.append({'tid': row['tid'], 'aid': row['aid'], 'vout': row['vout'], 'value': row['val']})
+
+    def _create_inputs(self, parameters):
+        for row in parameters['inputs']:
+            if row['tid'] in self.transactions:
+                self._address(row)
+                self.sent.append({'aid': row['aid'], 'tid': row['tid'], 'vin': row['vin'], 'value': row['val'],
+                                  'age_days': row['age']})
+
+    def _mark_ingested(self, parameters):
+        block = self.blocks.get(parameters['block_height'])
+        if block is not None:
+            block['ingested'] = True
+            block.update(parameters['rollup'])
+
+    # --- Checkpoint ---
+    def _ingested(self):
+        return sorted(height for height, block in self.blocks.items() if block.get('ingested'))
+
+    def _max_height(self, parameters):
+        return [{'max_height': max(self.blocks)}] if self.blocks else []
+
+    def _ingested_heights(self, parameters):
+        return [{'height': height} for height in self._ingested()
+                if parameters['from_height'] <= height <= parameters['to_height']]
+
+    def _ingested_range(self, parameters):
+        heights = self._ingested()
+        return [{'first_height': heights[0] if heights else None, 'high_water_mark': heights[-1] if heights else None}]
+
+    def _watermark(self, parameters):
+        heights = self._ingested()
+        return [{'first_height': heights[0] if heights else None,
+                 'high_water_mark': heights[-1] if heights else None, 'blocks': len(heights)}]
+
+    def _block_hashes(self, parameters):
+        return [{'height': height, 'hash': self.blocks[height]['hash']} for height in self._ingested()
+                if parameters['from_height'] <= height <= parameters['to_height']]
+
+    def _update_etl_state(self, parameters):
+        self.etl_state.update(high_water_mark=parameters['high_water_mark'],
+                              failed_heights=parameters['failed_heights'])
+
+    # --- Rollback ---
+    def _rollback_transactions(self, parameters):
+        orphans = {tid for tid, tx in self.transactions.items() if tx['block_height'] > parameters['fork_height']}
+        touched = {edge['aid'] for edge in self.received + self.sent if edge['tid'] in orphans}
+        self.received = [edge for edge in self.received if edge['tid'] not in orphans]
+        self.sent = [edge for edge in self.sent if edge['tid'] not in orphans]
+        self.included = {(tid, height) for tid, height in self.included if tid not in orphans}
+        for tid in orphans:
+            del self.transactions[tid]
+        linked = {edge['aid'] for edge in self.received + self.sent}
+        for aid in touched - linked:
+            del self.addresses[aid]
+
+    def _rollback_blocks(self, parameters):
+        fork_height = parameters['fork_height']
+        self.blocks = {height: block for height, block in self.blocks.items() if height <= fork_height}
+        self.included = {(tid, height) for tid, height in self.included if height <= fork_height}
+
+    # --- Migrazioni ---
+    def _blocks_without_edge_indexes(self, parameters):
+        heights = {self.transactions[edge['tid']]['block_height'] for edge in self.received if edge['vout'] is None}
+        heights |= {self.transactions[edge['tid']]['block_height'] for edge in self.sent if edge['vin'] is None}
+        return [{'height': height} for height in sorted(heights)
+                if parameters['from_height'] <= height <= parameters['to_height']]
+
+    def _set_output_indexes(self, parameters):
+        for row in parameters['outputs']:
+            for edge in self.received:
+                if edge['vout'] is None and (edge['tid'], edge['aid'], edge['value']) == (
+                        row['tid'], row['aid'], row['val']):
+                    edge['vout'] = row['vout']
+
+    def _set_input_indexes(self, parameters):
+        for row in parameters['inputs']:
+            for edge in self.sent:
+                if edge['vin'] is None and (edge['aid'], edge['tid'], edge['value']) == (
+                        row['aid'], row['tid'], row['val']):
+                    edge['vin'] = row['vin']
+
+    def _transactions_without_features(self, parameters):
+        return [{'transactions': sum(1 for tx in self.transactions.values()
+                                     if self._in_range(tx['block_height'], parameters) and tx.get('n_inputs') is None)}]
+
+    # --- Fondi dormienti ---
+    @staticmethod
+    def _in_range(height, parameters):
+        if parameters.get('heights') is not None:
+            return height in parameters['heights']
+        if 'from_height' in parameters:
+            return parameters['from_height'] <= height <= parameters['to_height']
+        return True
+
+    def _dormancy_summary(self, parameters):
+        blocks = [block for height, block in self.blocks.items()
+                  if self._in_range(height, parameters) and block.get('max_age_days') is not None]
+        summary = {
+            'blocks': len(blocks),
+            'cdd': sum(block['cdd'] for block in blocks),
+            'matching_blocks': sum(block['max_age_days'] >= parameters['min_age_days'] for block in blocks),
+        }
+        for years in DORMANCY_BANDS_YEARS:
+            summary[f'spent_over_{years}y'] = sum(block[f'spent_over_{years}y'] for block in blocks)
+        return [summary]
+
+    def _blocks_without_rollups(self, parameters):
+        return [{'blocks': sum(1 for height, block in self.blocks.items() if self._in_range(height, parameters)
+                               and block.get('ingested') and block.get('max_age_days') is None)}]
+
+    def _dormant_funds(self, parameters, rollups):
+        records = []
+        for edge in self.sent:
+            height = self.transactions[edge['tid']]['block_height']
+            if not self._in_range(height, parameters) or edge['age_days'] < parameters['min_age_days']:
+                continue
+            if rollups and not self.blocks[height].get('max_age_days', -1) >= parameters['min_age_days']:
+                continue
+            records.append({'txid': self.transactions[edge['tid']]['txid'],
+                            'from_address': self.addresses[edge['aid']]['address'],
+                            'value': edge['value'], 'days_dormant': edge['age_days']})
+        records.sort(key=lambda r: (-r['days_dormant'], r['txid'], r['from_address'], -r['value']))
+        return records
@@ -0,0 +1,74 @@
+"""Le analisi danno lo stesso output su Neo4j (FakeNeo4j) e su MemoryGraph."""
+import pytest
+
+from analysis import dormant_funds_analysis
+from analysis.windows import split_windows
+from benchmarks.harness import CountingNeo4j, InProcessNeo4j, run_etl_benchmark
+from tests.fake_neo4j import FakeNeo4j
+
+@pytest.fixture
+def backends(chain, rpc_server, tmp_path):
+    neo4j = FakeNeo4j()
+    memory = InProcessNeo4j()
+    for name, connector in (('neo4j', CountingNeo4j(neo4j)), ('memory', memory)):
+        (tmp_path / name).mkdir()
+        assert run_etl_benchmark(chain, rpc_server, connector, str(tmp_path / name))['failed_blocks'] == 0
+    return neo4j, memory.builder.build()
+
+def _output(analysis, **kwargs):
+    lines = []
+    analysis(out=lines.append, **kwargs)
+    return lines
+
+@pytest.mark.parametrize('use_rollups', [True, False])
+@pytest.mark.parametrize('min_age_years', [0, 1, 5, 10])
+def test_dormant_funds_same_output(backends, chain, use_rollups, min_age_years):
+    neo4j, graph = backends
+    last_height = len(chain.blocks) - 1
+    cases = [{}, {'heights': [0, last_height - 1, last_height]}, {'windows': split_windows(0, last_height, 7)}]
+    for case in cases:
+        expected = _output(dormant_funds_analysis.run, neo4j_conn=neo4j, min_age_years=min_age_years,
+                           use_rollups=use_rollups, **case)
+        actual = _output(dormant_funds_analysis.run, neo4j_conn=None, graph=graph, min_age_years=min_age_years,
+                         use_rollups=use_rollups, **case)
+        assert actual == expected
+
+def test_dormant_funds_summary_printed(backends):
+    neo4j, graph = backends
+    for kwargs in ({'neo4j_conn': neo4j}, {'neo4j_conn': None, 'graph': graph}):
+        lines = _output(dormant_funds_analysis.run, min_age_years=5, **kwargs)
+        assert any('coin-days destroyed' in line for line in lines)
+        assert any('TXID' in line for line in lines)
+
+def test_dormant_funds_without_rollups(backends, chain):
+    """Su un grafo migrato solo in parte use_rollups ripiega sulla query completa."""
+    neo4j, _ = backends
+    expected = _output(dormant_funds_analysis.run, neo4j_conn=neo4j, min_age_years=5, use_rollups=False)
+    for height in range(len(chain.blocks) // 2, len(chain.blocks)):
+        block = neo4j.blocks[height]
+        for name in [name for name in block if name not in ('height', 'hash', 'timestamp', 'ingested')]:
+            del block[name]
+    lines = _output(dormant_funds_analysis.run, neo4j_conn=neo4j, min_age_years=5, use_rollups=True)
+    assert 'senza rollup' in lines[1]
+    assert [lines[0]] + lines[2:] == expected
+    assert any('TXID' in line for line in expected)
+
+def test_analysis_without_features(backends, chain, capsys):
+    """Con transazioni senza feature run_analysis avvisa e usa le query complete."""
+    import main
+    neo4j, _ = backends
+    last_height = len(chain.blocks) - 1
+    assert main.count_transactions_without_features(neo4j) == 0
+    main.run_analysis(neo4j, 'dormant')
+    assert 'senza feature' not in capsys.readouterr().out
+
+    legacy = [tx for tx in neo4j.transactions.values() if tx['block_height'] == last_height]
+    for tx in legacy:
+        del tx['n_inputs']
+    assert main.count_transactions_without_features(neo4j) == len(legacy)
+    assert main.count_transactions_without_features(neo4j, heights=[0]) == 0
+    assert main.count_transactions_without_features(neo4j, window=(0, last_height)) == len(legacy)
+    main.run_analysis(neo4j, 'dormant')
+    output = capsys.readouterr().out
+    assert f"{len(legacy)} transazioni senza feature" in output
+    assert 'senza rollup' not in output and 'TXID' in output
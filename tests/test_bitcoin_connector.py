@@ -0,0 +1,76 @@
+"""Chiamate batch del BitcoinConnector e risoluzione degli input (_resolve_prevouts) sul server RPC finto."""
+import copy
+
+import pytest
+from bitcoinrpc.authproxy import JSONRPCException
+
+import config
+from connectors.bitcoin_connector import BitcoinConnector
+from etl.parser import _resolve_prevouts, build_block_rows
+from etl.prevout_store import PrevoutStore
+
+def test_batches_split_at_max_batch_size(chain, rpc_server):
+    btc_connector = BitcoinConnector('test', 'test', rpc_server.host, rpc_server.port, max_batch_size=7)
+    txids = list(chain.transactions)[:20]
+    rpc_server.reset_stats()
+    transactions = btc_connector.get_transactions(txids + txids[:5])
+    assert list(transactions) == txids
+    assert all(transactions[txid]['txid'] == txid for txid in txids)
+    # 20 txid distinti in richieste da al più 7 chiamate
+    assert rpc_server.requests == 3
+    assert rpc_server.calls['getrawtransaction'] == 20
+
+    rpc_server.reset_stats()
+    heights = list(range(15))
+    assert btc_connector.get_block_hashes(heights) == [chain.blocks[height]['hash'] for height in heights]
+    assert rpc_server.requests == 3 and rpc_server.calls['getblockhash'] == 15
+
+def test_batch_item_error(chain, rpc_server):
+    btc_connector = BitcoinConnector('test', 'test', rpc_server.host, rpc_server.port, max_batch_size=7)
+    txids = list(chain.transactions)[:3] + ['00' * 32]
+    with pytest.raises(JSONRPCException) as error:
+        btc_connector.get_transactions(txids)
+    assert error.value.code == -5
+
+def _spend_in_block(block):
+    """Copia del blocco con una transazione in più che spende l'output 0 di una transazione dello stesso blocco."""
+    block = copy.deepcopy(block)
+    source = block['tx'][1]
+    block['tx'].append({
+        'txid': 'ff' * 32,
+        'vin': [{'txid': source['txid'], 'vout': 0}],
+        'vout': [{'value': 0.001, 'n': 0, 'scriptPubKey': {'address': 'bcrt1qsameblockspend'}}]
+    })
+    return block, source
+
+@pytest.fixture
+def prevout_store(tmp_path):
+    store = PrevoutStore(str(tmp_path / 'prevouts.sqlite'), config.PREVOUT_CACHE_SIZE)
+    yield store
+    store.close()
+
+def test_same_block_spend_without_rpc(chain, rpc_server, btc_connector, prevout_store):
+    height = len(chain.blocks) // 2
+    for block in chain.blocks[:height]:
+        prevout_store.add_block(block)
+    block, source = _spend_in_block(chain.blocks[height])
+
+    rpc_server.reset_stats()
+    rows = build_block_rows(height, block, btc_connector, prevout_store)
+    assert rpc_server.requests == 0
+    input_row, = rows['transactions'][-1]['inputs']
+    assert input_row['addr'] == source['vout'][0]['scriptPubKey']['address']
+    assert input_row['val'] == source['vout'][0]['value']
+    assert input_row['age'] == 0
+
+def test_resolve_prevouts_in_batches(chain, rpc_server):
+    """Senza prevout_store le transazioni sorgente distinte vengono chieste al nodo in batch."""
+    btc_connector = BitcoinConnector('test', 'test', rpc_server.host, rpc_server.port, max_batch_size=4)
+    block = chain.blocks[-1]
+    spent = {(vin['txid'], vin['vout']) for tx in block['tx'][1:] for vin in tx['vin']}
+    source_txids = {txid for txid, _ in spent}
+    rpc_server.reset_stats()
+    prevouts = _resolve_prevouts(block, btc_connector, None)
+    assert spent <= prevouts.keys()
+    assert rpc_server.calls['getrawtransaction'] == len(source_txids)
+    assert rpc_server.requests == -(-len(source_txids) // 4)
@@ -0,0 +1,114 @@
+"""Lettura dei file blk*.dat sintetici, in chiaro e offuscati con xor.dat."""
+import hashlib
+import os
+import struct
+
+import pytest
+
+from connectors import blk_file_connector
+from connectors.blk_file_connector import BlkFileConnector, _xor
+
+MAGIC = blk_file_connector.NETWORKS['regtest']['magic']
+XOR_KEY = bytes([3, 141, 59, 26, 5, 35, 89, 79])
+
+def _sha256d(data):
+    return hashlib.sha256(hashlib.sha256(data).digest()).digest()
+
+def _varint(value):
+    return bytes([value]) if value < 0xfd else b'\xfd' + struct.pack('<H', value)
+
+def _p2pkh(seed):
+    return bytes([0x76, 0xa9, 0x14]) + bytes([seed]) * 20 + bytes([0x88, 0xac])
+
+def _transaction(height, prev_txid=None):
+    """Coinbase (prev_txid None) o transazione che spende l'output 0 di prev_txid."""
+    if prev_txid is None:
+        script = bytes([2, height & 0xff, 1])
+        inputs = bytes(32) + b'\xff\xff\xff\xff' + _varint(len(script)) + script + b'\xff\xff\xff\xff'
+    else:
+        inputs = bytes.fromhex(prev_txid)[::-1] + struct.pack('<I', 0) + b'\x00' + b'\xff\xff\xff\xff'
+    outputs = b''.join(
+        struct.pack('<q', 100000000 * (n + 1)) + _varint(25) + _p2pkh(height * 2 + n) for n in range(2)
+    )
+    raw = struct.pack('<I', 1) + b'\x01' + inputs + b'\x02' + outputs + bytes(4)
+    return raw, _sha256d(raw)[::-1].hex()
+
+def _block(height, prev_hash, salt=0):
+    coinbase, coinbase_txid = _transaction(height)
+    transactions = [coinbase]
+    txids = [coinbase_txid]
+    if height > 0:
+        spend, spend_txid = _transaction(height, prev_txid=coinbase_txid)
+        transactions.append(spend)
+        txids.append(spend_txid)
+    header = struct.pack('<I', 1) + prev_hash + bytes(32) + struct.pack('<III', 1600000000 + height, 0x207fffff, salt)
+    raw = header + _varint(len(transactions)) + b''.join(transactions)
+    return raw, _sha256d(header), txids
+
+def _write_chain(directory, heights=6, blocks_per_file=2, xor_key=None):
+    """
+    Scrive la catena in più file blk*.dat, con un blocco orfano concorrente
+    all'altezza 2. Restituisce [(hash, txids)] della catena principale.
+    """
+    chain, records, prev_hash = [], [], bytes(32)
+    for height in range(heights):
+        raw, block_hash, txids = _block(height, prev_hash)
+        chain.append((block_hash[::-1].hex(), txids))
+        records.append(raw)
+        if height == 2:
+            orphan, _, _ = _block(height, prev_hash, salt=1)
+            records.append(orphan)
+        prev_hash = block_hash
+    for file_index, start in enumerate(range(0, len(records), blocks_per_file)):
+        data = b''.join(MAGIC + struct.pack('<I', len(raw)) + raw for raw in records[start:start + blocks_per_file])
+        with open(os.path.join(directory, f'blk{file_index:05d}.dat'), 'wb') as f:
+            f.write(data if xor_key is None else _xor(data, xor_key))
+    if xor_key is not None:
+        with open(os.path.join(directory, 'xor.dat'), 'wb') as f:
+            f.write(xor_key)
+    return chain
+
+def _open_fds():
+    return len(os.listdir('/proc/self/fd'))
+
+@pytest.mark.parametrize('xor_key', [None, XOR_KEY], ids=['plain', 'xor'])
+def test_reads_main_chain(tmp_path, xor_key):
+    chain = _write_chain(str(tmp_path), xor_key=xor_key)
+    connector = BlkFileConnector(str(tmp_path), 'regtest')
+    assert connector.get_block_count() == len(chain) - 1
+    for height, (block_hash, txids) in enumerate(chain):
+        block = connector.get_block_by_height(height)
+        assert block['hash'] == block_hash
+        assert [tx['txid'] for tx in block['tx']] == txids
+        assert block['tx'][0]['vin'][0].get('coinbase')
+        assert [vout['value'] for vout in block['tx'][0]['vout']] == [1.0, 2.0]
+        assert block['tx'][0]['vout'][0]['scriptPubKey']['address'].startswith(('m', 'n'))
+        if height:
+            assert block['tx'][1]['vin'] == [{'txid': txids[0], 'vout': 0}]
+
+def test_xor_matches_plain(tmp_path):
+    plain, obfuscated = tmp_path / 'plain', tmp_path / 'xor'
+    plain.mkdir()
+    obfuscated.mkdir()
+    _write_chain(str(plain))
+    _write_chain(str(obfuscated), xor_key=XOR_KEY)
+    first, second = BlkFileConnector(str(plain), 'regtest'), BlkFileConnector(str(obfuscated), 'regtest')
+    for height in range(first.get_block_count() + 1):
+        assert first.get_block_by_height(height) == second.get_block_by_height(height)
+
+def test_xor_offset():
+    data = bytes(range(200))
+    encoded = _xor(data, XOR_KEY)
+    for offset in (0, 3, 8, 13, 199):
+        assert _xor(encoded[offset:offset + 40], XOR_KEY, offset) == data[offset:offset + 40]
+
+@pytest.mark.parametrize('xor_key', [None, XOR_KEY], ids=['plain', 'xor'])
+def test_bounded_open_files(tmp_path, xor_key):
+    """L'indicizzazione non lascia file aperti; le mappe aperte restano al più max_open_files."""
+    _write_chain(str(tmp_path), heights=20, blocks_per_file=1, xor_key=xor_key)
+    before = _open_fds()
+    connector = BlkFileConnector(str(tmp_path), 'regtest', max_open_files=3)
+    assert _open_fds() == before
+    for height in range(connector.get_block_count() + 1):
+        connector.get_block_by_height(height)
+        assert _open_fds() <= before + 3
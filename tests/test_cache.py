@@ -0,0 +1,76 @@
+"""Cache delle analisi: voci eliminate da altri thread e analisi non incrementali."""
+import threading
+
+from analysis import cache as cache_module
+from analysis.cache import AnalysisCache, cached
+
+WATERMARK = {'first_height': 0, 'high_water_mark': 9, 'blocks': 10}
+APPENDED = {'first_height': 0, 'high_water_mark': 14, 'blocks': 15}
+
+class _Analysis:
+    """Analisi finta che registra le chiamate e stampa le altezze ricevute."""
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, out=print, heights=None):
+        self.calls.append(heights)
+        out(f"altezze {heights}")
+
+def _run(cache, name, analysis, watermark):
+    lines = []
+    cached(cache, name, analysis, {}, watermark)(out=lambda text, end='\n': lines.append(text + end))
+    return ''.join(lines)
+
+def test_evicted_entry_is_a_miss(tmp_path, monkeypatch):
+    cache = AnalysisCache(str(tmp_path))
+    analysis = _Analysis()
+    _run(cache, 'fan', analysis, WATERMARK)
+    assert cache.replay(cache.key('fan', {}), lambda *args, **kwargs: None)
+
+    # La voce sparisce tra la lettura del watermark e la ristampa
+    monkeypatch.setattr(cache, 'watermark', lambda key: WATERMARK)
+    (tmp_path / f"{cache.key('fan', {})}.txt.gz").unlink()
+    assert not cache.replay(cache.key('fan', {}), lambda *args, **kwargs: None)
+    assert _run(cache, 'fan', analysis, WATERMARK) == "altezze None\n"
+    assert analysis.calls == [None, None]
+    monkeypatch.undo()
+
+    # Anche una copia parziale ripiega su un'esecuzione completa
+    monkeypatch.setattr(cache, 'watermark', lambda key: WATERMARK)
+    (tmp_path / f"{cache.key('fan', {})}.txt.gz").unlink()
+    assert _run(cache, 'fan', analysis, APPENDED) == "altezze None\n"
+    assert analysis.calls[-1] is None
+
+def test_concurrent_commits_and_replays(tmp_path):
+    cache = AnalysisCache(str(tmp_path), max_bytes=2000)
+    errors = []
+
+    def worker(index):
+        try:
+            for round_index in range(30):
+                name = f"analisi{(index + round_index) % 6}"
+                watermark = dict(WATERMARK, high_water_mark=round_index)
+                cached(cache, name, lambda out, heights=None: out('x' * 200), {}, watermark)(
+                    out=lambda *args, **kwargs: None
+                )
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=worker, args=(index,)) for index in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+
+def test_dormant_is_not_appended(tmp_path):
+    assert 'dormant' not in cache_module.INCREMENTAL_ANALYSES
+    cache = AnalysisCache(str(tmp_path))
+    analysis = _Analysis()
+    _run(cache, 'dormant', analysis, WATERMARK)
+    assert _run(cache, 'dormant', analysis, APPENDED) == "altezze None\n"
+    assert analysis.calls == [None, None]
+
+    fan = _Analysis()
+    _run(cache, 'fan', fan, WATERMARK)
+    assert "altezze [10, 11, 12, 13, 14]" in _run(cache, 'fan', fan, APPENDED)
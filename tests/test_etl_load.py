@@ -0,0 +1,107 @@
+"""Caricamento fresco (CREATE) contro idempotente (MERGE) e migrazione degli indici vout/vin."""
+import copy
+import os
+
+import pytest
+
+import config
+import metrics
+from benchmarks.fake_rpc import FakeBitcoinRpcServer
+from benchmarks.harness import CountingNeo4j, run_etl_benchmark
+from benchmarks.synthetic_chain import SyntheticChain
+from connectors.bitcoin_connector import BitcoinConnector
+from etl.migrations import backfill_edge_indexes
+from etl.parser import build_block_rows, process_block, write_block_rows
+from etl.prevout_store import PrevoutStore
+from tests.fake_neo4j import FakeNeo4j
+
+def _load(chain, rpc_server, workdir, fresh):
+    neo4j = FakeNeo4j()
+    os.makedirs(workdir)
+    assert run_etl_benchmark(chain, rpc_server, CountingNeo4j(neo4j), workdir, fresh=fresh)['failed_blocks'] == 0
+    return neo4j
+
+@pytest.fixture
+def merge_graph(chain, rpc_server, tmp_path):
+    return _load(chain, rpc_server, str(tmp_path / 'merge'), fresh=False)
+
+class _CrashAfter:
+    """Inoltra execute_write al connettore e solleva dopo writes transazioni riuscite."""
+    def __init__(self, connector, writes):
+        self._connector = connector
+        self._writes = writes
+
+    def execute_write(self, statements):
+        if self._writes == 0:
+            raise RuntimeError("connessione persa")
+        self._writes -= 1
+        return self._connector.execute_write(statements)
+
+def test_fresh_load_matches_merge_load(chain, rpc_server, tmp_path, merge_graph):
+    fresh_graph = _load(chain, rpc_server, str(tmp_path / 'fresh'), fresh=True)
+    assert fresh_graph.failed_transactions == 0
+    assert fresh_graph.counts() == merge_graph.counts()
+    assert fresh_graph.snapshot() == merge_graph.snapshot()
+
+def test_fresh_load_falls_back_on_partial_block(chain, btc_connector, tmp_path, merge_graph):
+    neo4j = FakeNeo4j()
+    prevout_store = PrevoutStore(str(tmp_path / 'prevouts.sqlite'), config.PREVOUT_CACHE_SIZE)
+    partial_height = len(chain.blocks) // 2
+    for block in chain.blocks[:partial_height]:
+        assert process_block(block['height'], btc_connector, neo4j, prevout_store=prevout_store, fresh=True)
+
+    # Il blocco viene interrotto dopo il primo gruppo di transazioni: Block e
+    # parte delle transazioni esistono, ma il blocco non è segnato come completato.
+    rows = build_block_rows(partial_height, btc_connector.get_block_by_height(partial_height), btc_connector,
+                            prevout_store)
+    with pytest.raises(RuntimeError):
+        write_block_rows(_CrashAfter(neo4j, 1), rows, tx_chunk_size=3, fresh=True)
+    assert partial_height in neo4j.blocks and not neo4j.blocks[partial_height].get('ingested')
+
+    fallbacks = metrics.REGISTRY.snapshot()['counters'].get('etl_fresh_fallbacks', 0)
+    for block in chain.blocks[partial_height:]:
+        assert process_block(block['height'], btc_connector, neo4j, prevout_store=prevout_store, fresh=True)
+    prevout_store.close()
+    assert metrics.REGISTRY.snapshot()['counters']['etl_fresh_fallbacks'] == fallbacks + 1
+    assert neo4j.counts() == merge_graph.counts()
+    assert neo4j.snapshot() == merge_graph.snapshot()
+
+def _legacy_edges(edges, key, index):
+    """Relazioni come le scriveva il vecchio MERGE: senza indice e fuse per estremi e valore."""
+    legacy = {}
+    for edge in edges:
+        legacy.setdefault(tuple(edge[name] for name in key), dict(edge, **{index: None}))
+    return list(legacy.values())
+
+@pytest.fixture
+def duplicate_output_chain():
+    """Catena con una transazione che paga due volte lo stesso valore allo stesso indirizzo."""
+    chain = SyntheticChain(blocks=12, txs_per_block=10, seed=11, peel_chains=1, dormant_coins=2)
+    tx = next(tx for tx in chain.blocks[-1]['tx'][1:] if len(tx['vout']) >= 2)
+    # Le liste vout sono condivise tra i blocchi e getrawtransaction
+    tx['vout'][1].update(value=tx['vout'][0]['value'], scriptPubKey=dict(tx['vout'][0]['scriptPubKey']))
+    return chain
+
+def test_backfill_edge_indexes(duplicate_output_chain, tmp_path):
+    chain = duplicate_output_chain
+    server = FakeBitcoinRpcServer(chain).start()
+    try:
+        merge_graph = _load(chain, server, str(tmp_path / 'merge'), fresh=False)
+        expected = merge_graph.snapshot()
+        neo4j = FakeNeo4j()
+        neo4j._restore(copy.deepcopy(merge_graph._state()))
+        neo4j.received = _legacy_edges(merge_graph.received, ('tid', 'aid', 'value'), 'vout')
+        neo4j.sent = _legacy_edges(merge_graph.sent, ('aid', 'tid', 'value'), 'vin')
+        assert len(neo4j.received) == len(merge_graph.received) - 1
+        legacy_heights = {neo4j.transactions[edge['tid']]['block_height'] for edge in neo4j.received + neo4j.sent}
+
+        btc_connector = BitcoinConnector('test', 'test', server.host, server.port, config.RPC_BATCH_SIZE)
+        prevout_store = PrevoutStore(str(tmp_path / 'prevouts.sqlite'), config.PREVOUT_CACHE_SIZE)
+        updated = backfill_edge_indexes(neo4j, btc_connector, batch_blocks=5, prevout_store=prevout_store)
+        assert updated == len(legacy_heights)
+        assert neo4j.snapshot() == expected
+        # Rilanciata non trova più nulla da migrare
+        assert backfill_edge_indexes(neo4j, btc_connector, batch_blocks=5, prevout_store=prevout_store) == 0
+        prevout_store.close()
+    finally:
+        server.stop()
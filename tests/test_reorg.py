@@ -0,0 +1,144 @@
+"""Riorganizzazioni della catena: punto di fork, rollback del grafo e annullamento del clustering."""
+import os
+
+import pytest
+
+import config
+from etl.clustering import DisjointSet
+from etl.follow import ReorgTooDeepError, find_fork_height, rollback_blocks
+from etl.parser import process_block
+from etl.prevout_store import PrevoutStore
+from tests.fake_neo4j import FakeNeo4j
+
+DEPTH = 4
+
+def _load(chain, btc_connector, workdir, to_height):
+    """Carica con le query idempotenti i blocchi della catena fino a to_height."""
+    neo4j = FakeNeo4j()
+    prevout_store = PrevoutStore(os.path.join(workdir, 'prevouts.sqlite'), config.PREVOUT_CACHE_SIZE)
+    for block in chain.blocks[:to_height + 1]:
+        assert process_block(block['height'], btc_connector, neo4j, prevout_store=prevout_store)
+    prevout_store.close()
+    return neo4j
+
+def test_fork_height_and_rollback(chain, rpc_server, btc_connector, tmp_path):
+    tip = len(chain.blocks) - 1
+    (tmp_path / 'full').mkdir()
+    (tmp_path / 'prefix').mkdir()
+    neo4j = _load(chain, btc_connector, str(tmp_path / 'full'), tip)
+    assert find_fork_height(btc_connector, neo4j, tip, max_depth=10) == tip
+
+    rpc_server.reorg(DEPTH)
+    fork_height = find_fork_height(btc_connector, neo4j, tip, max_depth=10)
+    assert fork_height == tip - DEPTH
+    with pytest.raises(ReorgTooDeepError):
+        find_fork_height(btc_connector, neo4j, tip, max_depth=DEPTH - 1)
+
+    orphans = {tid for tid, tx in neo4j.transactions.items() if tx['block_height'] > fork_height}
+    assert orphans
+    rollback_blocks(neo4j, fork_height)
+    assert max(neo4j.blocks) == fork_height
+    assert not orphans & neo4j.transactions.keys()
+    # Il grafo è quello che si otterrebbe caricando solo i blocchi fino al fork,
+    # senza indirizzi comparsi solo nei blocchi orfani
+    expected = _load(chain, btc_connector, str(tmp_path / 'prefix'), fork_height)
+    assert neo4j.snapshot() == expected.snapshot()
+
+def _input_address_sets(chain):
+    """(altezza, indirizzi di input) delle transazioni, come get_input_address_sets_query."""
+    for block in chain.blocks:
+        for tx in block['tx']:
+            if tx['vin'][0].get('coinbase'):
+                continue
+            addresses = [chain.transactions[vin['txid']]['vout'][vin['vout']]['scriptPubKey']['address']
+                         for vin in tx['vin']]
+            yield block['height'], list(dict.fromkeys(addresses))
+
+def _cluster(disjoint_set, address_sets):
+    for height, addresses in address_sets:
+        disjoint_set.record(height)
+        address_ids = [disjoint_set.add(address) for address in addresses]
+        for address_id in address_ids[1:]:
+            disjoint_set.union(address_ids[0], address_id)
+
+def _state(disjoint_set):
+    return dict(disjoint_set.ids), disjoint_set.parent.tolist(), bytes(disjoint_set.rank)
+
+def _clusters(disjoint_set):
+    """Indirizzi, rank e rappresentante di ogni indirizzo: invarianti rispetto alla path compression."""
+    roots = [disjoint_set.find(node) for node in range(len(disjoint_set.parent))]
+    return dict(disjoint_set.ids), bytes(disjoint_set.rank), roots
+
+def test_disjoint_set_rewind(chain):
+    tip = len(chain.blocks) - 1
+    fork_height = tip - DEPTH
+    address_sets = list(_input_address_sets(chain))
+    disjoint_set = DisjointSet()
+    _cluster(disjoint_set, [item for item in address_sets if item[0] <= fork_height])
+    expected = _state(disjoint_set)
+
+    # Finché tutte le unioni sono nel registro nessun puntatore viene spostato
+    _cluster(disjoint_set, [item for item in address_sets if item[0] > fork_height])
+    assert _state(disjoint_set) != expected
+    roots, redo_heights = disjoint_set.rewind(fork_height)
+    assert _state(disjoint_set) == expected
+    assert roots and not redo_heights
+    assert all(height <= fork_height for height, _ in disjoint_set.history)
+
+    # Oltre il registro l'annullamento non è possibile
+    disjoint_set.forget(fork_height - DEPTH)
+    assert disjoint_set.rewind(fork_height - DEPTH - 2) is None
+    assert _clusters(disjoint_set)[0] == expected[0]
+
+def _balanced_unions(levels):
+    """(altezza, coppia di indirizzi): al livello k si uniscono alberi di rank k, fino a profondità levels."""
+    for level in range(levels):
+        step = 1 << level
+        for first in range(0, 1 << levels, 2 * step):
+            yield level, [f"addr{first}", f"addr{first + step}"]
+
+def test_path_compression_outside_undo_window():
+    levels = 5
+    unions = list(_balanced_unions(levels))
+    reference = DisjointSet()
+    _cluster(reference, [item for item in unions if item[0] < 2])
+
+    disjoint_set = DisjointSet()
+    _cluster(disjoint_set, unions)
+    leaf = disjoint_set.ids[f"addr{(1 << levels) - 1}"]
+    before = disjoint_set.parent.tolist()
+    disjoint_set.find(leaf)
+    assert disjoint_set.parent.tolist() == before
+
+    # Definitivi i livelli 0 e 1: il primo tratto del percorso viene compresso
+    disjoint_set.forget(2)
+    clusters = _clusters(disjoint_set)
+    compressed = [node for node, parent in enumerate(disjoint_set.parent) if parent != before[node]]
+    assert compressed and all(disjoint_set.settled[node] for node in compressed)
+    for node, parent in enumerate(disjoint_set.parent):
+        if disjoint_set.settled[node]:
+            assert not disjoint_set.settled[parent] or disjoint_set.parent[parent] == parent
+    assert _clusters(disjoint_set) == clusters
+
+    disjoint_set.rewind(1)
+    assert _clusters(disjoint_set) == _clusters(reference)
+
+    # Con tutte le unioni definitive ogni nodo punta direttamente alla radice
+    disjoint_set = DisjointSet()
+    _cluster(disjoint_set, unions)
+    disjoint_set.forget(levels)
+    root = disjoint_set.find(leaf)
+    assert all(disjoint_set.find(node) == root for node in range(1 << levels))
+    assert set(disjoint_set.parent) == {root}
+
+def test_disjoint_set_old_pickle(chain):
+    """Gli stati salvati senza settled lo ricostruiscono dal registro."""
+    disjoint_set = DisjointSet()
+    address_sets = list(_input_address_sets(chain))
+    _cluster(disjoint_set, address_sets)
+    disjoint_set.forget(len(chain.blocks) - DEPTH)
+    state = dict(disjoint_set.__dict__)
+    del state['settled']
+    restored = DisjointSet.__new__(DisjointSet)
+    restored.__setstate__(state)
+    assert restored.settled == disjoint_set.settled